@@ -3,18 +3,201 @@ Unified API client factory for the RAG project.
 Provides centralized client creation and management for OpenAI-compatible APIs.
 """
 
-from typing import Optional, List, Any
+import asyncio
+import time
+import weakref
+from collections import deque
+from typing import Optional, List, Any, Awaitable, Callable, Dict
 from openai import OpenAI, AsyncOpenAI
+import httpx
 import requests
 from config import Config, ModelType
+from utils import usage
 from utils.colored_logger import get_colored_logger
 
 logger = get_colored_logger(__name__)
 
+
+class CircuitOpenError(Exception):
+    """Raised when an endpoint's circuit breaker is open and calls fail fast"""
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies for one endpoint"""
+
+    def __init__(self, window: int = Config.LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Return the q-quantile (0-1) of the window, or None if empty"""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after consecutive failures; open -> half-open after the
+    recovery timeout, where a single trial call decides whether to close again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = Config.CIRCUIT_FAILURE_THRESHOLD,
+        recovery_timeout: float = Config.CIRCUIT_RECOVERY_TIMEOUT
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError if the call must not be attempted; returns whether it is the half-open trial"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                raise CircuitOpenError(f"Circuit for '{self.name}' is open, failing fast")
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError(f"Circuit for '{self.name}' is half-open, trial call in flight")
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit for '{self.name}' closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit for '{self.name}' opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def abandon_trial(self):
+        """A trial call ended without a verdict (cancelled); the next call may try again"""
+        self._trial_in_flight = False
+
+
+class EndpointGuard:
+    """
+    Per-endpoint hedging and circuit breaking for provider calls.
+
+    A duplicate request is sent once the primary exceeds the endpoint's recent
+    latency percentile, and whichever finishes first wins. Hedges are capped by
+    a budget ratio so the average number of requests stays close to one.
+    """
+
+    _guards: Dict[str, "EndpointGuard"] = {}
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(name)
+        self.calls = 0
+        self.hedges = 0
+
+    @classmethod
+    def get(cls, name: str) -> "EndpointGuard":
+        """Get or create the guard for an endpoint"""
+        if name not in cls._guards:
+            cls._guards[name] = cls(name)
+        return cls._guards[name]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None if hedging is not allowed now"""
+        if not Config.HEDGE_ENABLED or Config.HEDGE_MAX_EXTRA <= 0:
+            return None
+        if self.calls and self.hedges / self.calls >= Config.HEDGE_BUDGET_RATIO:
+            return None
+        if len(self.latency) < Config.HEDGE_MIN_SAMPLES:
+            return Config.HEDGE_MAX_DELAY
+        p = self.latency.percentile(Config.HEDGE_PERCENTILE)
+        return min(Config.HEDGE_MAX_DELAY, max(Config.HEDGE_MIN_DELAY, p))
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        on_duplicate: Optional[Callable[[], None]] = None
+    ) -> Any:
+        """
+        Run fn() with hedging and circuit breaking
+
+        Args:
+            fn: Zero-argument coroutine factory issuing one provider request
+            on_duplicate: Called once for every attempt still in flight when another
+                one won; the provider bills it although its response is discarded
+
+        Returns:
+            The result of the first attempt to succeed
+        """
+        trial = self.breaker.before_call()
+        settled = False
+        self.calls += 1
+        start = time.monotonic()
+        attempts = [asyncio.ensure_future(fn())]
+        extra = 0
+        last_error: Optional[BaseException] = None
+        try:
+            while attempts:
+                delay = self.hedge_delay() if extra < Config.HEDGE_MAX_EXTRA else None
+                done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    extra += 1
+                    self.hedges += 1
+                    logger.info(f"[{self.name}] No response after {delay:.2f}s, sending hedged request")
+                    attempts.append(asyncio.ensure_future(fn()))
+                    continue
+                for task in done:
+                    attempts.remove(task)
+                    if task.exception() is None:
+                        self.latency.record(time.monotonic() - start)
+                        self.breaker.record_success()
+                        settled = True
+                        if on_duplicate is not None:
+                            for _ in attempts:
+                                on_duplicate()
+                        return task.result()
+                    last_error = task.exception()
+            self.breaker.record_failure()
+            settled = True
+            raise last_error
+        finally:
+            for task in attempts:
+                task.cancel()
+            # A cancelled trial (client gone, coalesced caller cancelled) must not leave the breaker half-open for good
+            if trial and not settled:
+                self.breaker.abandon_trial()
+
 class APIClientFactory:
     """Factory for creating and managing API clients"""
     
     _clients = {}
+    _async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+    _http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
     
     @classmethod
     def get_client(cls, api_key: Optional[str] = None) -> OpenAI:
@@ -39,10 +222,52 @@ class APIClientFactory:
         
         return cls._clients[api_key]
     
+    @classmethod
+    def get_async_client(cls, api_key: Optional[str] = None) -> AsyncOpenAI:
+        """
+        Get or create an AsyncOpenAI client instance for the running event loop
+        
+        Args:
+            api_key: Optional API key, will use config default if not provided
+            
+        Returns:
+            AsyncOpenAI client instance
+        """
+        if api_key is None:
+            api_key = Config.get_api_key()
+        
+        # Async clients hold a connection pool bound to the event loop that created it
+        loop = asyncio.get_running_loop()
+        clients = cls._async_clients.setdefault(loop, {})
+        if api_key not in clients:
+            clients[api_key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=Config.API_BASE_URL
+            )
+        
+        return clients[api_key]
+    
+    @classmethod
+    def get_async_http_client(cls) -> httpx.AsyncClient:
+        """
+        Get or create a pooled httpx client for the running event loop,
+        for endpoints the OpenAI client does not cover (rerank)
+
+        Returns:
+            httpx.AsyncClient instance
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._http_clients.get(loop)
+        if client is None:
+            client = cls._http_clients[loop] = httpx.AsyncClient()
+        return client
+
     @classmethod
     def clear_cache(cls):
         """Clear the client cache"""
         cls._clients.clear()
+        cls._async_clients.clear()
+        cls._http_clients.clear()
 
 
 class RerankClient:
@@ -52,6 +277,20 @@ class RerankClient:
         self.api_key = api_key or Config.get_api_key()
         self.model_config = Config.get_model_config(ModelType.RERANK)
         self.base_url = Config.API_BASE_URL
+
+    @staticmethod
+    def _record_usage(result: dict, query: str, documents: List[str], hedged: bool = False):
+        """Account the tokens the provider reports (meta.tokens or usage), estimated if it reports none"""
+        tokens = (result.get("meta") or {}).get("tokens") or {}
+        reported = result.get("usage") or {}
+        if "input_tokens" in tokens:
+            usage.record(ModelType.RERANK, tokens["input_tokens"], tokens.get("output_tokens") or 0)
+        elif "total_tokens" in reported:
+            usage.record(ModelType.RERANK, reported["total_tokens"])
+        else:
+            # Every document is scored together with the query
+            estimate = sum(usage.estimate_tokens(query) + usage.estimate_tokens(document) for document in documents)
+            usage.record(ModelType.RERANK, estimate, estimated=True, hedged=hedged)
     
     def rerank(
         self,
@@ -94,43 +333,137 @@ class RerankClient:
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers)
+            response = requests.post(url, json=payload, headers=headers, timeout=Config.RERANK_TIMEOUT)
             response.raise_for_status()
             result = response.json()
+            self._record_usage(result, query, documents)
             return result
         except Exception as e:
             raise Exception(f"Rerank API request failed: {e}")
 
+    async def rerank_async(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: int
+    ) -> List[str]:
+        """Async version of rerank with hedging and circuit breaking"""
+        if not documents:
+            return []
+
+        if not all(isinstance(doc, str) for doc in documents):
+            raise ValueError(f"All documents must be strings, got: {[type(doc) for doc in documents]}")
+
+        logger.info(f"Reranking {len(documents)} documents for query: {query}")
+        url = f"{self.base_url}/rerank"
+
+        payload = {
+            "model": self.model_config.name,
+            "query": query,
+            "documents": documents,
+            "top_n": top_n
+        }
+
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        # Attempts, hedged duplicates included, share the loop's connection pool
+        http = APIClientFactory.get_async_http_client()
+
+        async def request_once():
+            response = await http.post(url, json=payload, headers=headers, timeout=Config.RERANK_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+
+        try:
+            result = await EndpointGuard.get("rerank").call(
+                request_once, on_duplicate=lambda: self._record_usage({}, query, documents, hedged=True)
+            )
+        except Exception as e:
+            raise Exception(f"Rerank API request failed: {e}")
+        self._record_usage(result, query, documents)
+        return result
+
 class EmbeddingClient:
     """Specialized client for embedding operations"""
     
     def __init__(self, api_key: Optional[str] = None):
+        self.api_key = api_key
         self.client = APIClientFactory.get_client(api_key)
-        self.async_client = AsyncOpenAI(
-            api_key=api_key or Config.get_api_key(),
-            base_url=Config.API_BASE_URL
-        )
         self.model_config = Config.get_model_config(ModelType.EMBEDDING)
 
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return APIClientFactory.get_async_client(self.api_key)
+
+    @staticmethod
+    def _record_usage(response: Any, inputs: List[str], hedged: bool = False):
+        """Account the tokens the provider reports, estimated if it reports none"""
+        reported = getattr(response, "usage", None)
+        if reported is not None and reported.prompt_tokens is not None:
+            usage.record(ModelType.EMBEDDING, reported.prompt_tokens)
+        else:
+            usage.record(
+                ModelType.EMBEDDING, sum(usage.estimate_tokens(text) for text in inputs), estimated=True, hedged=hedged
+            )
+
     async def create_embedding_async(self, text: str) -> list[float]:
         """Create embedding for a single text asynchronously"""
         try:
-            response = await self.async_client.embeddings.create(
-                model="Qwen/Qwen3-Embedding-4B",
-                input="To embedding: " + text,
-                dimensions=Config.DATABASE.dimensions
+            response = await EndpointGuard.get("embeddings").call(
+                lambda: self.async_client.embeddings.create(
+                    model="Qwen/Qwen3-Embedding-4B",
+                    input="To embedding: " + text,
+                    dimensions=Config.DATABASE.dimensions
+                ),
+                on_duplicate=lambda: self._record_usage(None, ["To embedding: " + text], hedged=True)
+            )
+        except Exception as e:
+            raise Exception(f"Embedding API request failed: {e}")
+        self._record_usage(response, ["To embedding: " + text])
+        return response.data[0].embedding
+
+    async def create_embeddings_async(self, texts: List[str]) -> List[List[float]]:
+        """Create embeddings for a batch of texts in one request, in input order"""
+        inputs = ["To embedding: " + text for text in texts]
+        try:
+            response = await EndpointGuard.get("embeddings_batch").call(
+                lambda: self.async_client.embeddings.create(
+                    model=self.model_config.name,
+                    input=inputs,
+                    dimensions=Config.DATABASE.dimensions
+                ),
+                on_duplicate=lambda: self._record_usage(None, inputs, hedged=True)
             )
-            return response.data[0].embedding
         except Exception as e:
             raise Exception(f"Embedding API request failed: {e}")
+        self._record_usage(response, inputs)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
 
 
 class ChatClient:
     """Specialized client for chat/completion operations"""
     
     def __init__(self, api_key: Optional[str] = None, model_type: ModelType = ModelType.CHAT):
+        self.api_key = api_key
         self.client = APIClientFactory.get_client(api_key)
+        self.model_type = model_type
         self.model_config = Config.get_model_config(model_type)
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return APIClientFactory.get_async_client(self.api_key)
+
+    def _record_usage(self, reported: Any, messages: List[Any], completion: str):
+        """Account the tokens the provider reports, estimated if it reports none (e.g. streams)"""
+        if reported is not None and reported.prompt_tokens is not None:
+            usage.record(self.model_type, reported.prompt_tokens, reported.completion_tokens or 0)
+        else:
+            usage.record(
+                self.model_type, usage.estimate_message_tokens(messages), usage.estimate_tokens(completion), estimated=True
+            )
     
     def create_completion(
         self, 
@@ -146,6 +479,7 @@ class ChatClient:
             )
             
             content = response.choices[0].message.content
+            self._record_usage(response.usage, messages, content or "")
             return content if content else "No response generated."
         
         except Exception as e:
@@ -164,13 +498,76 @@ class ChatClient:
                 temperature=self.model_config.temperature,
                 stream=True
             )
-            
+        except Exception as e:
+            raise Exception(f"Chat streaming completion API request failed: {e} + messages={messages}")
+
+        parts = []
+        reported = None
+        try:
             for chunk in response:
-                if chunk.choices[0].delta.content is not None:
+                # Some providers report usage in a last chunk without choices
+                reported = getattr(chunk, "usage", None) or reported
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    parts.append(chunk.choices[0].delta.content)
                     yield chunk.choices[0].delta.content
+        except Exception as e:
+            raise Exception(f"Chat streaming completion API request failed: {e} + messages={messages}")
+        finally:
+            # Counted even if the consumer stops early, the tokens generated so far are billed
+            self._record_usage(reported, messages, "".join(parts))
+
+    async def create_completion_async(
+        self, 
+        messages: List[Any]
+    ) -> str:
+        """Create a chat completion without blocking the event loop"""
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model_config.name,
+                messages=messages,
+                max_tokens=self.model_config.max_tokens,
+                temperature=self.model_config.temperature
+            )
+            
+            content = response.choices[0].message.content
+            self._record_usage(response.usage, messages, content or "")
+            return content if content else "No response generated."
         
+        except Exception as e:
+            raise Exception(f"Chat completion API request failed: {e} + messages={messages}")
+
+    async def create_completion_stream_async(
+        self, 
+        messages: List[Any]
+    ):
+        """Create a streaming chat completion without blocking the event loop"""
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model_config.name,
+                messages=messages,
+                max_tokens=self.model_config.max_tokens,
+                temperature=self.model_config.temperature,
+                stream=True
+            )
+        except Exception as e:
+            raise Exception(f"Chat streaming completion API request failed: {e} + messages={messages}")
+
+        parts = []
+        reported = None
+        try:
+            async for chunk in response:
+                # Some providers report usage in a last chunk without choices
+                reported = getattr(chunk, "usage", None) or reported
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
         except Exception as e:
             raise Exception(f"Chat streaming completion API request failed: {e} + messages={messages}")
+        finally:
+            # Counted even if the consumer stops early, the tokens generated so far are billed
+            self._record_usage(reported, messages, "".join(parts))
+            # Release the upstream HTTP stream even if the consumer stops early
+            await response.close()
 
 
 class ErrorHandler:
@@ -4,25 +4,49 @@ Provides a user-friendly web interface for PDF management and querying.
 """
 
 import os
-import shutil
-from typing import List, Optional
-from datetime import datetime
+import asyncio
+import json
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, List, Optional
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
+from starlette.datastructures import MutableHeaders
+from starlette.background import BackgroundTask
+from starlette.requests import HTTPConnection
+
+from config import Config
 
 # Import RAG modules
-from utils.pdf_manage import get_pdf_names, insert_pdf, set_active_pdfs, query_pdfs_async, query_pdfs_stream_async, delete_pdf
+from utils.pdf_manage import get_pdf_names, has_pdf, set_active_pdfs, query_pdfs_async, query_pdfs_stream_async, delete_pdf
 from rag_modules.clear import clear_database
-from rag_modules import get_database
+from rag_modules import answer_store, batch, doc_registry, get_database, maintenance
 from utils.colored_logger import get_colored_logger, logging
+from utils.ingest_jobs import IngestJobQueue
+from utils.marker_pool import shutdown_marker_pool
+from utils import admission, image_assets, metrics, session_store, usage
 
 logger = get_colored_logger(__name__, level=logging.DEBUG)
 
+# Background ingestion queue, uploads are processed outside the request
+ingest_queue = IngestJobQueue()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ingest_queue.start()
+    maintenance_task = None
+    if Config.MAINTENANCE_ENABLED:
+        maintenance_task = asyncio.create_task(maintenance.scheduler(is_busy=lambda: ingest_queue.busy))
+    yield
+    if maintenance_task is not None:
+        maintenance_task.cancel()
+    await ingest_queue.stop()
+    shutdown_marker_pool()
+
 # Initialize FastAPI app
-app = FastAPI(title="RAG System", description="PDF-based Retrieval-Augmented Generation System")
+app = FastAPI(title="RAG System", description="PDF-based Retrieval-Augmented Generation System", lifespan=lifespan)
 
 # Create necessary directories
 os.makedirs("static", exist_ok=True)
@@ -33,57 +57,123 @@ os.makedirs("database", exist_ok=True)  # Ensure docs directory exists
 
 # Mount static files and templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/docs", StaticFiles(directory="docs"), name="docs")  # Add docs directory for images
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")  # Add uploads directory for processed PDFs
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers cache images (revalidated with the ETag StaticFiles already sends)"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if str(full_path).lower().endswith(image_assets.IMAGE_EXTENSIONS):
+            response.headers["Cache-Control"] = f"public, max-age={Config.IMAGE_REVALIDATE_MAX_AGE}"
+        return response
+
+app.mount("/docs", CachedStaticFiles(directory="docs"), name="docs")  # Add docs directory for images
+app.mount("/uploads", CachedStaticFiles(directory="uploads"), name="uploads")  # Add uploads directory for processed PDFs
 templates = Jinja2Templates(directory="templates")
 
-# Global state for active PDFs (in production, use session management)
-active_pdfs = []
+class SessionCookieMiddleware:
+    """
+    Give every browser a session id cookie, available as request.state.session_id
 
-def save_answer_to_file(query: str, answer: str, used_pdfs: List[str]) -> str:
-    """Save LLM answer to a file in ./uploads directory"""
-    try:
-        # Create timestamp for filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        # Sanitize query for filename (remove special characters)
-        safe_query = "".join(c for c in query[:50] if c.isalnum() or c in (' ', '-', '_')).rstrip()
-        safe_query = safe_query.replace(' ', '_')
-        
-        filename = f"{timestamp}_{safe_query}.md"
-        filepath = os.path.join("uploads", filename)
-        
-        # Create content with metadata
-        content = f"""# Query Response - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    Per-session state (the active PDFs) is kept in the shared session store
+    under this id, so any web worker can serve any request. Plain ASGI rather
+    than BaseHTTPMiddleware, which would get in the way of disconnect detection
+    on streamed responses.
+    """
 
-## Query
-{query}
+    def __init__(self, app):
+        self.app = app
 
-## Used PDFs
-{', '.join(used_pdfs)}
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        session_id = HTTPConnection(scope).cookies.get(Config.SESSION_COOKIE, "")
+        is_new = not session_store.is_valid_session_id(session_id)
+        if is_new:
+            session_id = session_store.new_session_id()
+        scope.setdefault("state", {})["session_id"] = session_id
 
-## Answer
-{answer}
+        async def send_with_cookie(message):
+            if is_new and message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(
+                    "set-cookie",
+                    f"{Config.SESSION_COOKIE}={session_id}; Max-Age={Config.SESSION_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax"
+                )
+            await send(message)
 
----
-*Generated by RAG System*
-"""
-        
-        # Write to file
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        logger.info(f"Answer saved to: {filepath}")
-        return filename
-        
+        await self.app(scope, receive, send_with_cookie)
+
+app.add_middleware(SessionCookieMiddleware)
+
+@app.exception_handler(admission.Overloaded)
+async def overloaded_handler(request: Request, exc: admission.Overloaded):
+    """Shed load with 429 and a hint when to retry, instead of queueing work that would time out"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "stage": exc.stage},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+async def save_answer(query: str, answer: str, used_pdfs: List[str]) -> Optional[int]:
+    """Append an answer to the answer history; returns its id, or None if saving failed"""
+    try:
+        answer_id = await asyncio.to_thread(answer_store.add, query, answer, used_pdfs)
+        logger.info(f"Answer saved with id {answer_id}")
+        return answer_id
     except Exception as e:
-        logger.error(f"Error saving answer to file: {e}")
-        return ""
+        logger.error(f"Error saving answer: {e}")
+        return None
+
+
+class ClientDisconnected(Exception):
+    """The client went away while a response was being streamed"""
+
+
+async def _wait_for_disconnect(request: Request):
+    # The body has been read already, the next message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def until_disconnected(request: Request, iterator: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Yield from iterator until the client disconnects
+
+    Each step races the disconnect, so a client leaving during retrieval or
+    between chunks cancels the pending step at once instead of at the next write.
+    """
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(request))
+    step = None
+    try:
+        while True:
+            step = asyncio.ensure_future(anext(iterator))
+            await asyncio.wait({step, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                raise ClientDisconnected()
+            try:
+                item = step.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        disconnected.cancel()
+        if step is not None and not step.done():
+            # Cancelling the pending step unwinds the pipeline, closing its upstream HTTP streams
+            step.cancel()
+            await asyncio.gather(step, return_exceptions=True)
+        await iterator.aclose()
+
 
 # Pydantic models
 class QueryRequest(BaseModel):
     query: str
     active_pdfs: List[str]
 
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    active_pdfs: List[str]
+    save_answers: bool = False
+
 class SetActivePDFsRequest(BaseModel):
     pdf_names: List[str]
 
@@ -98,6 +188,7 @@ async def home(request: Request):
     try:
         get_database.get_database_client() # 重新获取数据库客户端
         pdf_list = list(get_pdf_names())
+        active_pdfs = await asyncio.to_thread(session_store.get_active_pdfs, request.state.session_id)
         return templates.TemplateResponse("index.html", {
             "request": request,
             "pdf_list": pdf_list,
@@ -110,7 +201,7 @@ async def home(request: Request):
 # 1. Import PDF functionality
 @app.post("/upload-pdf")
 async def upload_pdf(file: UploadFile = File(...)):
-    """Upload and process a PDF file"""
+    """Upload a PDF file and queue it for background processing"""
     try:
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
@@ -146,35 +237,85 @@ async def upload_pdf(file: UploadFile = File(...)):
         if not final_path.startswith(upload_dir):
             raise HTTPException(status_code=400, detail="Invalid file path")
         
-        # 检查文件是否已存在，如果存在则添加序号
-        counter = 1
-        while os.path.exists(upload_path):
-            name, ext = os.path.splitext(safe_filename)
-            safe_filename = f"{name}_{counter}{ext}"
-            upload_path = os.path.join("uploads", safe_filename)
-            counter += 1
-
-        # Save uploaded file
-        # upload_path = os.path.join("uploads", file.filename)
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Process the PDF
-        success = await insert_pdf(upload_path)
+        # Save uploaded file to a temporary path while hashing it
+        temp_path = os.path.join("uploads", f".{uuid.uuid4().hex}.upload")
+        with open(temp_path, "wb") as buffer:
+            sha256, size = await asyncio.to_thread(doc_registry.copy_with_sha256, file.file, buffer)
         
-        if success:
+        # 内容完全相同的PDF已导入，直接返回
+        duplicate = await asyncio.to_thread(doc_registry.find_by_hash, sha256)
+        if duplicate is not None and await asyncio.to_thread(has_pdf, duplicate["pdf_name"]):
+            os.remove(temp_path)
             return APIResponse(
-                success=True, 
-                message=f"Successfully uploaded and processed {file.filename}",
-                data={"filename": file.filename}
+                success=True,
+                message=f"{file.filename} is identical to already imported '{duplicate['pdf_name']}', skipped",
+                data={"filename": file.filename, "job_id": None, "duplicate_of": duplicate["pdf_name"]}
             )
-        else:
-            raise HTTPException(status_code=500, detail="Failed to process PDF")
+        
+        # 同名文件视为同一文档的修订版本，覆盖后增量更新
+        os.replace(temp_path, upload_path)
+        
+        # Queue the PDF for processing
+        try:
+            job = await ingest_queue.submit(upload_path, file.filename)
+        except asyncio.QueueFull:
+            os.remove(upload_path)
+            metrics.inc("admission_rejected_total", stage="ingest_queue")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many PDFs waiting to be processed, please retry later",
+                headers={"Retry-After": str(Config.ADMISSION_UPLOAD_RETRY_AFTER)}
+            )
+        
+        return APIResponse(
+            success=True, 
+            message=f"Uploaded {file.filename}, processing in background",
+            data={"filename": file.filename, "job_id": job.id, "status_url": f"/api/jobs/{job.id}"}
+        )
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading PDF: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 1.1. Ingestion job status functionality
+@app.get("/api/jobs")
+async def list_jobs():
+    """List recent ingestion jobs"""
+    jobs = [job.to_dict() for job in await ingest_queue.list()]
+    return APIResponse(
+        success=True,
+        message=f"Found {len(jobs)} ingestion jobs",
+        data={"jobs": jobs}
+    )
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get status and progress of an ingestion job"""
+    job = await ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return APIResponse(
+        success=True,
+        message=f"Job {job.status}",
+        data=job.to_dict()
+    )
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running ingestion job"""
+    job = await ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    if not await ingest_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job '{job_id}' already {job.status}")
+    return APIResponse(
+        success=True,
+        message=f"Cancellation requested for job {job_id}",
+        data=(await ingest_queue.get(job_id) or job).to_dict()
+    )
+
 # 2. List imported PDFs functionality  
 @app.get("/api/pdfs")
 async def list_pdfs():
@@ -192,12 +333,10 @@ async def list_pdfs():
 
 # 3. Set active PDFs functionality
 @app.post("/api/set-active-pdfs")
-async def set_active_pdfs_endpoint(request: SetActivePDFsRequest):
-    """Set which PDFs should be currently used for querying"""
+async def set_active_pdfs_endpoint(request: SetActivePDFsRequest, http_request: Request):
+    """Set which PDFs should be currently used for querying in this browser session"""
     try:
-        global active_pdfs
-        active_pdfs = request.pdf_names
-        success = set_active_pdfs(request.pdf_names)
+        success = await asyncio.to_thread(set_active_pdfs, request.pdf_names, http_request.state.session_id)
         
         if success:
             return APIResponse(
@@ -214,25 +353,19 @@ async def set_active_pdfs_endpoint(request: SetActivePDFsRequest):
 
 # 3.1. Delete specific PDF functionality
 @app.delete("/api/pdfs/{pdf_name}")
-async def delete_pdf_endpoint(pdf_name: str):
+async def delete_pdf_endpoint(pdf_name: str, http_request: Request):
     """Delete a specific PDF and all its associated data from the database"""
     try:
-        global active_pdfs
-        
         # Check if PDF exists first
         existing_pdfs = list(get_pdf_names())
         if pdf_name not in existing_pdfs:
             raise HTTPException(status_code=404, detail=f"PDF '{pdf_name}' not found")
         
-        # Remove from active PDFs if it's currently active
-        if pdf_name in active_pdfs:
-            active_pdfs.remove(pdf_name)
-            logger.info(f"Removed '{pdf_name}' from active PDFs list")
-        
-        # Delete the PDF
+        # Delete the PDF (this also deselects it in every session)
         success = delete_pdf(pdf_name)
         
         if success:
+            active_pdfs = await asyncio.to_thread(session_store.get_active_pdfs, http_request.state.session_id)
             return APIResponse(
                 success=True,
                 message=f"Successfully deleted PDF '{pdf_name}' and all associated data",
@@ -251,14 +384,15 @@ async def delete_pdf_endpoint(pdf_name: str):
 @app.post("/api/query")
 async def query_endpoint(request: QueryRequest):
     """Answer user's question based on selected PDFs"""
+    if not request.active_pdfs:
+        raise HTTPException(status_code=400, detail="No PDFs selected for querying")
+    ticket = admission.admit_query()
     try:
-        if not request.active_pdfs:
-            raise HTTPException(status_code=400, detail="No PDFs selected for querying")
+        async with usage.track(request.active_pdfs) as ledger:
+            answer = await query_pdfs_async(request.query, request.active_pdfs)
         
-        answer = await query_pdfs_async(request.query, request.active_pdfs)
-        
-        # Save answer to file
-        saved_filename = save_answer_to_file(request.query, answer, request.active_pdfs)
+        # Save answer to the answer history
+        answer_id = await save_answer(request.query, answer, request.active_pdfs)
         
         return APIResponse(
             success=True,
@@ -267,46 +401,70 @@ async def query_endpoint(request: QueryRequest):
                 "query": request.query,
                 "answer": answer,
                 "used_pdfs": request.active_pdfs,
-                "saved_file": saved_filename
+                "answer_id": answer_id,
+                # Tokens and cost of this request; zero when it joined an identical query already in flight
+                "usage": ledger.to_dict()
             }
         )
+    except admission.Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        ticket.release()
 
 # 4.1. Streaming Query functionality
 @app.post("/api/query/stream")
-async def query_stream_endpoint(request: QueryRequest):
-    """Stream answer for user's question based on selected PDFs"""
+async def query_stream_endpoint(request: QueryRequest, http_request: Request):
+    """Stream answer for user's question based on selected PDFs; stops all upstream work if the client leaves"""
+    if not request.active_pdfs:
+        raise HTTPException(status_code=400, detail="No PDFs selected for querying")
+    # Rejected with 429 here, before the response starts; the ticket is held until the stream ends
+    ticket = admission.admit_query()
     try:
-        if not request.active_pdfs:
-            raise HTTPException(status_code=400, detail="No PDFs selected for querying")
-        
         # Collect full answer for saving
         full_answer = ""
         
+        def record_cancellation():
+            # Before the first chunk the pipeline was still splitting, retrieving or reranking
+            stage = "generation" if full_answer else "retrieval"
+            metrics.inc("query_stream_cancelled_total", stage=stage)
+            metrics.inc("query_stream_cancelled_chars_total", len(full_answer))
+            logger.info(f"Client disconnected during {stage}, streaming query cancelled after {len(full_answer)} chars")
+
         async def generate_stream():
             nonlocal full_answer
             try:
-                async for chunk in query_pdfs_stream_async(request.query, request.active_pdfs):
-                    if chunk:
-                        # Accumulate chunks for saving
-                        full_answer += chunk
-                        # Ensure proper SSE format
-                        yield f"data: {chunk}\n\n"
+                pipeline = until_disconnected(http_request, query_pdfs_stream_async(request.query, request.active_pdfs))
+                async with usage.track(request.active_pdfs), aclosing(pipeline):
+                    async for chunk in pipeline:
+                        if chunk:
+                            # Accumulate chunks for saving
+                            full_answer += chunk
+                            # Ensure proper SSE format
+                            yield f"data: {chunk}\n\n"
                 
                 # Save the complete answer after streaming is done
                 if full_answer.strip():
-                    saved_filename = save_answer_to_file(request.query, full_answer, request.active_pdfs)
-                    logger.info(f"Streaming answer saved to: {saved_filename}")
+                    await save_answer(request.query, full_answer, request.active_pdfs)
                 
                 yield "data: [DONE]\n\n"  # Signal completion
+            except ClientDisconnected:
+                record_cancellation()
+            except (asyncio.CancelledError, GeneratorExit):
+                # The server closed the response after a failed write
+                record_cancellation()
+                raise
             except Exception as e:
                 logger.error(f"Error in stream generation: {e}")
                 yield f"data: Error: {str(e)}\n\n"
+            finally:
+                ticket.release()
         
         return StreamingResponse(
             generate_stream(),
+            background=BackgroundTask(ticket.release),
             media_type="text/plain",
             headers={
                 "Cache-Control": "no-cache",
@@ -317,17 +475,65 @@ async def query_stream_endpoint(request: QueryRequest):
             }
         )
     except Exception as e:
+        ticket.release()
         logger.error(f"Error processing streaming query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 4.2. Batch Query functionality
+@app.post("/api/query/batch")
+async def query_batch_endpoint(request: BatchQueryRequest, http_request: Request):
+    """
+    Answer many questions against the selected PDFs, sharing embedding, search and rerank work
+
+    Results are streamed as JSON lines in completion order, each carrying the
+    question's index in the request; a last line {"done": true, ...} ends the batch.
+    """
+    if not request.active_pdfs:
+        raise HTTPException(status_code=400, detail="No PDFs selected for querying")
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="No questions given")
+    if len(request.questions) > Config.BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {Config.BATCH_MAX_QUESTIONS} questions per batch")
+
+    async def generate_results():
+        answered = failed = 0
+        started = asyncio.get_running_loop().time()
+        try:
+            results = until_disconnected(http_request, batch.query_batch_async(request.questions, request.active_pdfs))
+            async with usage.track(request.active_pdfs) as ledger, aclosing(results):
+                async for result in results:
+                    if result["error"] is None:
+                        answered += 1
+                        if request.save_answers:
+                            result["answer_id"] = await save_answer(result["question"], result["answer"], request.active_pdfs)
+                    else:
+                        failed += 1
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({
+                "done": True,
+                "answered": answered,
+                "failed": failed,
+                "seconds": round(asyncio.get_running_loop().time() - started, 2),
+                "usage": ledger.to_dict(),
+            }, ensure_ascii=False) + "\n"
+        except ClientDisconnected:
+            logger.info(f"Client disconnected, batch query cancelled after {answered + failed} of {len(request.questions)} questions")
+        except Exception as e:
+            logger.error(f"Error in batch query: {e}")
+            yield json.dumps({"done": True, "error": str(e)}) + "\n"
+
+    return StreamingResponse(
+        generate_results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # 5. Clear database functionality
 @app.delete("/api/clear")
 async def clear_all_data():
     """Clear all imported PDFs from the database"""
     try:
         clear_database()
-        global active_pdfs
-        active_pdfs = []
         
         return APIResponse(
             success=True,
@@ -337,64 +543,180 @@ async def clear_all_data():
         logger.error(f"Error clearing database: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 6. Collection maintenance
+@app.get("/api/admin/maintenance")
+async def maintenance_status():
+    """Whether maintenance is due on each shard, and the result of its last run"""
+    try:
+        reports = await asyncio.to_thread(maintenance.check_all)
+        due = [report["shard"] for report in reports if report["needed"]]
+        return APIResponse(
+            success=True,
+            message=f"Maintenance due on shard(s) {due}" if due else "No maintenance due",
+            data={
+                "needed": bool(due),
+                "running": maintenance.is_running(),
+                "shards": reports,
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error checking maintenance: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/maintenance")
+async def run_maintenance(force: bool = False):
+    """Compact the collections, rebuild their vector indexes and compact the text stores; reports before/after"""
+    if maintenance.is_running():
+        raise HTTPException(status_code=409, detail="Maintenance is already running")
+    try:
+        results = await asyncio.to_thread(maintenance.run_all, force)
+    except Exception as e:
+        logger.error(f"Maintenance failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if any(result["status"] == "already_running" for result in results):
+        raise HTTPException(status_code=409, detail="Maintenance is already running")
+    completed = [result["shard"] for result in results if result["status"] == "completed"]
+    return APIResponse(
+        success=True,
+        message=f"Maintained shard(s) {completed}" if completed else "Nothing to do",
+        data={"shards": results}
+    )
+
+# 7. Metrics
+@app.get("/api/metrics")
+async def get_metrics():
+    """Operational counters (e.g. streaming queries cancelled by client disconnects, requests shed) and stage load"""
+    return APIResponse(
+        success=True,
+        message="Metrics",
+        data={"counters": metrics.snapshot(), "cache_hit_rates": metrics.cache_hit_rates(), "admission": admission.status()}
+    )
+
+@app.get("/api/usage")
+async def get_usage(
+        group_by: str = "day",
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        pdf: Optional[str] = None):
+    """
+    Token and cost totals of provider calls, grouped by a comma separated
+    list of day, stage, model and pdf_set (empty for one total); since/until
+    are inclusive days (YYYY-MM-DD), pdf keeps PDF sets containing that PDF
+    """
+    columns = [column.strip() for column in group_by.split(",") if column.strip()]
+    try:
+        totals = await asyncio.to_thread(usage.summary, columns, since, until, pdf)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return APIResponse(success=True, message="Usage", data=totals)
+
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    """
+    All metrics of this worker in the Prometheus text format: per-stage latency
+    histograms (rag_stage_seconds by stage, model and outcome), in-flight gauges,
+    cache lookups and the counters of /api/metrics
+    """
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "message": "RAG system is running"}
 
-# List saved answers endpoint
+# Answer history endpoints
 @app.get("/api/answers")
-async def list_saved_answers():
-    """List all saved answer files"""
+async def list_saved_answers(
+        limit: int = 50,
+        before_id: Optional[int] = None,
+        pdf: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        q: Optional[str] = None
+):
+    """
+    Page through saved answers, newest first
+
+    Pass next_before_id from a response as before_id to get the next page.
+    Filters: pdf (document used), since/until (Unix seconds), q (full-text search).
+    """
     try:
-        answers_dir = "uploads"
-        answer_files = []
-        
-        if os.path.exists(answers_dir):
-            for filename in os.listdir(answers_dir):
-                if filename.endswith('.md'):
-                    filepath = os.path.join(answers_dir, filename)
-                    stat = os.stat(filepath)
-                    
-                    answer_files.append({
-                        "filename": filename,
-                        "path": filepath,
-                        "size": stat.st_size,
-                        "created": datetime.fromtimestamp(stat.st_ctime).strftime("%Y-%m-%d %H:%M:%S"),
-                        "modified": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
-                    })
-        
-        # Sort by creation time (newest first)
-        answer_files.sort(key=lambda x: x['created'], reverse=True)
-        
+        page = await asyncio.to_thread(
+            answer_store.list_answers, limit, before_id, pdf, since, until, q
+        )
         return APIResponse(
             success=True,
-            message=f"Found {len(answer_files)} saved answers",
-            data={"answers": answer_files}
+            message=f"Found {len(page['answers'])} saved answers",
+            data=page
         )
     except Exception as e:
         logger.error(f"Error listing saved answers: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Test endpoint for checking image accessibility
+@app.get("/api/answers/{answer_id}")
+async def get_saved_answer(answer_id: int):
+    """Full text of a saved answer"""
+    entry = await asyncio.to_thread(answer_store.get, answer_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Answer {answer_id} not found")
+    return APIResponse(success=True, message="Answer found", data=entry)
+
+@app.delete("/api/answers/{answer_id}")
+async def delete_saved_answer(answer_id: int):
+    """Delete a saved answer"""
+    if not await asyncio.to_thread(answer_store.delete, answer_id):
+        raise HTTPException(status_code=404, detail=f"Answer {answer_id} not found")
+    return APIResponse(success=True, message=f"Answer {answer_id} deleted")
+
+# Image assets
+@app.get("/assets/{pdf_name}/{filename}")
+async def image_asset(pdf_name: str, filename: str, request: Request, size: Optional[str] = None, v: Optional[str] = None):
+    """
+    Serve an extracted figure (size=thumb for its thumbnail) with a strong ETag
+
+    URLs carrying the current content version (?v=etag) are cached for a year
+    without revalidation; unversioned URLs are revalidated after IMAGE_REVALIDATE_MAX_AGE.
+    """
+    entry = await asyncio.to_thread(image_assets.get, pdf_name, filename)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if size == "thumb" and entry["thumbnail_path"]:
+        path, etag = entry["thumbnail_path"], entry["thumbnail_etag"]
+    else:
+        path, etag = entry["path"], entry["etag"]
+
+    versioned = v == etag
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={Config.IMAGE_CACHE_MAX_AGE}, immutable" if versioned
+        else f"public, max-age={Config.IMAGE_REVALIDATE_MAX_AGE}",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or f'"{etag}"' in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image file missing")
+    return FileResponse(path, headers=headers)
+
 @app.get("/test-images")
-async def test_images():
-    """Test endpoint to list available images"""
+async def test_images(pdf: Optional[str] = None, page: Optional[int] = None):
+    """List indexed images, optionally of one PDF and page"""
     try:
-        images = []
-        docs_path = "docs"
-        if os.path.exists(docs_path):
-            for root, dirs, files in os.walk(docs_path):
-                for file in files:
-                    if file.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                        rel_path = os.path.relpath(os.path.join(root, file), docs_path)
-                        images.append({
-                            "filename": file,
-                            "path": f"/docs/{rel_path}",
-                            "full_path": os.path.join(root, file)
-                        })
-        
+        entries = await asyncio.to_thread(image_assets.list_images, pdf, page)
+        images = [
+            {
+                "filename": entry["filename"],
+                "pdf_name": entry["pdf_name"],
+                "page_id": entry["page_id"],
+                "path": image_assets.asset_url(entry),
+                "thumbnail": image_assets.asset_url(entry, thumbnail=True) if entry["thumbnail_path"] else None,
+                "full_path": entry["path"],
+                "width": entry["width"],
+                "height": entry["height"],
+            }
+            for entry in entries
+        ]
         return APIResponse(
             success=True,
             message=f"Found {len(images)} images",
@@ -409,4 +731,10 @@ async def test_images():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    if Config.WEB_WORKERS > 1 and "://" not in Config.DATABASE.path:
+        raise SystemExit(
+            "A Milvus Lite file can only be opened by one process; "
+            "set RAG_MILVUS_URI to a Milvus server to run several web workers"
+        )
+    # Worker processes import the app themselves, so it is passed by name
+    uvicorn.run("app:app", host=Config.WEB_HOST, port=Config.WEB_PORT, workers=Config.WEB_WORKERS)
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+Microbenchmark for the Markdown chunker.
+
+Generates synthetic Markdown manuals of increasing size (sections with
+repeated titles, tables and mixed CJK/ASCII text) and reports:
+  - section lookup time: the previous approach (str.find from the start of
+    the document for every TOC entry) vs the single forward pass
+  - full chunking time on an in-memory string and on a memory-mapped file
+  - peak Python heap while streaming chunks from the memory-mapped file
+
+Usage:
+    python benchmarks/bench_chunk.py [--sizes 1 5 20] [--skip-legacy-above 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import chunk  # noqa: E402
+
+_WORDS = "clock input output latch serial parallel shift register voltage supply pin timing".split()
+_CJK = "引脚配置时钟输入输出电压电源寄存器并行串行移位"
+
+
+def synthetic_markdown(target_mb: float, seed: int = 0):
+    """Build a Markdown document of roughly target_mb megabytes and its table of contents"""
+    rng = random.Random(seed)
+    parts, toc = [], []
+    size, section, page = 0, 0, 0
+    target = int(target_mb * 1024 * 1024)
+    while size < target:
+        # Every 10th section reuses a common title to exercise repeated headings
+        title = "## Electrical Characteristics" if section % 10 == 9 else f"## {section}. {rng.choice(_WORDS).title()} {section}"
+        body = []
+        for _ in range(rng.randint(3, 12)):
+            words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(20, 120)))
+            cjk = "".join(rng.choice(_CJK) for _ in range(rng.randint(0, 40)))
+            body.append(words + cjk)
+        body.append("| Pin | Name | Description |\n|---|---|---|\n" + "\n".join(
+            f"| {i} | P{i} | {rng.choice(_WORDS)} |" for i in range(rng.randint(2, 16))
+        ))
+        text = f"{title}\n\n" + "\n\n".join(body) + "\n\n"
+        parts.append(text)
+        toc.append({"title": title, "page_id": page})
+        size += len(text.encode("utf-8"))
+        section += 1
+        if section % 3 == 0:
+            page += 1
+    return "".join(parts), toc
+
+
+def legacy_sections(markdown_content: str, toc):
+    """Section lookup as done before the single-pass chunker (kept here for comparison)"""
+    seen, filtered = set(), []
+    for item in toc:
+        if item["title"] not in seen:
+            filtered.append(item)
+            seen.add(item["title"])
+    spans = []
+    for i, item in enumerate(filtered):
+        start = markdown_content.find(item["title"])
+        end = markdown_content.find(filtered[i + 1]["title"]) if i + 1 < len(filtered) else len(markdown_content)
+        spans.append((start, end))
+    return spans
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def peak_mb(fn) -> float:
+    """Peak traced Python heap while running fn, in MB (run separately: tracing slows everything down)"""
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Markdown chunker")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 5, 20], help="Document sizes in MB")
+    parser.add_argument("--skip-legacy-above", type=float, default=5, help="Skip the quadratic lookup above this size")
+    args = parser.parse_args()
+
+    print(
+        f"{'size MB':>8} {'sections':>9} {'chunks':>8} {'old find s':>11} {'new find s':>11} "
+        f"{'str s':>7} {'mmap s':>7} {'MB/s':>6} {'peak MB':>8}"
+    )
+    for size_mb in args.sizes:
+        markdown, toc = synthetic_markdown(size_mb)
+
+        legacy = "-"
+        if size_mb <= args.skip_legacy_above:
+            _, seconds = timed(lambda: legacy_sections(markdown, toc))
+            legacy = f"{seconds:.2f}"
+        _, find_seconds = timed(lambda: list(chunk._iter_sections(markdown, chunk._filter_toc(toc), lambda s: s)))
+
+        chunks, str_seconds = timed(lambda: chunk.chunk_with_metadata(markdown, toc))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            md_path = os.path.join(tmp, "doc.md")
+            meta_path = os.path.join(tmp, "doc_meta.json")
+            with open(md_path, "w", encoding="utf-8") as f:
+                f.write(markdown)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"table_of_contents": toc}, f)
+            del markdown
+            # Consume chunks without keeping them, as the streaming ingestion pipeline does
+            count, mmap_seconds = timed(lambda: sum(1 for _ in chunk.iter_chunks(md_path, meta_path)))
+            peak = peak_mb(lambda: sum(1 for _ in chunk.iter_chunks(md_path, meta_path)))
+
+        assert count == len(chunks)
+        print(
+            f"{size_mb:>8.1f} {len(toc):>9} {count:>8} {legacy:>11} {find_seconds:>11.3f} "
+            f"{str_seconds:>7.2f} {mmap_seconds:>7.2f} {size_mb / mmap_seconds:>6.1f} {peak:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
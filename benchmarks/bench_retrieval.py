@@ -0,0 +1,388 @@
+"""
+Retrieval quality vs. latency sweep.
+
+Takes labelled questions (question -> relevant pages of a PDF) and evaluates
+every combination of the retrieval knobs:
+  - chunk_token_limit / chunk_size_limit (documents are re-chunked and re-ingested per setting)
+  - vector index type, nlist and search nprobe (Milvus Lite always searches FLAT; use --milvus-uri for IVF)
+  - DEFAULT_SEARCH_LIMIT and DEFAULT_RERANK_LIMIT
+  - split vs. no split (sub-questions from the split model, or the question alone)
+  - rerank vs. no rerank (the first DEFAULT_RERANK_LIMIT hits per sub-query in similarity order)
+
+For each configuration it reports recall@k over the referenced pages (in the
+order they would reach the prompt), MRR, the prompt tokens of the answer
+request and the latency of the split, search (embedding included) and rerank
+stages. The table lists the Pareto front: configurations no other one beats on
+recall, MRR, latency and prompt tokens at once. With --min-recall it also names
+the fastest configuration that meets the bar.
+
+The split of each question does not depend on any knob, so it runs once and its
+measured latency is added to every configuration that splits.
+
+Questions file (JSON lines, as written by benchmarks/corpus.py):
+    {"question": "...", "pdf_name": "SN74X0001", "relevant_pages": [4, 5], "pdfs": [...]}
+"pdfs" (optional) are the documents searched; by default the question's PDF and
+--pdfs-per-query - 1 others. Documents are read from DOCS_DIR/{name}/{name}.md
+and {name}_meta.json, the layout of docs/.
+
+Usage:
+    python benchmarks/bench_retrieval.py [--docs 10] [--search-limits 5 15 30] [--rerank-limits 3 5] [--min-recall 0.9]
+    python benchmarks/bench_retrieval.py --questions labelled.jsonl --docs-dir docs --base-url https://api.siliconflow.cn/v1
+"""
+
+import argparse
+import ast
+import asyncio
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import bench_stages  # Puts the repository root on sys.path
+import corpus
+import mock_provider
+from config import Config
+
+# Knobs that need the documents re-ingested, and knobs applied per query
+INGEST_KNOBS = ("chunk_tokens", "chunk_chars", "index_type", "nlist")
+QUERY_KNOBS = ("search_limit", "rerank_limit", "nprobe", "split", "rerank")
+
+
+@dataclass
+class Question:
+    question: str
+    pdf_name: str
+    relevant_pages: Set[int]
+    pdfs: List[str]
+
+
+def load_questions(path: str, pdfs_per_query: int) -> List[Question]:
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    names = list(dict.fromkeys(record["pdf_name"] for record in records))
+    questions = []
+    for record in records:
+        pdfs = record.get("pdfs")
+        if not pdfs:
+            # The question's own document plus neighbours as distractors
+            start = names.index(record["pdf_name"])
+            pdfs = [names[(start + offset) % len(names)] for offset in range(min(pdfs_per_query, len(names)))]
+        questions.append(Question(record["question"], record["pdf_name"], set(record["relevant_pages"]), pdfs))
+    return questions
+
+
+def apply(setting: Dict[str, object]):
+    """Set the configuration knobs present in setting"""
+    if "chunk_tokens" in setting:
+        Config.DATABASE.chunk_token_limit = setting["chunk_tokens"]
+        Config.DATABASE.chunk_size_limit = setting["chunk_chars"]
+        Config.DATABASE.index_type = setting["index_type"]
+        Config.DATABASE.index_nlist = setting["nlist"]
+    if "search_limit" in setting:
+        Config.DEFAULT_SEARCH_LIMIT = setting["search_limit"]
+        Config.DEFAULT_RERANK_LIMIT = setting["rerank_limit"]
+        Config.DATABASE.search_nprobe = setting["nprobe"]
+
+
+def grid(args: argparse.Namespace, knobs: Sequence[str]) -> List[Dict[str, object]]:
+    values = {
+        "chunk_tokens": args.chunk_tokens,
+        "chunk_chars": args.chunk_chars,
+        "index_type": args.index_types,
+        "nlist": args.nlist,
+        "search_limit": args.search_limits,
+        "rerank_limit": args.rerank_limits,
+        "nprobe": args.nprobe,
+        "split": [mode == "on" for mode in args.split],
+        "rerank": [mode == "on" for mode in args.rerank],
+    }
+    return [dict(zip(knobs, combination)) for combination in itertools.product(*(values[knob] for knob in knobs))]
+
+
+def ranked_pages(references: List[dict]) -> List[Tuple[str, int]]:
+    """Distinct (PDF, page) of the references, in prompt order"""
+    return list(dict.fromkeys((reference.get("pdf_name"), reference.get("page_number")) for reference in references))
+
+
+def score(question: Question, pages: List[Tuple[str, int]], ks: Sequence[int]) -> dict:
+    relevant = {(question.pdf_name, page) for page in question.relevant_pages}
+    hits = [page in relevant for page in pages]
+    first = next((rank for rank, hit in enumerate(hits, start=1) if hit), None)
+    result = {f"recall@{k}": len(relevant & set(pages[:k])) / len(relevant) for k in ks}
+    result["recall"] = len(relevant & set(pages)) / len(relevant)
+    result["mrr"] = 1 / first if first else 0.0
+    return result
+
+
+async def ingest(documents: Dict[str, Tuple[str, str]], concurrency: int) -> dict:
+    """Chunk and insert every document with the current settings"""
+    from rag_modules import insert
+    from utils import chunk
+
+    semaphore = asyncio.Semaphore(concurrency)
+    chunk_counts: List[int] = []
+    chunk_tokens: List[int] = []
+
+    async def one(name: str, markdown_path: str, meta_path: str) -> bool:
+        async with semaphore:
+            chunks = await asyncio.to_thread(chunk.load_and_chunk, markdown_path, meta_path)
+            chunk_counts.append(len(chunks))
+            chunk_tokens.extend(chunk.estimate_tokens(item["content"]) for item in chunks)
+            return await insert.insert_data(chunks, name)
+
+    started = time.perf_counter()
+    stored = await asyncio.gather(*[one(name, *paths) for name, paths in documents.items()])
+    if not all(stored):
+        raise RuntimeError("Some documents could not be ingested")
+    return {
+        "chunks": sum(chunk_counts),
+        "mean_chunk_tokens": round(sum(chunk_tokens) / len(chunk_tokens), 1) if chunk_tokens else 0,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+async def split_all(questions: List[Question], concurrency: int) -> Dict[str, Tuple[List[str], float]]:
+    """Sub-questions of every question (the question first, as the query pipeline does) and the split latency"""
+    from rag_modules import query
+
+    semaphore = asyncio.Semaphore(concurrency)
+    splits = {}
+
+    async def one(question: str):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await query.split_query_async(question)
+            seconds = time.perf_counter() - started
+        try:
+            sub_questions = [str(item) for item in ast.literal_eval(response)]
+        except (ValueError, SyntaxError, TypeError):
+            sub_questions = []
+        splits[question] = ([question] + sub_questions, seconds)
+
+    await asyncio.gather(*[one(question.question) for question in questions])
+    return splits
+
+
+async def evaluate(
+    questions: List[Question],
+    splits: Dict[str, Tuple[List[str], float]],
+    setting: Dict[str, object],
+    ks: Sequence[int],
+    concurrency: int
+) -> dict:
+    """Retrieve the references of every question with the current settings and score them"""
+    from rag_modules import query, refer, search
+    from utils.usage import estimate_message_tokens
+
+    semaphore = asyncio.Semaphore(concurrency)
+    rows: List[dict] = []
+    errors = 0
+
+    async def one(question: Question):
+        nonlocal errors
+        sub_questions, split_seconds = splits[question.question] if setting["split"] else ([question.question], 0.0)
+        async with semaphore:
+            try:
+                started = time.perf_counter()
+                results = await search.search_async(sub_questions, question.pdfs)
+                searched = time.perf_counter()
+                references = await refer.rerank_hits(sub_questions, results, rerank=setting["rerank"])
+                finished = time.perf_counter()
+            except Exception as e:
+                errors += 1
+                logging.getLogger(__name__).warning(f"Retrieval failed for '{question.question}': {e}")
+                return
+        messages = query._answer_messages(sub_questions, references, "chinese", streaming=True)
+        rows.append({
+            **score(question, ranked_pages(references), ks),
+            "references": len(references),
+            "prompt_tokens": estimate_message_tokens(messages),
+            "split_s": split_seconds,
+            "search_s": searched - started,
+            "rerank_s": finished - searched,
+            "retrieval_s": split_seconds + finished - started,
+        })
+
+    await asyncio.gather(*[one(question) for question in questions])
+
+    def mean(key: str) -> float:
+        return sum(row[key] for row in rows) / len(rows) if rows else 0.0
+
+    def ms(key: str, q: float) -> Optional[float]:
+        value = bench_stages.percentile([row[key] for row in rows], q)
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        **setting,
+        "questions": len(rows),
+        "errors": errors,
+        **{key: round(mean(key), 4) for key in [f"recall@{k}" for k in ks] + ["recall", "mrr"]},
+        "references": round(mean("references"), 1),
+        "prompt_tokens": round(mean("prompt_tokens")),
+        "split_p50_ms": ms("split_s", 0.5),
+        "search_p50_ms": ms("search_s", 0.5),
+        "rerank_p50_ms": ms("rerank_s", 0.5),
+        "retrieval_p50_ms": ms("retrieval_s", 0.5),
+        "retrieval_p95_ms": ms("retrieval_s", 0.95),
+    }
+
+
+def pareto_front(results: List[dict], quality: str) -> List[dict]:
+    """Configurations not dominated on (quality, MRR: higher; latency p50, prompt tokens: lower)"""
+    def objectives(result: dict) -> Tuple[float, ...]:
+        return (result[quality], result["mrr"], -(result["retrieval_p50_ms"] or 0), -result["prompt_tokens"])
+
+    front = []
+    for result in results:
+        own = objectives(result)
+        dominated = any(
+            all(a >= b for a, b in zip(objectives(other), own)) and objectives(other) != own
+            for other in results if other is not result
+        )
+        if not dominated:
+            front.append(result)
+    return front
+
+
+def print_table(results: List[dict], ks: Sequence[int], front: List[dict]):
+    knobs = list(INGEST_KNOBS[:2]) + (["index_type", "nlist", "nprobe"] if len({(r["index_type"], r["nlist"], r["nprobe"]) for r in results}) > 1 else [])
+    knobs += ["search_limit", "rerank_limit", "split", "rerank"]
+    headers = {
+        "chunk_tokens": "tokens", "chunk_chars": "chars", "index_type": "index", "nlist": "nlist", "nprobe": "nprobe",
+        "search_limit": "search", "rerank_limit": "rerank_n", "split": "split", "rerank": "rerank",
+    }
+    metrics = [f"recall@{k}" for k in ks] + ["recall", "mrr", "prompt_tokens", "split_p50_ms", "search_p50_ms", "rerank_p50_ms", "retrieval_p50_ms", "retrieval_p95_ms"]
+    titles = [f"R@{k}" for k in ks] + ["R@all", "MRR", "prompt tok", "split ms", "search ms", "rerank ms", "p50 ms", "p95 ms"]
+
+    def cell(result: dict, key: str) -> str:
+        value = result.get(key)
+        if isinstance(value, bool):
+            return "on" if value else "off"
+        return "-" if value is None else str(value)
+
+    print("  " + " ".join(f"{headers[knob]:>8}" for knob in knobs) + " " + " ".join(f"{title:>10}" for title in titles))
+    front_ids = {id(result) for result in front}
+    for result in sorted(results, key=lambda r: r["retrieval_p50_ms"] or 0):
+        marker = "* " if id(result) in front_ids else "  "
+        print(marker + " ".join(f"{cell(result, knob):>8}" for knob in knobs) + " " + " ".join(f"{cell(result, key):>10}" for key in metrics))
+
+
+async def sweep(args: argparse.Namespace, base_url: str, directory: str) -> Tuple[List[dict], List[dict]]:
+    questions = load_questions(args.questions, args.pdfs_per_query)
+    names = sorted({name for question in questions for name in question.pdfs})
+    documents = {
+        name: (os.path.join(args.docs_dir, name, f"{name}.md"), os.path.join(args.docs_dir, name, f"{name}_meta.json"))
+        for name in names
+    }
+    print(f"{len(questions)} questions over {len(documents)} documents")
+
+    results, ingests = [], []
+    splits = None
+    for index, ingest_setting in enumerate(grid(args, INGEST_KNOBS)):
+        # A fresh database per chunking / index setting
+        bench_stages.configure(os.path.join(directory, f"index{index}"), base_url, args.dimensions)
+        if args.milvus_uri:
+            Config.DATABASE.path = args.milvus_uri
+            Config.DATABASE.collection_name = f"rag_eval_{os.getpid()}_{index}"
+        apply(ingest_setting)
+        report = await ingest(documents, args.ingest_concurrency)
+        ingests.append({**ingest_setting, **report})
+        print(f"Ingested with {ingest_setting}: {report['chunks']} chunks, {report['mean_chunk_tokens']} tokens each")
+
+        if splits is None:
+            splits = await split_all(questions, args.concurrency)
+        for query_setting in grid(args, QUERY_KNOBS):
+            setting = {**ingest_setting, **query_setting}
+            apply(setting)
+            results.append(await evaluate(questions, splits, setting, args.k, args.concurrency))
+
+        if args.milvus_uri:
+            from rag_modules.get_database import connect, shards
+            for shard in shards():
+                connect(shard).drop_collection(collection_name=shard.collection_name)
+    return results, ingests
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Sweep retrieval settings and report quality against latency")
+    parser.add_argument("--questions", help="Labelled questions (JSON lines); default: a generated synthetic corpus")
+    parser.add_argument("--docs-dir", default="docs", help="Marker output folders of the documents in --questions")
+    parser.add_argument("--docs", type=int, default=10, help="Synthetic datasheets when no --questions are given")
+    parser.add_argument("--filler-pages", type=int, default=8, help="Pages of filler text per synthetic datasheet")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pdfs-per-query", type=int, default=3, help="PDFs each question searches, unless it lists them")
+    parser.add_argument("--chunk-tokens", type=int, nargs="+", default=[Config.DATABASE.chunk_token_limit], help="chunk_token_limit values")
+    parser.add_argument("--chunk-chars", type=int, nargs="+", default=[Config.DATABASE.chunk_size_limit], help="chunk_size_limit values")
+    parser.add_argument("--index-types", nargs="+", default=[Config.DATABASE.index_type], help="Vector index types, e.g. IVF_FLAT IVF_SQ8 FLAT")
+    parser.add_argument("--nlist", type=int, nargs="+", default=[Config.DATABASE.index_nlist], help="IVF cluster counts")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[Config.DATABASE.search_nprobe], help="IVF clusters searched")
+    parser.add_argument("--search-limits", type=int, nargs="+", default=[5, Config.DEFAULT_SEARCH_LIMIT, 30], help="DEFAULT_SEARCH_LIMIT values")
+    parser.add_argument("--rerank-limits", type=int, nargs="+", default=[3, Config.DEFAULT_RERANK_LIMIT], help="DEFAULT_RERANK_LIMIT values")
+    parser.add_argument("--split", nargs="+", choices=["on", "off"], default=["on", "off"], help="Search with sub-questions or the question alone")
+    parser.add_argument("--rerank", nargs="+", choices=["on", "off"], default=["on", "off"], help="Rerank search hits or keep similarity order")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10], help="Cut-offs of recall@k")
+    parser.add_argument("--quality-k", type=int, default=5, help="recall@k used for the Pareto front and --min-recall")
+    parser.add_argument("--min-recall", type=float, help="Name the fastest configuration with at least this recall@quality-k")
+    parser.add_argument("--all", action="store_true", help="List every configuration, not only the Pareto front")
+    parser.add_argument("--concurrency", type=int, default=4, help="Questions evaluated at once")
+    parser.add_argument("--ingest-concurrency", type=int, default=Config.INGEST_WORKERS, help="Documents ingested at once")
+    parser.add_argument("--dimensions", type=int, default=256, help="Embedding size of the evaluation collections")
+    parser.add_argument("--milvus-uri", help="Evaluate on a Milvus server (temporary collections) instead of Milvus Lite files")
+    parser.add_argument("--base-url", help="Use this provider instead of starting the mock")
+    parser.add_argument("--provider-option", action="append", default=[], help="Flag passed to mock_provider.py (repeatable)")
+    parser.add_argument("--label", help="Suffix for the result file name")
+    parser.add_argument("--output-dir", default=os.path.join(bench_stages.RESULTS_DIR, "retrieval"), help="Where results are saved")
+    parser.add_argument("--verbose", action="store_true", help="Keep the pipeline's logging")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.quality_k not in args.k:
+        args.k = sorted(set(args.k) | {args.quality_k})
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    provider = None if args.base_url else mock_provider.MockProvider(args.provider_option)
+    with tempfile.TemporaryDirectory(prefix="rag-eval-") as directory, provider or nullcontext():
+        if args.questions is None:
+            args.docs_dir = os.path.join(directory, "corpus")
+            args.questions = corpus.write(corpus.generate(args.docs, args.filler_pages, args.seed), args.docs_dir)
+        results, ingests = asyncio.run(sweep(args, args.base_url or provider.base_url, directory))
+
+    quality = f"recall@{args.quality_k}"
+    front = pareto_front(results, quality)
+    print(f"\n{len(results)} configurations, {len(front)} on the Pareto front (*) of {quality}, MRR, p50 latency and prompt tokens:")
+    print_table(results if args.all else front, args.k, front)
+
+    if args.min_recall is not None:
+        meeting = [result for result in results if result[quality] >= args.min_recall]
+        if meeting:
+            best = min(meeting, key=lambda r: (r["retrieval_p50_ms"] or 0, r["prompt_tokens"]))
+            print(f"\nFastest with {quality} >= {args.min_recall}: " + ", ".join(
+                f"{knob}={best[knob]}" for knob in INGEST_KNOBS + QUERY_KNOBS
+            ) + f" ({quality} {best[quality]}, {best['retrieval_p50_ms']} ms p50, {best['prompt_tokens']} prompt tokens)")
+        else:
+            print(f"\nNo configuration reaches {quality} >= {args.min_recall}")
+
+    commit, dirty = bench_stages.git_commit()
+    run = {
+        "label": args.label,
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output_dir", "verbose", "all")},
+        "ingests": ingests,
+        "configurations": results,
+        "pareto_front": [results.index(result) for result in front],
+    }
+    print(f"\nSaved {bench_stages.save(run, args.output_dir)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Offline benchmark of the ingestion and query pipeline stages.
+
+Starts the local mock provider (benchmarks/mock_provider.py) in a subprocess,
+generates a synthetic datasheet corpus (benchmarks/corpus.py) and runs every
+stage against a throwaway database in a temporary directory:
+  - chunk:        utils.chunk.chunk_with_metadata per document
+  - insert:       rag_modules.insert.insert_data per document (embedding + Milvus insert)
+  - search:       rag_modules.search.search_async per question
+  - reference:    rag_modules.refer.get_reference per question and its sub-questions
+  - query_stream: utils.pdf_manage.query_pdfs_stream_async end to end, with time to first chunk
+
+Each stage reports throughput and latency percentiles, plus the provider
+requests it made. Results are saved as JSON under benchmarks/results/ (named
+by time and commit) and can be compared with an earlier run.
+
+Usage:
+    python benchmarks/bench_stages.py [--docs 20] [--questions 40] [--concurrency 8] [--compare latest]
+    python benchmarks/bench_stages.py --compare-files OLD.json NEW.json
+    # provider behaviour is set with mock_provider.py flags, e.g.
+    python benchmarks/bench_stages.py --provider-option=--chat-latency=1.0:0.5 --provider-option=--error-rate=0.02
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import corpus  # noqa: E402
+import mock_provider  # noqa: E402
+from config import Config, ModelType  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Metrics compared between runs: (key, higher is better)
+COMPARED = [("throughput", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("ttft_p50_ms", False)]
+
+
+def configure(directory: str, base_url: str, dimensions: int):
+    """Point every database file at a scratch directory and the API clients at the provider"""
+    os.makedirs(directory, exist_ok=True)
+    os.environ.setdefault(Config.API_KEY_ENV_VAR, "benchmark")
+    Config.API_BASE_URL = base_url
+    for field in dataclasses.fields(Config.DATABASE):
+        if field.name.endswith("path"):
+            setattr(Config.DATABASE, field.name, os.path.join(directory, os.path.basename(getattr(Config.DATABASE, field.name))))
+    Config.MAINTENANCE_STATE_PATH = os.path.join(directory, "maintenance.json")
+    Config.MAINTENANCE_ENABLED = False
+    Config.DATABASE.dimensions = dimensions
+    Config.MODELS[ModelType.EMBEDDING].dimensions = dimensions
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Nearest-rank q-quantile (0-1), None if there are no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(stage: str, unit: str, latencies: List[float], items: int, seconds: float, errors: int, **extra) -> dict:
+    def ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "stage": stage,
+        "ops": len(latencies),
+        "errors": errors,
+        "items": items,
+        "unit": unit,
+        "seconds": round(seconds, 3),
+        "throughput": round(items / seconds, 2) if seconds > 0 else None,
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 0.5)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(max(latencies)) if latencies else None,
+        **extra,
+    }
+
+
+async def run_concurrently(
+    inputs: Sequence[Any],
+    operation: Callable[[Any], Awaitable[Any]],
+    concurrency: int
+) -> Tuple[List[float], List[Any], int, float]:
+    """Run operation on every input with bounded concurrency; returns latencies, results, errors and wall time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(item):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return await operation(item)
+            except Exception as e:
+                errors += 1
+                logging.getLogger(__name__).warning(f"Benchmark operation failed: {e}")
+                return None
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(item) for item in inputs])
+    return latencies, results, errors, time.perf_counter() - started
+
+
+def pick_questions(datasheets: List[corpus.Datasheet], count: int, pdfs_per_query: int) -> List[Tuple[str, List[str]]]:
+    """(question, PDFs to search) pairs; distinct texts, so concurrent identical requests are not coalesced"""
+    pool = [(question, sheet.name) for sheet in datasheets for question, _ in sheet.questions]
+    names = [sheet.name for sheet in datasheets]
+    picked = []
+    for i in range(count):
+        question, pdf_name = pool[i % len(pool)]
+        if i >= len(pool):
+            question = f"{question} (variant {i // len(pool)})"
+        # The question's own document plus neighbours, as when a user selects a few related datasheets
+        start = names.index(pdf_name)
+        pdfs = [names[(start + offset) % len(names)] for offset in range(min(pdfs_per_query, len(names)))]
+        picked.append((question, pdfs))
+    return picked
+
+
+async def bench(args: argparse.Namespace, provider: Optional[mock_provider.MockProvider]) -> List[dict]:
+    # Imported after configure(), so module-level clients pick up the benchmark settings
+    from rag_modules import insert, refer, search
+    from utils import chunk, pdf_manage
+
+    def provider_requests() -> Optional[dict]:
+        if provider is None:
+            return None
+        stats = provider.stats()
+        provider.reset_stats()
+        return stats
+
+    results = []
+    datasheets = corpus.generate(args.docs, args.filler_pages, args.seed)
+    corpus_bytes = sum(len(sheet.markdown.encode("utf-8")) for sheet in datasheets)
+    print(f"Corpus: {len(datasheets)} documents, {corpus_bytes / 1024:.0f} KiB")
+
+    # chunk: CPU only, sequential
+    latencies, chunked = [], {}
+    started = time.perf_counter()
+    for _ in range(args.chunk_rounds):
+        for sheet in datasheets:
+            begin = time.perf_counter()
+            chunked[sheet.name] = chunk.chunk_with_metadata(sheet.markdown, sheet.toc)
+            latencies.append(time.perf_counter() - begin)
+    seconds = time.perf_counter() - started
+    chunk_count = sum(len(chunks) for chunks in chunked.values())
+    results.append(summarize(
+        "chunk", "chunks/s", latencies, chunk_count * args.chunk_rounds, seconds, 0,
+        mb_per_second=round(corpus_bytes * args.chunk_rounds / 1024 / 1024 / seconds, 2)
+    ))
+
+    # insert: embedding requests and Milvus inserts, a few documents at a time like the ingestion workers
+    if provider is not None:
+        provider.reset_stats()
+    latencies, outcomes, errors, seconds = await run_concurrently(
+        datasheets, lambda sheet: insert.insert_data(chunked[sheet.name], sheet.name), args.ingest_concurrency
+    )
+    errors += sum(1 for outcome in outcomes if outcome is False)
+    results.append(summarize("insert", "chunks/s", latencies, chunk_count, seconds, errors, provider_requests=provider_requests()))
+
+    questions = pick_questions(datasheets, args.questions, args.pdfs_per_query)
+    # Load the collection and open connections before timing
+    await search.search_async([questions[0][0]], questions[0][1])
+    provider_requests()
+
+    latencies, _, errors, seconds = await run_concurrently(
+        questions, lambda item: search.search_async([item[0]], item[1]), args.concurrency
+    )
+    results.append(summarize("search", "queries/s", latencies, len(questions), seconds, errors, provider_requests=provider_requests()))
+
+    async def reference(item):
+        question, pdfs = item
+        return await refer.get_reference(split_query=[question] + mock_provider.split_question(question), included_pdfs=pdfs)
+
+    variant = [(f"{question} (reference)", pdfs) for question, pdfs in questions]
+    latencies, references, errors, seconds = await run_concurrently(variant, reference, args.concurrency)
+    kept = [len(found) for found in references if found is not None]
+    results.append(summarize(
+        "reference", "queries/s", latencies, len(variant), seconds, errors,
+        references_mean=round(sum(kept) / len(kept), 1) if kept else None, provider_requests=provider_requests()
+    ))
+
+    first_chunk: List[float] = []
+
+    async def query_stream(item):
+        question, pdfs = item
+        started = time.perf_counter()
+        chunks = 0
+        async for part in pdf_manage.query_pdfs_stream_async(question, pdfs):
+            if chunks == 0:
+                first_chunk.append(time.perf_counter() - started)
+            chunks += 1
+            if part.startswith("Error occurred"):
+                raise RuntimeError(part)
+        return chunks
+
+    variant = [(f"{question} (end to end)", pdfs) for question, pdfs in questions]
+    latencies, _, errors, seconds = await run_concurrently(variant, query_stream, args.concurrency)
+    results.append(summarize(
+        "query_stream", "queries/s", latencies, len(variant), seconds, errors,
+        ttft_p50_ms=round(percentile(first_chunk, 0.5) * 1000, 2) if first_chunk else None,
+        ttft_p95_ms=round(percentile(first_chunk, 0.95) * 1000, 2) if first_chunk else None,
+        provider_requests=provider_requests()
+    ))
+    return results
+
+
+def git_commit() -> Tuple[str, bool]:
+    """Short hash of HEAD and whether the working tree has changes"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def save(run: dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{run['commit']}{'-dirty' if run['dirty'] else ''}"
+    if run.get("label"):
+        name += f"-{run['label']}"
+    path = os.path.join(directory, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def latest_result(directory: str, exclude: Optional[str] = None) -> Optional[str]:
+    paths = sorted(path for path in glob.glob(os.path.join(directory, "*.json")) if path != exclude)
+    return paths[-1] if paths else None
+
+
+def print_results(stages: List[dict]):
+    print(f"{'stage':<13} {'ops':>5} {'err':>4} {'throughput':>17} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ttft p50':>9}")
+    for stage in stages:
+        throughput = f"{stage['throughput']} {stage['unit']}" if stage["throughput"] is not None else "-"
+        print(
+            f"{stage['stage']:<13} {stage['ops']:>5} {stage['errors']:>4} {throughput:>17} "
+            + " ".join(f"{stage.get(key) if stage.get(key) is not None else '-':>9}" for key in ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms"))
+        )
+
+
+def compare(baseline: dict, current: dict):
+    """Print the change of every compared metric; positive percentages are improvements"""
+    print(f"\nCompared with {baseline['commit']}{' (dirty)' if baseline['dirty'] else ''} from {baseline['created_at']}:")
+    print(f"{'stage':<13} {'metric':<12} {'before':>10} {'after':>10} {'change':>9}")
+    before = {stage["stage"]: stage for stage in baseline["stages"]}
+    for stage in current["stages"]:
+        old = before.get(stage["stage"])
+        if old is None:
+            continue
+        for key, higher_is_better in COMPARED:
+            if old.get(key) is None or stage.get(key) is None or not old[key]:
+                continue
+            change = (stage[key] - old[key]) / old[key] * 100 * (1 if higher_is_better else -1)
+            print(f"{stage['stage']:<13} {key:<12} {old[key]:>10} {stage[key]:>10} {change:>+8.1f}%")
+
+
+def load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages offline against a mock provider")
+    parser.add_argument("--docs", type=int, default=20, help="Synthetic datasheets to generate")
+    parser.add_argument("--filler-pages", type=int, default=8, help="Pages of filler text per datasheet")
+    parser.add_argument("--questions", type=int, default=40, help="Queries per query stage")
+    parser.add_argument("--pdfs-per-query", type=int, default=3, help="PDFs each query searches")
+    parser.add_argument("--concurrency", type=int, default=8, help="Queries in flight in the query stages")
+    parser.add_argument("--ingest-concurrency", type=int, default=Config.INGEST_WORKERS, help="Documents inserted at once")
+    parser.add_argument("--chunk-rounds", type=int, default=3, help="Times the corpus is chunked")
+    parser.add_argument("--dimensions", type=int, default=256, help="Embedding size of the benchmark collection")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-url", help="Use this provider instead of starting the mock (e.g. to calibrate against the live API)")
+    parser.add_argument("--provider-option", action="append", default=[], help="Flag passed to mock_provider.py (repeatable)")
+    parser.add_argument("--label", help="Suffix for the result file name")
+    parser.add_argument("--output-dir", default=RESULTS_DIR, help="Where results are saved")
+    parser.add_argument("--compare", help="Result file to compare with, or 'latest' for the previous run")
+    parser.add_argument("--compare-files", nargs=2, metavar=("OLD", "NEW"), help="Only compare two saved runs")
+    parser.add_argument("--verbose", action="store_true", help="Keep the pipeline's logging")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.compare_files:
+        compare(load(args.compare_files[0]), load(args.compare_files[1]))
+        return
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    provider = None if args.base_url else mock_provider.MockProvider(args.provider_option)
+    with tempfile.TemporaryDirectory(prefix="rag-bench-") as directory, provider or nullcontext():
+        configure(directory, args.base_url or provider.base_url, args.dimensions)
+        stages = asyncio.run(bench(args, provider))
+
+    commit, dirty = git_commit()
+    run = {
+        "label": args.label,
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("compare", "compare_files", "output_dir", "verbose")},
+        "stages": stages,
+    }
+    print_results(stages)
+    path = save(run, args.output_dir)
+    print(f"\nSaved {path}")
+
+    baseline_path = latest_result(args.output_dir, exclude=path) if args.compare == "latest" else args.compare
+    if args.compare and baseline_path is None:
+        print("No earlier result to compare with")
+    elif baseline_path:
+        compare(load(baseline_path), run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Synthetic datasheet corpus for offline benchmarks and retrieval evaluation.
+
+Generates datasheet-like Markdown in the layout Marker produces
+({name}/{name}.md with a table of contents in {name}/{name}_meta.json): a
+feature list, pin table, ratings and characteristics tables, prose sections
+and filler pages of detailed description. Every document shares the same
+structure with different values, so the sections compete with each other the
+way real datasheets of one product family do.
+
+Alongside the documents it writes questions.jsonl, one labelled question per
+line: {"question", "pdf_name", "relevant_pages"}, the pages being 1-based
+page numbers as stored with each chunk.
+
+Usage:
+    python benchmarks/corpus.py OUTPUT_DIR [--docs 20] [--filler-pages 8] [--seed 0]
+"""
+
+import argparse
+import json
+import os
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+_FUNCTIONS = [
+    ("8-bit shift register with output latches", "serial data input"),
+    ("octal bus transceiver with 3-state outputs", "direction control input"),
+    ("dual D-type flip-flop with set and reset", "clock input"),
+    ("synchronous step-down DC/DC converter", "feedback input"),
+    ("low-dropout linear voltage regulator", "enable input"),
+    ("12-bit successive approximation ADC", "conversion start input"),
+]
+_PACKAGES = ["SOIC-16", "TSSOP-16", "QFN-20", "SOT-23-5", "DIP-16", "VSSOP-10", "BGA-24"]
+_PIN_NAMES = ["VCC", "GND", "OE", "CLK", "SER", "RCLK", "SRCLR", "QA", "QB", "QC", "QD", "QH'", "EN", "FB", "SW", "DIR"]
+_WORDS = (
+    "device output input register supply logic signal transition buffer stage current threshold level load "
+    "capacitance edge pulse cascade internal external mode operation bus line node path design board layout "
+    "trace ground plane decoupling noise margin reliability drive strength family series compatible"
+).split()
+
+
+@dataclass
+class Datasheet:
+    name: str
+    markdown: str
+    toc: List[Dict]
+    # Question -> 1-based pages that answer it
+    questions: List[Tuple[str, List[int]]] = field(default_factory=list)
+
+
+def _paragraph(rng: random.Random, name: str, words: int) -> str:
+    text = " ".join(rng.choice(_WORDS) for _ in range(words))
+    return f"The {name} {text}."
+
+
+def _table(header: List[str], rows: List[List[str]]) -> str:
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines += ["| " + " | ".join(row) + " |" for row in rows]
+    return "\n".join(lines)
+
+
+def make_datasheet(index: int, filler_pages: int, rng: random.Random) -> Datasheet:
+    """One datasheet; every section starts a new page and has its own table of contents entry"""
+    function, key_pin = _FUNCTIONS[index % len(_FUNCTIONS)]
+    name = f"SN{74 + index % 3}X{index:04d}"
+    vcc_max = rng.choice(["6", "7", "5.5", "18", "36"])
+    vcc_min = rng.choice(["1.65", "2", "2.7", "3"])
+    temp_min, temp_max = rng.choice([("-40", "85"), ("-40", "125"), ("0", "70"), ("-55", "150")])
+    tpd = rng.randint(4, 40)
+    fmax = rng.choice([25, 50, 100, 150, 200])
+    icc = rng.choice([1, 2, 4, 8, 20, 80])
+    package = rng.choice(_PACKAGES)
+    pins = rng.sample(_PIN_NAMES, 8)
+    key_pin_number = rng.randint(1, 8)
+
+    sections: List[Tuple[str, str]] = []
+    sections.append((f"# {name} {function}", "\n".join([
+        "## Features",
+        f"- Wide operating voltage range of {vcc_min} V to {vcc_max} V",
+        f"- Propagation delay {tpd} ns typical",
+        f"- Low power consumption, {icc} µA maximum supply current",
+        f"- Available in {package} package",
+        "",
+        _paragraph(rng, name, 60),
+    ])))
+    sections.append(("## Description", "\n\n".join(_paragraph(rng, name, 80) for _ in range(3))))
+    pin_rows = [
+        [str(i), pin, key_pin if i == key_pin_number else f"{rng.choice(_WORDS)} {rng.choice(['input', 'output'])}"]
+        for i, pin in enumerate(pins, start=1)
+    ]
+    sections.append(("## Pin Configuration and Functions", _table(["Pin", "Name", "Description"], pin_rows)))
+    sections.append(("## Absolute Maximum Ratings", _table(["Parameter", "Min", "Max", "Unit"], [
+        ["Supply voltage VCC", "-0.5", vcc_max, "V"],
+        ["Input voltage VI", "-0.5", "VCC + 0.5", "V"],
+        ["Storage temperature Tstg", "-65", "150", "°C"],
+    ]) + "\n\n" + _paragraph(rng, name, 40)))
+    sections.append(("## Recommended Operating Conditions", _table(["Parameter", "Min", "Max", "Unit"], [
+        ["Supply voltage VCC", vcc_min, vcc_max, "V"],
+        ["Operating free-air temperature TA", temp_min, temp_max, "°C"],
+        ["Input transition rise and fall rate", "0", "500", "ns/V"],
+    ])))
+    sections.append(("## Electrical Characteristics", _table(["Parameter", "Test conditions", "Typ", "Max", "Unit"], [
+        ["Quiescent supply current ICC", f"VCC = {vcc_max} V", str(icc / 10), str(icc), "µA"],
+        ["High-level output voltage VOH", "IOH = -4 mA", "4.3", "-", "V"],
+        ["Input leakage current II", "VI = VCC or GND", "0.1", "1", "µA"],
+    ])))
+    sections.append(("## Switching Characteristics", _table(["Parameter", "From", "To", "Typ", "Max", "Unit"], [
+        ["Propagation delay tpd", "CLK", "Q", str(tpd), str(tpd * 2), "ns"],
+        ["Maximum clock frequency fmax", "-", "-", str(fmax), "-", "MHz"],
+    ])))
+    sections.append(("## Application Information", "\n\n".join(
+        [f"Typical applications of the {name} include serial-to-parallel conversion, LED drivers and general "
+         f"purpose I/O expansion in {function} designs."] + [_paragraph(rng, name, 80) for _ in range(2)]
+    )))
+    for page in range(filler_pages):
+        sections.append((
+            f"## Detailed Description {page + 1}",
+            "\n\n".join(_paragraph(rng, name, 90) for _ in range(4))
+        ))
+    sections.append(("## Package Information", _table(["Package", "Pins", "Body size"], [
+        [package, package.split("-")[-1], f"{rng.randint(3, 10)} mm x {rng.randint(3, 6)} mm"],
+    ])))
+
+    # Marker's table of contents holds the heading text without the Markdown markers
+    toc = [{"title": title.lstrip("# "), "page_id": page, "heading_level": title.count("#")} for page, (title, _) in enumerate(sections)]
+    markdown = "\n\n".join(f"{title}\n\n{body}" for title, body in sections) + "\n"
+    page_of = {title: page + 1 for page, (title, _) in enumerate(sections)}
+
+    datasheet = Datasheet(name=name, markdown=markdown, toc=toc)
+    datasheet.questions = [
+        (f"What is the maximum supply voltage rating of {name}?", [page_of["## Absolute Maximum Ratings"], page_of["## Recommended Operating Conditions"]]),
+        (f"What is the operating free-air temperature range of {name}?", [page_of["## Recommended Operating Conditions"]]),
+        (f"Which pin of {name} is the {key_pin}?", [page_of["## Pin Configuration and Functions"]]),
+        (f"What is the propagation delay tpd of {name}?", [page_of["## Switching Characteristics"], page_of[f"# {name} {function}"]]),
+        (f"What is the maximum clock frequency fmax of {name}?", [page_of["## Switching Characteristics"]]),
+        (f"What is the quiescent supply current ICC of {name}?", [page_of["## Electrical Characteristics"]]),
+        (f"Which package body size is {name} available in?", [page_of["## Package Information"]]),
+        (f"What are typical applications of {name}?", [page_of["## Application Information"]]),
+    ]
+    return datasheet
+
+
+def generate(docs: int, filler_pages: int = 8, seed: int = 0) -> List[Datasheet]:
+    rng = random.Random(seed)
+    return [make_datasheet(index, filler_pages, rng) for index in range(docs)]
+
+
+def write(datasheets: List[Datasheet], directory: str) -> str:
+    """Write the documents in Marker's output layout and the labelled questions; returns the questions file"""
+    questions_path = os.path.join(directory, "questions.jsonl")
+    os.makedirs(directory, exist_ok=True)
+    with open(questions_path, "w", encoding="utf-8") as questions:
+        for datasheet in datasheets:
+            folder = os.path.join(directory, datasheet.name)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f"{datasheet.name}.md"), "w", encoding="utf-8") as f:
+                f.write(datasheet.markdown)
+            with open(os.path.join(folder, f"{datasheet.name}_meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"table_of_contents": datasheet.toc}, f, ensure_ascii=False)
+            for question, pages in datasheet.questions:
+                questions.write(json.dumps(
+                    {"question": question, "pdf_name": datasheet.name, "relevant_pages": pages}, ensure_ascii=False
+                ) + "\n")
+    return questions_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic datasheet corpus with labelled questions")
+    parser.add_argument("output", help="Directory for the documents and questions.jsonl")
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--filler-pages", type=int, default=8, help="Pages of detailed description per document")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    datasheets = generate(args.docs, args.filler_pages, args.seed)
+    questions_path = write(datasheets, args.output)
+    size = sum(len(datasheet.markdown.encode("utf-8")) for datasheet in datasheets)
+    print(f"Wrote {len(datasheets)} documents ({size / 1024:.0f} KiB) and {questions_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Local OpenAI-compatible stand-in for the model provider, for offline benchmarks.
+
+Serves the endpoints the project calls: /v1/embeddings, /v1/chat/completions
+(plain and streamed) and /v1/rerank. Responses are deterministic and cheap but
+not meaningless, so retrieval can be benchmarked and evaluated offline:
+  - embeddings hash the words of the text into a normalized vector (similar texts are close)
+  - rerank scores documents by their overlap with the query terms
+  - the split prompt gets a Python list of sub-questions, answers are filler text
+
+Every endpoint waits for a latency drawn from a log-normal distribution
+(median and sigma per endpoint) and fails with the configured probability,
+so tail latency, hedging and error handling can be exercised too.
+
+Usage:
+    python benchmarks/mock_provider.py [--port 9911] [--embeddings-latency 0.03:0.3] [--error-rate 0.01]
+    # then point Config.API_BASE_URL at http://127.0.0.1:9911/v1
+
+Benchmarks start it in a subprocess with MockProvider(...).
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import zlib
+from collections import Counter
+from typing import List, Optional
+
+_TOKEN = re.compile(r"[A-Za-z0-9]+|[\u3000-\u9fff\uac00-\ud7af]")
+# Prompt prefixes the project adds, and words too common to discriminate
+_STOPWORDS = {
+    "to", "embedding", "content", "the", "of", "a", "an", "and", "or", "is", "are", "what", "which", "for",
+    "in", "on", "at", "by", "with", "how", "does", "do", "it", "its", "this", "that", "be", "as", "from",
+}
+_FILLER = "the requested value is given in the referenced table on the cited page of the datasheet".split()
+
+
+def terms(text: str) -> List[str]:
+    """Lower-cased words (and single CJK characters) without stopwords"""
+    return [token for token in (match.lower() for match in _TOKEN.findall(text)) if token not in _STOPWORDS]
+
+
+def embed(text: str, dimensions: int) -> List[float]:
+    """Feature-hashed bag of words with sublinear term weights, L2-normalized"""
+    vector = [0.0] * dimensions
+    for term, count in Counter(terms(text)).items():
+        h = zlib.crc32(term.encode("utf-8"))
+        vector[h % dimensions] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(count))
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def overlap_score(query: str, document: str) -> float:
+    """Share of the query's distinct terms found in the document, favouring shorter documents slightly"""
+    query_terms = set(terms(query))
+    if not query_terms:
+        return 0.0
+    document_terms = terms(document)
+    hits = len(query_terms & set(document_terms))
+    return hits / len(query_terms) / (1.0 + len(document_terms) / 2000)
+
+
+def split_question(question: str) -> List[str]:
+    """Sub-questions a model might produce: the key terms asked about from a few angles"""
+    key = " ".join(terms(question)[:8]) or question
+    return [f"{key} value", f"{key} conditions", f"{key} specification table"]
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class Profile:
+    """Latency (log-normal: median seconds, sigma) and failure rate of one endpoint"""
+
+    def __init__(self, median: float, sigma: float, error_rate: float):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    @classmethod
+    def parse(cls, spec: str, error_rate: float) -> "Profile":
+        """Parse "MEDIAN[:SIGMA]" in seconds"""
+        median, _, sigma = spec.partition(":")
+        return cls(float(median), float(sigma or 0), error_rate)
+
+    def delay(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(rng.gauss(0, self.sigma)) if self.sigma > 0 else self.median
+
+    def fails(self, rng: random.Random) -> bool:
+        return self.error_rate > 0 and rng.random() < self.error_rate
+
+
+def create_app(args: argparse.Namespace):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+    rng = random.Random(args.seed)
+    profiles = {
+        "embeddings": Profile.parse(args.embeddings_latency, args.error_rate),
+        "chat": Profile.parse(args.chat_latency, args.error_rate),
+        "rerank": Profile.parse(args.rerank_latency, args.error_rate),
+    }
+    token_delay = Profile.parse(args.token_latency, 0.0)
+    stats = Counter()
+
+    async def simulate(endpoint: str, extra_delay: float = 0.0) -> Optional[JSONResponse]:
+        """Wait for the endpoint's latency; returns an error response if this call should fail"""
+        stats[f"{endpoint}_requests"] += 1
+        profile = profiles[endpoint]
+        await asyncio.sleep(profile.delay(rng) + extra_delay)
+        if profile.fails(rng):
+            stats[f"{endpoint}_errors"] += 1
+            return JSONResponse({"error": {"message": "Simulated provider error"}}, status_code=args.error_status)
+        return None
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        error = await simulate("embeddings")
+        if error is not None:
+            return error
+        inputs = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        dimensions = body.get("dimensions") or args.dimensions
+        stats["embedded_texts"] += len(inputs)
+        tokens = sum(count_tokens(text) for text in inputs)
+        return {
+            "object": "list",
+            "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": embed(text, dimensions)} for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        error = await simulate("chat")
+        if error is not None:
+            return error
+        messages = body["messages"]
+        prompt_tokens = sum(count_tokens(str(message.get("content") or "")) for message in messages)
+        if "Split the query" in str(messages[0].get("content")):
+            words = [repr(split_question(str(messages[-1]["content"])))]
+        else:
+            filler = random.Random(prompt_tokens)
+            words = [filler.choice(_FILLER) for _ in range(args.answer_tokens)]
+        completion_tokens = len(words)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+        if not body.get("stream"):
+            return {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        def event(choices: list, **extra) -> str:
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"], "choices": choices, **extra}
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def stream():
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(token_delay.delay(rng))
+                yield event([{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}])
+            yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if args.stream_usage or (body.get("stream_options") or {}).get("include_usage"):
+                yield event([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/rerank")
+    async def rerank(request: Request):
+        body = await request.json()
+        # Rerankers score every document, so their latency grows with the candidate count
+        error = await simulate("rerank", args.rerank_document_latency * len(body["documents"]))
+        if error is not None:
+            return error
+        query, documents = body["query"], body["documents"]
+        scores = sorted(((overlap_score(query, document), i) for i, document in enumerate(documents)), reverse=True)
+        top_n = int(body.get("top_n") or len(documents))
+        tokens = sum(count_tokens(query) + count_tokens(document) for document in documents)
+        return {
+            "id": "mock",
+            "results": [{"index": i, "relevance_score": round(score, 6)} for score, i in scores[:top_n]],
+            "meta": {"tokens": {"input_tokens": tokens, "output_tokens": 0}},
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def get_stats():
+        """Requests and simulated errors per endpoint since start (or the last reset)"""
+        return dict(stats)
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {}
+
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock provider for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9911)
+    parser.add_argument("--embeddings-latency", default="0.03:0.3", help="MEDIAN[:SIGMA] seconds, log-normal")
+    parser.add_argument("--chat-latency", default="0.3:0.4", help="MEDIAN[:SIGMA] seconds until the first token")
+    parser.add_argument("--token-latency", default="0.01", help="MEDIAN[:SIGMA] seconds between streamed tokens")
+    parser.add_argument("--rerank-latency", default="0.05:0.3", help="MEDIAN[:SIGMA] seconds")
+    parser.add_argument("--rerank-document-latency", type=float, default=0.002, help="Seconds added per reranked document")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability that a call fails")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of simulated failures")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="Length of generated answers")
+    parser.add_argument("--dimensions", type=int, default=2048, help="Embedding size when the request names none")
+    parser.add_argument("--stream-usage", action="store_true", help="Report usage in a last chunk of every stream")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def _free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class MockProvider:
+    """
+    Run the mock provider in a subprocess for the duration of a with block
+
+    A separate process keeps the server's work out of the measured process.
+    Options are the command line flags, e.g. MockProvider(["--error-rate", "0.01"]).
+    """
+
+    def __init__(self, options: Optional[List[str]] = None, host: str = "127.0.0.1"):
+        self.options = list(options or [])
+        self.host = host
+        self.port = _free_port(host)
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def _get(self, path: str, method: str = "GET") -> dict:
+        request = urllib.request.Request(f"http://{self.host}:{self.port}{path}", method=method)
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read())
+
+    def stats(self) -> dict:
+        return self._get("/stats")
+
+    def reset_stats(self):
+        self._get("/stats/reset", method="POST")
+
+    def __enter__(self) -> "MockProvider":
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--host", self.host, "--port", str(self.port), *self.options],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Mock provider exited with status {self.process.returncode}")
+            try:
+                self._get("/health")
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__(None, None, None)
+        raise RuntimeError("Mock provider did not start within 30s")
+
+    def __exit__(self, *exc_info):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+
+def main():
+    import uvicorn
+
+    args = build_parser().parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
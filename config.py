@@ -4,8 +4,8 @@ Manages all model settings, API configurations, and database settings.
 """
 
 import os
-from typing import Optional
-from dataclasses import dataclass
+from typing import Dict, Optional
+from dataclasses import dataclass, field
 from enum import Enum
 
 
@@ -24,15 +24,41 @@ class ModelConfig:
     dimensions: Optional[int] = None
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
+    # Price per million tokens in COST_CURRENCY, from the provider's price list (0 leaves cost untracked)
+    input_price: float = 0.0
+    output_price: float = 0.0
 
 
 @dataclass
 class DatabaseConfig:
     """Database configuration settings"""
-    path: str = "database/milvus_rag.db"
+    # A Milvus Lite file (one process only), or the URI of a Milvus server shared by several web workers
+    path: str = os.getenv("RAG_MILVUS_URI", "database/milvus_rag.db")
+    token: str = os.getenv("RAG_MILVUS_TOKEN", "")
     collection_name: str = "rag_docs"
     dimensions: int = 2048
     chunk_size_limit: int = 2000
+    chunk_token_limit: int = 512
+    chunk_overlap_tokens: int = 64
+    # Vector index of new collections (Milvus Lite always searches FLAT); maintenance resizes nlist to the row count
+    index_type: str = "IVF_FLAT"
+    index_nlist: int = 1024
+    search_nprobe: int = 128    # IVF clusters visited per search
+    registry_path: str = "database/documents.db"
+    answers_path: str = "database/answers.db"
+    images_path: str = "database/images.db"
+    sessions_path: str = "database/sessions.db"
+    jobs_path: str = "database/jobs.db"
+    usage_path: str = "database/usage.db"
+    external_text: bool = True    # New collections keep chunk text in the compressed side store instead of Milvus
+    text_store_path: str = "database/chunk_text.bin"
+    text_index_path: str = "database/chunk_text.db"
+    text_store_compression: int = 6
+    # Documents are spread over this many shards: separate Milvus Lite files, or collections on a Milvus server.
+    # Changing it moves documents to other shards, re-ingest them afterwards
+    shards: int = 1
+    shard_by: str = "hash"    # "hash" of the PDF name, or "family": longest matching prefix in shard_families
+    shard_families: Dict[str, int] = field(default_factory=dict)    # PDF name prefix -> shard index
 
 class Config:
     """Centralized configuration manager"""
@@ -43,6 +69,21 @@ class Config:
 
     # Marker Configuration
     MODEL_DIR = "/home/foggystar/Projects/RAG/models"
+    MARKER_POOL_SIZE = max(1, (os.cpu_count() or 1) // 4)  # Warm converter processes, 0 uses a marker_single subprocess per PDF
+    MARKER_POOL_MAX_RSS_MB = 6144    # Recycle a worker once its resident memory exceeds this
+    MARKER_POOL_MAX_JOBS = 0         # Recycle a worker after this many jobs, 0 for no limit
+    MARKER_PARALLEL_PROCESSES = max(1, (os.cpu_count() or 1) // 4)  # Concurrent marker_single runs without the pool
+    PARALLEL_CONVERT_MIN_PAGES = 100 # PDFs with at least this many pages are converted as parallel page ranges
+    MARKER_PAGES_PER_RANGE = 50
+
+    # Text-layer fast path ("auto": pdfminer text with per-page Marker fallback, "marker": every page through Marker)
+    CONVERT_MODE = "auto"
+    TEXT_LAYER_MIN_CHARS = 100          # Fewer extracted characters means no usable text layer
+    TEXT_LAYER_MAX_GARBLED_RATIO = 0.02 # Share of unmapped glyphs ("(cid:N)", U+FFFD) tolerated
+    TEXT_LAYER_MAX_RULINGS = 10         # More horizontal/vertical rules than this suggests a table
+    TEXT_LAYER_MAX_FIGURE_AREA = 0.15   # Share of the page covered by images and vector diagrams
+    TEXT_LAYER_MAX_DRAWINGS = 100       # More small vector strokes than this suggests a diagram
+    TEXT_LAYER_HEADING_SCALE = 1.2      # Font size relative to body text treated as a heading (PDFs without outline)
     
     # Model Configurations
     MODELS = {
@@ -76,6 +117,77 @@ class Config:
     RELEVANCE_THRESHOLD = 0.2
     DEFAULT_SEARCH_LIMIT = 15
     DEFAULT_RERANK_LIMIT = 5
+
+    # Batch Query Configuration
+    BATCH_MAX_QUESTIONS = 1000
+    BATCH_SPLIT_CONCURRENCY = 16     # Questions split at once
+    BATCH_RERANK_CONCURRENCY = 16    # Questions reranked at once
+    BATCH_GENERATE_CONCURRENCY = 4   # Answers generated at once
+
+    # Provider Resilience Configuration
+    HEDGE_ENABLED = True
+    HEDGE_PERCENTILE = 0.95      # Send a duplicate request once a call exceeds this latency percentile
+    HEDGE_MIN_DELAY = 0.2        # Seconds, lower bound of the hedge delay
+    HEDGE_MAX_DELAY = 5.0        # Seconds, upper bound (also used until enough samples are collected)
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_MAX_EXTRA = 1          # Maximum duplicate requests per call
+    HEDGE_BUDGET_RATIO = 0.1     # Maximum fraction of calls that may be hedged
+    LATENCY_WINDOW = 500         # Recent successful latencies kept per endpoint
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_RECOVERY_TIMEOUT = 30.0
+    RERANK_TIMEOUT = 60.0
+
+    # Ingestion Configuration
+    INGEST_WORKERS = 2           # PDFs processed concurrently in the background
+    INGEST_QUEUE_SIZE = 100      # Maximum jobs waiting for a worker
+    INGEST_JOB_HISTORY = 200     # Finished jobs kept for status polling
+    EMBED_BATCH_SIZE = 16        # Chunks per embedding request during ingestion
+    INSERT_BATCH_SIZE = 256      # Rows per Milvus insert during ingestion
+    INGEST_PIPELINE_QUEUE_SIZE = 4  # Batches buffered between pipeline stages
+    INGEST_POLL_INTERVAL = 1.0   # Seconds between checks for jobs submitted by other web workers
+
+    # Web Server Configuration
+    WEB_HOST = os.getenv("RAG_HOST", "127.0.0.1")
+    WEB_PORT = int(os.getenv("RAG_PORT", "8000"))
+    WEB_WORKERS = int(os.getenv("RAG_WEB_WORKERS", "1"))  # More than one needs a Milvus server (DATABASE.path)
+    SESSION_COOKIE = "rag_session"
+    SESSION_MAX_AGE = 30 * 24 * 3600  # Seconds an idle session's active PDF selection is kept
+
+    # Admission Control Configuration
+    ADMISSION_ENABLED = True
+    ADMISSION_MAX_QUERIES = 64       # Interactive queries in flight before new ones get 429
+    ADMISSION_MIN_RETRY_AFTER = 1    # Seconds, lower bound of the Retry-After header
+    ADMISSION_UPLOAD_RETRY_AFTER = 60  # Retry-After of uploads rejected because the ingestion queue is full
+    # Stage -> (concurrent calls, calls allowed to wait, longest wait in seconds for interactive work)
+    ADMISSION_STAGES = {
+        "split": (16, 64, 5.0),
+        "embed": (32, 256, 5.0),
+        "search": (8, 64, 5.0),
+        "rerank": (16, 64, 10.0),
+        "generate": (16, 64, 15.0),
+        "convert": (INGEST_WORKERS, INGEST_QUEUE_SIZE, None),
+    }
+
+    # Metrics Configuration
+    # Upper bounds (seconds) of the latency histogram buckets on /metrics; Marker conversion can take minutes
+    METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+    # Usage Accounting Configuration
+    COST_CURRENCY = "CNY"            # Currency of the model prices (ModelConfig.input_price / output_price)
+
+    # Collection Maintenance Configuration
+    MAINTENANCE_ENABLED = True       # Run maintenance automatically during quiet hours
+    MAINTENANCE_QUIET_HOURS = (2, 5) # Local hours [start, end) in which scheduled maintenance may run
+    MAINTENANCE_CHECK_INTERVAL = 900 # Seconds between scheduler checks
+    MAINTENANCE_MIN_CHURN = 0.2      # Rows inserted + deleted since the last index build, relative to its row count
+    MAINTENANCE_MIN_DEAD_TEXT = 0.3  # Share of the text store file no longer referenced
+    MAINTENANCE_PROBE_QUERIES = 20   # Searches timed before and after maintenance
+    MAINTENANCE_STATE_PATH = "database/maintenance.json"
+
+    # Image Asset Configuration
+    IMAGE_THUMBNAIL_SIZE = 640          # Longest side of pre-generated thumbnails shown in answers, in pixels
+    IMAGE_CACHE_MAX_AGE = 31536000      # Browser cache lifetime of versioned (?v=etag) image URLs
+    IMAGE_REVALIDATE_MAX_AGE = 3600     # Cache lifetime of unversioned image URLs before revalidating with the ETag
     
     @classmethod
     def get_api_key(cls) -> str:
@@ -0,0 +1,279 @@
+"""
+Bulk ingestion of whole directory trees of PDFs.
+
+Every finished document is appended to a JSONL checkpoint manifest, so an
+interrupted run (crash or Ctrl-C) picks up where it stopped: documents whose
+size and modification time still match a "done" entry are skipped.
+
+Usage:
+    python ingest.py /path/to/library [--workers 4] [--embed-workers 8] [--convert-workers 2]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from config import Config
+from rag_modules.get_database import PDF_NAME_MAX_LENGTH
+from utils.colored_logger import get_colored_logger
+from utils.progress import IngestCancelled, IngestProgress
+
+logger = get_colored_logger(__name__)
+
+DEFAULT_MANIFEST = "database/ingest_manifest.jsonl"
+
+# Stage -> (unit, items processed in it); embedding and inserting overlap in one pipeline stage
+_STAGE_ITEMS = {
+    "converting": ("pages", lambda progress: progress.pages_converted),
+    "chunking": ("chunks", lambda progress: progress.chunks_total + progress.chunks_unchanged),
+    "embedding": ("chunks", lambda progress: progress.chunks_embedded),
+}
+
+
+# Same safe characters as web uploads; other characters would break the pdf_name filters
+_UNSAFE_NAME = re.compile(r'[^a-zA-Z0-9._-]')
+
+
+def name_error(pdf_name: str) -> Optional[str]:
+    """Why a file name cannot be used as a PDF name, or None if it can"""
+    if not pdf_name or pdf_name.startswith("."):
+        return "file name is empty or starts with '.'"
+    if _UNSAFE_NAME.search(pdf_name):
+        return "file name may only contain letters, digits, '.', '_' and '-'"
+    if len(pdf_name) > PDF_NAME_MAX_LENGTH:
+        return f"file name is longer than {PDF_NAME_MAX_LENGTH} characters"
+    return None
+
+
+def find_pdfs(paths: List[str], pattern: str = ".pdf") -> Iterator[str]:
+    """Yield PDF files under the given files/directories in a stable order"""
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(pattern) and not name.startswith("."):
+                    yield os.path.abspath(os.path.join(root, name))
+
+
+class Manifest:
+    """Append-only JSONL checkpoint of processed documents; the last entry per path wins"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line after a crash
+                    self.entries[entry["path"]] = entry
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def is_done(self, pdf_path: str) -> bool:
+        entry = self.entries.get(pdf_path)
+        if entry is None or entry.get("status") != "done":
+            return False
+        stat = os.stat(pdf_path)
+        return entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime
+
+    def record(self, pdf_path: str, status: str, **details):
+        stat = os.stat(pdf_path)
+        entry = {
+            "path": pdf_path,
+            "status": status,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "finished_at": time.time(),
+            **details,
+        }
+        self.entries[pdf_path] = entry
+        # One line per document, flushed immediately so a crash loses at most the documents in flight
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+@dataclass
+class RunStats:
+    started: float = field(default_factory=time.time)
+    done: int = 0
+    failed: int = 0
+    skipped: int = 0
+    cancelled: int = 0
+    rows_inserted: int = 0
+    rows_deleted: int = 0
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    stage_docs: Dict[str, int] = field(default_factory=dict)
+    stage_items: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, progress: IngestProgress):
+        for stage, seconds in progress.to_dict()["stage_seconds"].items():
+            if stage not in _STAGE_ITEMS:
+                continue
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_docs[stage] = self.stage_docs.get(stage, 0) + 1
+            self.stage_items[stage] = self.stage_items.get(stage, 0) + _STAGE_ITEMS[stage][1](progress)
+        self.rows_inserted += progress.chunks_inserted
+        self.rows_deleted += progress.chunks_deleted
+
+    def summary(self) -> str:
+        wall = time.time() - self.started
+        lines = [
+            f"Documents: {self.done} done, {self.failed} failed, {self.skipped} skipped, "
+            f"{self.cancelled} interrupted in {wall:.1f}s",
+            f"Rows: {self.rows_inserted} inserted, {self.rows_deleted} deleted",
+            f"{'stage':<12} {'docs':>6} {'items':>14} {'busy s':>10} {'per doc/s':>10} {'overall/s':>10}",
+        ]
+        for stage, (unit, _) in _STAGE_ITEMS.items():
+            if stage not in self.stage_seconds:
+                continue
+            seconds = self.stage_seconds[stage]
+            items = self.stage_items[stage]
+            # "per doc" is the rate while a document is in the stage; "overall" spreads it over the run
+            per_doc = f"{items / seconds:.1f}" if seconds else "-"
+            overall = f"{items / wall:.1f}" if wall else "-"
+            lines.append(
+                f"{stage:<12} {self.stage_docs[stage]:>6} {f'{items} {unit}':>14} {seconds:>10.1f} "
+                f"{per_doc:>10} {overall:>10}"
+            )
+        return "\n".join(lines)
+
+
+async def ingest_paths(
+        pdf_paths: List[str],
+        manifest: Manifest,
+        workers: int,
+        output_dir: Optional[str] = None,
+        retry_failed: bool = True,
+        stats: Optional[RunStats] = None
+) -> RunStats:
+    """Ingest documents with up to `workers` of them in flight, checkpointing each one"""
+    from utils.pdf_manage import insert_pdf
+
+    stats = stats if stats is not None else RunStats()
+    pending: asyncio.Queue = asyncio.Queue()
+    seen_names: Dict[str, str] = {}
+    for pdf_path in pdf_paths:
+        pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        if pdf_name in seen_names:
+            # Documents are keyed by file name, a second file with the same name would replace the first
+            logger.warning(f"Skipping {pdf_path}: same name as {seen_names[pdf_name]}")
+            stats.skipped += 1
+            continue
+        seen_names[pdf_name] = pdf_path
+        if manifest.is_done(pdf_path):
+            stats.skipped += 1
+            continue
+        entry = manifest.entries.get(pdf_path)
+        if not retry_failed and entry is not None and entry.get("status") == "failed":
+            stats.skipped += 1
+            continue
+        error = name_error(pdf_name)
+        if error is not None:
+            # Rejected before conversion, rename the file and run again
+            logger.error(f"Failed to ingest {pdf_path}: {error}")
+            stats.failed += 1
+            manifest.record(pdf_path, "failed", error=error)
+            continue
+        pending.put_nowait(pdf_path)
+
+    total = pending.qsize()
+    logger.info(f"{total} documents to ingest, {stats.skipped} skipped")
+
+    async def worker():
+        while True:
+            try:
+                pdf_path = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            progress = IngestProgress()
+            started = time.time()
+            try:
+                success = await insert_pdf(pdf_path, progress=progress, output_dir=output_dir)
+                error = None if success else "Failed to process PDF"
+            except (asyncio.CancelledError, IngestCancelled):
+                # Not checkpointed: the next run starts this document again
+                progress.cancel()
+                stats.cancelled += 1
+                raise
+            except Exception as e:
+                success, error = False, f"{type(e).__name__}: {e}"
+
+            stats.add(progress)
+            if success:
+                stats.done += 1
+            else:
+                stats.failed += 1
+                logger.error(f"Failed to ingest {pdf_path}: {error}")
+            manifest.record(
+                pdf_path,
+                "done" if success else "failed",
+                error=error,
+                seconds=round(time.time() - started, 2),
+                progress=progress.to_dict(),
+            )
+            finished = stats.done + stats.failed
+            logger.info(f"[{finished}/{total}] {'done' if success else 'failed'}: {pdf_path}")
+
+    tasks = [asyncio.create_task(worker()) for _ in range(max(1, workers))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest directory trees of PDFs into the RAG database")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories to scan recursively")
+    parser.add_argument("--workers", type=int, default=Config.INGEST_WORKERS, help="Documents processed concurrently")
+    parser.add_argument("--convert-workers", type=int, help="Marker worker processes (default: MARKER_POOL_SIZE)")
+    parser.add_argument("--embed-workers", type=int, help="Concurrent embedding batches per document (default: MAX_CONCURRENT_WORKERS)")
+    parser.add_argument("--insert-batch", type=int, help="Rows per database insert (default: INSERT_BATCH_SIZE)")
+    parser.add_argument("--output-dir", help="Where converted Markdown is written (default: next to each PDF)")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="Checkpoint manifest (JSONL)")
+    parser.add_argument("--skip-failed", action="store_true", help="Do not retry documents that failed in an earlier run")
+    args = parser.parse_args()
+
+    if args.convert_workers is not None:
+        Config.MARKER_POOL_SIZE = args.convert_workers
+        Config.MARKER_PARALLEL_PROCESSES = max(1, args.convert_workers)
+    if args.embed_workers is not None:
+        Config.MAX_CONCURRENT_WORKERS = args.embed_workers
+    if args.insert_batch is not None:
+        Config.INSERT_BATCH_SIZE = args.insert_batch
+    # No interactive queries to protect here, --workers alone bounds the work
+    Config.ADMISSION_ENABLED = False
+
+    from utils.marker_pool import shutdown_marker_pool
+
+    manifest = Manifest(args.manifest)
+    pdf_paths = list(find_pdfs(args.paths))
+    stats = RunStats()
+    try:
+        asyncio.run(ingest_paths(
+            pdf_paths, manifest, args.workers,
+            output_dir=args.output_dir, retry_failed=not args.skip_failed, stats=stats
+        ))
+    except KeyboardInterrupt:
+        logger.warning(f"Interrupted, progress saved to {args.manifest}; run again to resume")
+    finally:
+        shutdown_marker_pool()
+        print(stats.summary())
+
+
+if __name__ == "__main__":
+    main()
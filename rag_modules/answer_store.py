@@ -0,0 +1,219 @@
+"""
+History of generated answers in SQLite (WAL mode), with full-text search.
+Replaces the Markdown files that used to be written to uploads/ and scanned
+on every listing: rows are appended in one short transaction, listing pages
+backwards by id, and query/answer text is indexed with an FTS5 trigram
+index so substring search also works for Chinese.
+
+Usage (import answers saved as Markdown files by earlier versions):
+    python -m rag_modules.answer_store import-files uploads
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from config import Config
+
+_SNIPPET_CHARS = 200
+_MAX_PAGE_SIZE = 200
+# Trigram tokens need at least three characters, shorter searches scan the table
+_MIN_FTS_CHARS = 3
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the store, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.answers_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.answers_path, timeout=30)
+    try:
+        _ensure_schema(conn)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _ensure_schema(conn: sqlite3.Connection):
+    # WAL lets readers list and search while an answer is being appended
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS answers ("
+        " id INTEGER PRIMARY KEY,"
+        " created_at REAL NOT NULL,"
+        " query TEXT NOT NULL,"
+        " answer TEXT NOT NULL,"
+        " used_pdfs TEXT NOT NULL);"
+        "CREATE INDEX IF NOT EXISTS answers_created_at ON answers (created_at);"
+        "CREATE TABLE IF NOT EXISTS answer_pdfs ("
+        " pdf_name TEXT NOT NULL,"
+        " answer_id INTEGER NOT NULL,"
+        " PRIMARY KEY (pdf_name, answer_id)) WITHOUT ROWID;"
+        "CREATE VIRTUAL TABLE IF NOT EXISTS answers_fts USING fts5("
+        " query, answer, content='answers', content_rowid='id', tokenize='trigram');"
+        "CREATE TRIGGER IF NOT EXISTS answers_ai AFTER INSERT ON answers BEGIN"
+        " INSERT INTO answers_fts (rowid, query, answer) VALUES (new.id, new.query, new.answer); END;"
+        "CREATE TRIGGER IF NOT EXISTS answers_ad AFTER DELETE ON answers BEGIN"
+        " INSERT INTO answers_fts (answers_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);"
+        " DELETE FROM answer_pdfs WHERE answer_id = old.id; END;"
+    )
+
+
+def add(query: str, answer: str, used_pdfs: List[str], created_at: Optional[float] = None) -> int:
+    """Append an answer; returns its id"""
+    with _connect() as conn:
+        cursor = conn.execute(
+            "INSERT INTO answers (created_at, query, answer, used_pdfs) VALUES (?, ?, ?, ?)",
+            (created_at or time.time(), query, answer, json.dumps(used_pdfs, ensure_ascii=False))
+        )
+        answer_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT OR IGNORE INTO answer_pdfs (pdf_name, answer_id) VALUES (?, ?)",
+            [(pdf_name, answer_id) for pdf_name in set(used_pdfs)]
+        )
+    return answer_id
+
+
+def get(answer_id: int) -> Optional[dict]:
+    """Full answer by id, or None"""
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT id, created_at, query, used_pdfs, length(answer), substr(answer, 1, {_SNIPPET_CHARS}), answer"
+            " FROM answers WHERE id = ?",
+            (answer_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    entry = _row_to_dict(row)
+    entry["answer"] = row[6]
+    return entry
+
+
+def delete(answer_id: int) -> bool:
+    with _connect() as conn:
+        return conn.execute("DELETE FROM answers WHERE id = ?", (answer_id,)).rowcount > 0
+
+
+def list_answers(
+        limit: int = 50,
+        before_id: Optional[int] = None,
+        pdf_name: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        search: Optional[str] = None
+) -> dict:
+    """
+    One page of answers, newest first
+
+    Pages are keyed by id (pass the returned next_before_id to get the next
+    page), so each page costs the same however deep it is.
+
+    Args:
+        limit: Page size
+        before_id: Only answers older than this id
+        pdf_name: Only answers that used this document
+        since, until: Creation time range (Unix seconds)
+        search: Text that must occur in the query or the answer
+
+    Returns:
+        dict: {"answers": [...], "next_before_id": id or None}
+    """
+    limit = max(1, min(limit, _MAX_PAGE_SIZE))
+    conditions, params = [], []
+    snippet = f"substr(a.answer, 1, {_SNIPPET_CHARS})"
+    source = "answers a"
+    key = "a.id"
+
+    if search and len(search) >= _MIN_FTS_CHARS:
+        source = "answers_fts f JOIN answers a ON a.id = f.rowid"
+        conditions.append("answers_fts MATCH ?")
+        params.append('"' + search.replace('"', '""') + '"')
+        snippet = "snippet(answers_fts, 1, '', '', '…', 24)"
+        # FTS5 walks matches in descending rowid itself, so LIMIT stops early instead of sorting every match
+        key = "f.rowid"
+    elif search:
+        conditions.append("(instr(a.query, ?) > 0 OR instr(a.answer, ?) > 0)")
+        params += [search, search]
+    if pdf_name:
+        conditions.append("a.id IN (SELECT answer_id FROM answer_pdfs WHERE pdf_name = ?)")
+        params.append(pdf_name)
+    if before_id is not None:
+        conditions.append(f"{key} < ?")
+        params.append(before_id)
+    if since is not None:
+        conditions.append("a.created_at >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("a.created_at < ?")
+        params.append(until)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with _connect() as conn:
+        rows = conn.execute(
+            f"SELECT a.id, a.created_at, a.query, a.used_pdfs, length(a.answer), {snippet}"
+            f" FROM {source} {where} ORDER BY {key} DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+
+    answers = [_row_to_dict(row) for row in rows[:limit]]
+    return {"answers": answers, "next_before_id": answers[-1]["id"] if len(rows) > limit else None}
+
+
+def count() -> int:
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+def _row_to_dict(row) -> dict:
+    return {
+        "id": row[0],
+        "created": datetime.fromtimestamp(row[1]).strftime("%Y-%m-%d %H:%M:%S"),
+        "created_at": row[1],
+        "query": row[2],
+        "used_pdfs": json.loads(row[3]),
+        "size": row[4],
+        "snippet": row[5],
+    }
+
+
+_MARKDOWN_ANSWER = re.compile(
+    r"^# Query Response - (?P<created>[\d\- :]+)\n\n## Query\n(?P<query>.*?)\n\n## Used PDFs\n(?P<pdfs>.*?)\n\n"
+    r"## Answer\n(?P<answer>.*)\n\n---\n\*Generated by RAG System\*\s*$",
+    re.DOTALL
+)
+
+
+def import_markdown_files(directory: str) -> int:
+    """Import answers saved as Markdown files by earlier versions; returns how many were imported"""
+    imported = 0
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".md"):
+            continue
+        with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+            match = _MARKDOWN_ANSWER.match(f.read())
+        if match is None:
+            continue
+        created_at = datetime.strptime(match["created"].strip(), "%Y-%m-%d %H:%M:%S").timestamp()
+        used_pdfs = [name.strip() for name in match["pdfs"].split(",") if name.strip()]
+        add(match["query"], match["answer"], used_pdfs, created_at)
+        imported += 1
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the answer history store")
+    parser.add_argument("command", choices=["import-files"])
+    parser.add_argument("directory", help="Directory with Markdown answer files")
+    args = parser.parse_args()
+    print(f"Imported {import_markdown_files(args.directory)} answers into {Config.DATABASE.answers_path}")
+
+
+if __name__ == "__main__":
+    main()
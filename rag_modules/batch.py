@@ -0,0 +1,144 @@
+"""
+Batch querying: answer many questions against the same PDFs while sharing
+pipeline work between them.
+
+All questions are split concurrently, every distinct sub-query is embedded
+in a few batched embedding requests, each shard is searched once with all
+query vectors, and then every question is reranked concurrently and answered
+with bounded parallelism. Results are yielded as each question finishes.
+
+Usage (one question per line, results as JSON lines in input order):
+    python -m rag_modules.batch questions.txt --pdf NAME [--pdf NAME ...] [--output results.jsonl]
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List
+
+from config import Config
+from rag_modules import query, refer
+from rag_modules.embedding import get_embedding_batch_async
+from rag_modules.search import search_vectors_async
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+
+def _sub_queries(question: str, split: str) -> List[str]:
+    """The question followed by its sub-questions; just the question if the split output is not a list"""
+    try:
+        parsed = ast.literal_eval(split)
+    except (ValueError, SyntaxError):
+        parsed = None
+    if not isinstance(parsed, list):
+        logger.warning(f"Could not parse the split of '{question}', using it unsplit")
+        parsed = []
+    return [question] + [str(sub_query) for sub_query in parsed]
+
+
+async def _split_all(questions: List[str]) -> List[List[str]]:
+    semaphore = asyncio.Semaphore(Config.BATCH_SPLIT_CONCURRENCY)
+
+    async def split(question: str) -> List[str]:
+        async with semaphore:
+            try:
+                response = await query.split_query_async(question)
+            except Exception as e:
+                # One failed split (overload, open circuit, provider error) must not abort the whole batch
+                logger.warning(f"Could not split '{question}', using it unsplit: {e}")
+                return [question]
+            return _sub_queries(question, response)
+
+    return await asyncio.gather(*[split(question) for question in questions])
+
+
+async def _embed_all(texts: List[str]) -> Dict[str, List[float]]:
+    """Embed the distinct texts in batched requests of EMBED_BATCH_SIZE"""
+    unique = list(dict.fromkeys(texts))
+    batches = [unique[start:start + Config.EMBED_BATCH_SIZE] for start in range(0, len(unique), Config.EMBED_BATCH_SIZE)]
+    vectors = await asyncio.gather(*[get_embedding_batch_async(batch) for batch in batches])
+    return {text: vector for batch, batch_vectors in zip(batches, vectors) for text, vector in zip(batch, batch_vectors)}
+
+
+async def query_batch_async(questions: List[str], included_pdfs: List[str]) -> AsyncIterator[dict]:
+    """
+    Answer many questions against the same PDFs, yielding each result as soon as it is ready
+
+    Yields:
+        dict: {"index", "question", "sub_queries", "answer", "references", "seconds", "error"},
+        index being the question's position in the input
+    """
+    if not questions:
+        return
+    started = time.time()
+    sub_queries = await _split_all(questions)
+    flat = [sub_query for group in sub_queries for sub_query in group]
+    logger.info(f"Batch of {len(questions)} questions split into {len(flat)} sub-queries")
+
+    # Questions often share sub-queries, each distinct one is embedded and searched once
+    vectors = await _embed_all(flat)
+    hits = dict(zip(vectors, await search_vectors_async(list(vectors.values()), included_pdfs)))
+
+    rerank_semaphore = asyncio.Semaphore(Config.BATCH_RERANK_CONCURRENCY)
+    generate_semaphore = asyncio.Semaphore(Config.BATCH_GENERATE_CONCURRENCY)
+
+    async def answer(index: int) -> dict:
+        group = sub_queries[index]
+        result = {"index": index, "question": questions[index], "sub_queries": group, "answer": None, "references": 0, "error": None}
+        try:
+            async with rerank_semaphore:
+                references = await refer.rerank_hits(group, [hits[sub_query] for sub_query in group])
+            result["references"] = len(references)
+            async with generate_semaphore:
+                result["answer"] = await query.generate_answer_async(group, references)
+        except Exception as e:
+            logger.error(f"Batch question {index} failed: {e}")
+            result["error"] = str(e)
+        result["seconds"] = round(time.time() - started, 2)
+        return result
+
+    tasks = [asyncio.create_task(answer(index)) for index in range(len(questions))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The consumer stopped early (e.g. the client disconnected), drop the remaining questions
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info(f"Batch of {len(questions)} questions answered in {time.time() - started:.1f}s")
+
+
+async def _collect(questions: List[str], included_pdfs: List[str]) -> List[dict]:
+    results = [result async for result in query_batch_async(questions, included_pdfs)]
+    return sorted(results, key=lambda result: result["index"])
+
+
+def query_batch(questions: List[str], included_pdfs: List[str]) -> List[dict]:
+    """Sync version of query_batch_async; returns the results in input order"""
+    return asyncio.run(_collect(questions, included_pdfs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions (one per line) against the given PDFs")
+    parser.add_argument("questions", help="Text file with one question per line")
+    parser.add_argument("--pdf", action="append", dest="pdf_names", required=True, help="PDF to query (repeatable)")
+    parser.add_argument("--output", help="JSON lines file for the results (default: stdout)")
+    args = parser.parse_args()
+
+    with open(args.questions, 'r', encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+    results = query_batch(questions, args.pdf_names)
+    lines = [json.dumps(result, ensure_ascii=False) for result in results]
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
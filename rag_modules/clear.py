@@ -1,23 +1,27 @@
-from pymilvus import MilvusClient
-
-from config import Config
+from rag_modules import doc_registry, get_database, text_store
+from utils import image_assets, session_store
 from utils.colored_logger import get_colored_logger
 
 logger = get_colored_logger(__name__)
 
 def clear_database():
-    """清除Milvus集合中的数据"""
-    
-    # 创建Milvus客户端
-    client = MilvusClient(Config.DATABASE.path)
-    
-    # 检查集合是否存在
-    if not client.has_collection(collection_name=Config.DATABASE.collection_name):
-        logger.warning(f"集合 {Config.DATABASE.collection_name} 不存在，无法清除数据")
-        return
+    """清除所有分片中Milvus集合的数据"""
     
-    # 清除集合中的所有数据
-    client.drop_collection(collection_name=Config.DATABASE.collection_name)    
-    logger.info(f"集合 {Config.DATABASE.collection_name} 中的数据已被清除")
+    for shard in get_database.shards():
+        # 创建Milvus客户端
+        client = get_database.connect(shard)
+        
+        # 检查集合是否存在
+        if not client.has_collection(collection_name=shard.collection_name):
+            logger.warning(f"集合 {shard.collection_name} ({shard.uri}) 不存在，无法清除数据")
+            continue
+        
+        # 清除集合中的所有数据
+        client.drop_collection(collection_name=shard.collection_name)    
+        text_store.clear(shard)
+        logger.info(f"集合 {shard.collection_name} ({shard.uri}) 中的数据已被清除")
 
-    
\ No newline at end of file
+    get_database.forget_schema()
+    doc_registry.clear()
+    image_assets.clear()
+    session_store.clear()
@@ -0,0 +1,113 @@
+"""
+Registry of ingested documents keyed by PDF name, with the SHA-256 of the PDF bytes.
+Used to skip re-ingesting identical files and to recognise revised uploads.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from config import Config
+
+_READ_SIZE = 1024 * 1024
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the registry, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.registry_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.registry_path, timeout=30)
+    try:
+        _ensure_schema(conn)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _ensure_schema(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS documents ("
+        " pdf_name TEXT PRIMARY KEY,"
+        " sha256 TEXT NOT NULL,"
+        " filename TEXT,"
+        " size INTEGER,"
+        " updated_at REAL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS documents_sha256 ON documents (sha256)")
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 hex digest of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_with_sha256(src: BinaryIO, dst: BinaryIO) -> Tuple[str, int]:
+    """Copy a stream while hashing it; returns (sha256 hex digest, size in bytes)"""
+    digest = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: src.read(_READ_SIZE), b''):
+        digest.update(block)
+        dst.write(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+
+def get(pdf_name: str) -> Optional[dict]:
+    """Registry entry for a PDF name, or None"""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT pdf_name, sha256, filename, size, updated_at FROM documents WHERE pdf_name = ?",
+            (pdf_name,)
+        ).fetchone()
+    return _row_to_dict(row)
+
+
+def find_by_hash(sha256: str) -> Optional[dict]:
+    """Registry entry of a document with exactly these bytes, or None"""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT pdf_name, sha256, filename, size, updated_at FROM documents WHERE sha256 = ?",
+            (sha256,)
+        ).fetchone()
+    return _row_to_dict(row)
+
+
+def record(pdf_name: str, sha256: str, filename: Optional[str] = None, size: Optional[int] = None):
+    """Insert or update the registry entry for a PDF"""
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO documents (pdf_name, sha256, filename, size, updated_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(pdf_name) DO UPDATE SET sha256 = excluded.sha256, filename = excluded.filename,"
+            " size = excluded.size, updated_at = excluded.updated_at",
+            (pdf_name, sha256, filename, size, time.time())
+        )
+
+
+def remove(pdf_name: str):
+    with _connect() as conn:
+        conn.execute("DELETE FROM documents WHERE pdf_name = ?", (pdf_name,))
+
+
+def clear():
+    with _connect() as conn:
+        conn.execute("DELETE FROM documents")
+
+
+def _row_to_dict(row) -> Optional[dict]:
+    if row is None:
+        return None
+    return {
+        "pdf_name": row[0],
+        "sha256": row[1],
+        "filename": row[2],
+        "size": row[3],
+        "updated_at": row[4],
+    }
@@ -4,9 +4,14 @@ import time
 
 from api_client import EmbeddingClient
 from config import Config
+from utils import admission, metrics
 from utils.colored_logger import get_colored_logger
+from utils.singleflight import SingleFlight
 logger = get_colored_logger(__name__)
 
+# 相同文本的并发embedding请求共享一次API调用
+_embedding_flight = SingleFlight("embedding")
+
 
 async def get_embedding_async(
     text: List[str]
@@ -18,8 +23,14 @@ async def get_embedding_async(
         start_time = time.time()
         
         logger.info(f"Embedding text with length {len(text_item)}")
+
+        async def embed_one():
+            with metrics.timed("rag_stage", stage="embed", model=client.model_config.name):
+                async with admission.stage("embed"):
+                    return await client.create_embedding_async(text_item)
+
         try:
-            result = await client.create_embedding_async(text_item)
+            result = await _embedding_flight.do((client.model_config.name, text_item), embed_one)
             duration = time.time() - start_time
             logger.info(f"[{index + 1}] {duration:.2f}s ")
             return result
@@ -48,6 +59,23 @@ async def get_embedding_async(
     return await create_embeddings_async()
 
 
+async def get_embedding_batch_async(
+    text: List[str]
+) -> List[List[float]]:
+    """Embed a batch of texts with a single API request"""
+    client = EmbeddingClient(Config.get_api_key())
+    start_time = time.time()
+    try:
+        with metrics.timed("rag_stage", stage="embed", model=client.model_config.name):
+            async with admission.stage("embed"):
+                results = await client.create_embeddings_async(text)
+    except Exception as e:
+        logger.error(f"[batch of {len(text)}] ✗ {time.time() - start_time:.2f}s | 错误: {str(e)}")
+        raise
+    logger.info(f"[batch of {len(text)}] {time.time() - start_time:.2f}s")
+    return results
+
+
 def get_embedding(
     text: List[str]
 ) -> List[List[float]]:
@@ -1,48 +1,185 @@
+import os
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
 from pymilvus import MilvusClient, DataType
 
 from config import Config
+from utils import metrics
 from utils.colored_logger import get_colored_logger
 
 logger = get_colored_logger(__name__)
 
-def get_database_client() -> MilvusClient:
-    
-    client = MilvusClient(uri=Config.DATABASE.path)
-    index_params = MilvusClient.prepare_index_params()
+# Longest PDF name the pdf_name field holds
+PDF_NAME_MAX_LENGTH = 100
+
+
+def _shard_path(path: str, index: int) -> str:
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_shard{index}{ext}"
+
+
+@dataclass(frozen=True)
+class Shard:
+    """One partition of the corpus: a Milvus Lite file, or a collection on a Milvus server"""
+    index: int
+    uri: str
+    collection_name: str
+
+    def local_path(self, path: str) -> str:
+        """Per-shard variant of a local file path; the first shard keeps the unsharded name"""
+        return _shard_path(path, self.index)
+
+
+def shards() -> List[Shard]:
+    """All configured shards"""
+    path, name = Config.DATABASE.path, Config.DATABASE.collection_name
+    if "://" in path:
+        # A Milvus server already scales across cores, shards are collections on it
+        return [Shard(index, path, _shard_path(name, index)) for index in range(max(1, Config.DATABASE.shards))]
+    # Separate Milvus Lite files run in separate server processes
+    return [Shard(index, _shard_path(path, index), name) for index in range(max(1, Config.DATABASE.shards))]
+
+
+def shard_for(pdf_name: str) -> Shard:
+    """Shard that holds a document, by product family prefix or by a stable hash of its name"""
+    all_shards = shards()
+    if Config.DATABASE.shard_by == "family":
+        prefixes = [prefix for prefix in Config.DATABASE.shard_families if pdf_name.startswith(prefix)]
+        if prefixes:
+            return all_shards[Config.DATABASE.shard_families[max(prefixes, key=len)] % len(all_shards)]
+    return all_shards[zlib.crc32(pdf_name.encode('utf-8')) % len(all_shards)]
+
+
+def group_by_shard(pdf_names: Iterable[str]) -> Dict[Shard, List[str]]:
+    """Documents grouped by the shard holding them, so a search only visits those shards"""
+    groups: Dict[Shard, List[str]] = {}
+    for pdf_name in pdf_names:
+        groups.setdefault(shard_for(pdf_name), []).append(pdf_name)
+    return groups
+
+
+def connect(shard: Optional[Shard] = None) -> MilvusClient:
+    """Client for a shard's Milvus Lite file or server, without creating its collection"""
+    shard = shard or shards()[0]
+    return MilvusClient(uri=shard.uri, token=Config.DATABASE.token)
+
+
+def get_database_client(shard: Optional[Shard] = None) -> MilvusClient:
+    shard = shard or shards()[0]
+    client = connect(shard)
 
     # Check if collection exists, create with metadata if it doesn't
-    if not client.has_collection(collection_name=Config.DATABASE.collection_name):
-        logger.info(f"Collection '{Config.DATABASE.collection_name}' does not exist, creating new collection...")
+    if not client.has_collection(collection_name=shard.collection_name):
+        logger.info(f"Collection '{shard.collection_name}' in {shard.uri} does not exist, creating new collection...")
 
         schema = MilvusClient.create_schema()
 
         schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True, auto_id=True)
         schema.add_field(field_name="vector", datatype=DataType.FLOAT_VECTOR, dim=Config.DATABASE.dimensions)
-        schema.add_field(field_name="text_content", datatype=DataType.VARCHAR, max_length=Config.DATABASE.chunk_size_limit+100)
-        schema.add_field(field_name="pdf_name", datatype=DataType.VARCHAR, max_length=100)
+        if not Config.DATABASE.external_text:
+            schema.add_field(field_name="text_content", datatype=DataType.VARCHAR, max_length=Config.DATABASE.chunk_size_limit+100)
+        schema.add_field(field_name="pdf_name", datatype=DataType.VARCHAR, max_length=PDF_NAME_MAX_LENGTH)
         schema.add_field(field_name="page_number", datatype=DataType.INT16)
+        schema.add_field(field_name="chunk_hash", datatype=DataType.VARCHAR, max_length=64)
 
-        client.create_collection(collection_name=Config.DATABASE.collection_name, schema=schema)
+        client.create_collection(collection_name=shard.collection_name, schema=schema)
 
         logger.info("Creating vector index...")
-        index_params.add_index(
-            field_name="vector", # Name of the vector field to be indexed
-            index_type="IVF_FLAT", # Type of the index to create
-            index_name="vector", # Name of the index to create
-            metric_type="COSINE", # Metric type used to measure similarity
-            params={
-                "nlist": 1024, # Number of clusters for the index
-                "nprobe": 128, # Number of clusters to search
-            } # Index building params
-        )
-
         client.create_index(
-            collection_name=Config.DATABASE.collection_name,
-            index_params=index_params
+            collection_name=shard.collection_name,
+            index_params=vector_index_params()
         )
 
-        
-
-        logger.info(f"Collection '{Config.DATABASE.collection_name}' created successfully")
+        logger.info(f"Collection '{shard.collection_name}' created successfully")
     
-    return client
\ No newline at end of file
+    return client
+
+
+def vector_index_params(nlist: Optional[int] = None):
+    """Index parameters of the vector field"""
+    index_params = MilvusClient.prepare_index_params()
+    index_params.add_index(
+        field_name="vector", # Name of the vector field to be indexed
+        index_type=Config.DATABASE.index_type, # Type of the index to create
+        index_name="vector", # Name of the index to create
+        metric_type="COSINE", # Metric type used to measure similarity
+        params={
+            "nlist": nlist or Config.DATABASE.index_nlist, # Number of clusters for the index
+            "nprobe": Config.DATABASE.search_nprobe, # Number of clusters to search
+        } # Index building params
+    )
+    return index_params
+
+
+def has_field(client: MilvusClient, field_name: str, shard: Optional[Shard] = None) -> bool:
+    """Whether the collection schema has a field (older collections lack newer fields)"""
+    shard = shard or shards()[0]
+    description = client.describe_collection(collection_name=shard.collection_name)
+    return any(field.get("name") == field_name for field in description.get("fields", []))
+
+
+# Shard -> (schema generation the fact was read at, text stored inline)
+_inline_text: Dict[Shard, Tuple[int, bool]] = {}
+
+
+def _schema_generation_path() -> str:
+    return os.path.join(os.path.dirname(Config.DATABASE.registry_path) or ".", "schema_generation")
+
+
+def _schema_generation() -> int:
+    """Changes whenever any process drops or recreates the collections (modification time of a marker file)"""
+    try:
+        return os.stat(_schema_generation_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def stores_text_inline(client: MilvusClient, shard: Optional[Shard] = None) -> bool:
+    """Whether chunk text lives in the collection's text_content field rather than the text store (cached)"""
+    shard = shard or shards()[0]
+    generation = _schema_generation()
+    cached = _inline_text.get(shard)
+    hit = cached is not None and cached[0] == generation
+    metrics.cache_lookup("schema", hit)
+    if not hit:
+        cached = _inline_text[shard] = (generation, has_field(client, "text_content", shard))
+    return cached[1]
+
+
+def forget_schema():
+    """Drop cached schema facts in every process, after the collections were dropped or recreated"""
+    _inline_text.clear()
+    path = _schema_generation_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+
+def iter_rows(
+    client: MilvusClient,
+    filter: str,
+    output_fields: List[str],
+    batch_size: int = 1000,
+    shard: Optional[Shard] = None
+) -> Iterator[Dict[str, Any]]:
+    """Iterate over every row matching a filter, without the query result size limit"""
+    shard = shard or shards()[0]
+    iterator = client.query_iterator(
+        collection_name=shard.collection_name,
+        batch_size=batch_size,
+        filter=filter,
+        output_fields=output_fields
+    )
+    try:
+        while True:
+            batch = iterator.next()
+            if not batch:
+                return
+            yield from batch
+    finally:
+        iterator.close()
@@ -1,50 +1,225 @@
-from typing import List, Dict, Any
+import asyncio
+import hashlib
+import itertools
+import time
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Set
+
+from pymilvus import MilvusClient
 
 from config import Config
-from rag_modules.embedding import get_embedding_async
-from rag_modules.get_database import get_database_client
+from rag_modules.embedding import get_embedding_batch_async
+from rag_modules import text_store
+from rag_modules.get_database import Shard, get_database_client, has_field, iter_rows, shard_for, stores_text_inline
+from utils import metrics
 from utils.colored_logger import get_colored_logger
+from utils.progress import IngestCancelled, IngestProgress
 
 logger = get_colored_logger(__name__)
 
 
+def chunk_hash(text: str, page_id: int) -> str:
+    """Content hash identifying a chunk within a document"""
+    return hashlib.sha256(f"{page_id}\x00{text}".encode('utf-8')).hexdigest()
+
+
+def _existing_chunks(client: MilvusClient, shard: Shard, pdf_name: str, incremental: bool) -> Dict[str, List[int]]:
+    """Map chunk hash -> row ids already stored for a PDF (hash is "" for legacy rows)"""
+    output_fields = ["id", "chunk_hash"] if incremental else ["id"]
+    existing: Dict[str, List[int]] = {}
+    for row in iter_rows(client, f'pdf_name == "{pdf_name}"', output_fields, shard=shard):
+        existing.setdefault(row.get("chunk_hash", ""), []).append(row["id"])
+    return existing
+
+
+def _without_text(existing: Dict[str, List[int]], shard: Shard) -> List[int]:
+    """
+    Remove rows whose text never reached the text store from existing and return their ids
+
+    An insert interrupted between the Milvus insert and the text write leaves
+    such rows; their chunks count as changed, so a retry stores them again.
+    """
+    stored = text_store.stored_ids([row_id for ids in existing.values() for row_id in ids], shard)
+    orphans = []
+    for h in list(existing):
+        kept = [row_id for row_id in existing[h] if row_id in stored]
+        orphans.extend(row_id for row_id in existing[h] if row_id not in stored)
+        if kept:
+            existing[h] = kept
+        else:
+            del existing[h]
+    return orphans
+
+
+def _take(items: Iterator[Dict[str, Any]], count: int) -> List[Dict[str, Any]]:
+    """Next count chunks of items (fewer at the end)"""
+    return list(itertools.islice(items, count))
+
+
+def _stale_ids(existing: Dict[str, List[int]], wanted: Set[str], incremental: bool) -> List[int]:
+    """Row ids to delete once every chunk of the new version is stored"""
+    if not incremental:
+        # Collection predates chunk hashes: replace the document wholesale
+        return [row_id for ids in existing.values() for row_id in ids]
+
+    stale_ids = []
+    for h, ids in existing.items():
+        # Drop chunks no longer in the document, and duplicate rows of a kept chunk
+        stale_ids.extend(ids if h not in wanted else ids[1:])
+    return stale_ids
+
+
 async def insert_data(
-    data : List[Dict[str, Any]],
+    data : Iterable[Dict[str, Any]],
     pdf_name: str,
+    progress: Optional[IngestProgress] = None,
 ) -> bool:
-    
-    # titled_text = [("Title: " + data[i]['metadata']['title'] + "Content: " + data[i]['content']) for i in range(len(data))]
-    titled_text = [("Content: " + data[i]['content']) for i in range(len(data))]
+    """
+    Embed and insert a document's chunks as a pipeline.
 
-    page_id = [data[i]['metadata']['page_id'] for i in range(len(data))]
-    try:
-        client = get_database_client()
+    Chunks flow through bounded queues: they are pulled from data in a worker
+    thread (chunking a memory-mapped file is CPU work), batches of EMBED_BATCH_SIZE are
+    embedded by MAX_CONCURRENT_WORKERS concurrent workers, and embedded rows
+    are inserted in groups of INSERT_BATCH_SIZE as soon as they are ready. Memory
+    stays flat regardless of document size and rows become searchable while
+    later batches are still being embedded. Chunks already stored with the
+    same content hash (and their stored text) are skipped; stale rows are deleted at the end. The
+    document goes to the shard chosen by get_database.shard_for.
 
-        logger.info(f"Generating embedding vectors for {len(data)} texts")
-        embeddings = await get_embedding_async(titled_text)
-        logger.info(f"Embedding vector generation completed")
-        
+    Args:
+        data: Chunks with 'content' and 'metadata' ({'title', 'page_id'}); may be a generator
+        pdf_name: Name of the PDF the chunks belong to
+        progress: Optional progress tracker, also used for cancellation
+
+    Returns:
+        bool: True if every chunk was stored
+    """
+    try:
+        shard = shard_for(pdf_name)
+        client = await asyncio.to_thread(get_database_client, shard)
+        incremental = await asyncio.to_thread(has_field, client, "chunk_hash", shard)
+        inline_text = await asyncio.to_thread(stores_text_inline, client, shard)
+        existing = await asyncio.to_thread(_existing_chunks, client, shard, pdf_name, incremental)
+        orphan_ids = [] if inline_text else await asyncio.to_thread(_without_text, existing, shard)
     except Exception as e:
-        logger.error(f"Failed to embed data: {e}")
+        logger.error(f"Failed to read existing chunks: {e}")
         return False
-    
+
+    if progress is None:
+        progress = IngestProgress()
+    progress.set_stage("embedding")
+
+    embed_queue: asyncio.Queue = asyncio.Queue(maxsize=Config.INGEST_PIPELINE_QUEUE_SIZE)
+    insert_queue: asyncio.Queue = asyncio.Queue(maxsize=Config.INGEST_PIPELINE_QUEUE_SIZE)
+    wanted: Set[str] = set()
+    embed_workers = max(1, Config.MAX_CONCURRENT_WORKERS)
+
+    async def produce():
+        items = iter(data)
+        chunk_seconds = 0.0
+        batch = []
+        while True:
+            started = time.perf_counter()
+            pulled = await asyncio.to_thread(_take, items, Config.EMBED_BATCH_SIZE)
+            chunk_seconds += time.perf_counter() - started
+            if not pulled:
+                break
+            for item in pulled:
+                # titled_text = "Title: " + item['metadata']['title'] + "Content: " + item['content']
+                text = "Content: " + item['content']
+                page_id = item['metadata']['page_id']
+                h = chunk_hash(text, page_id)
+                # 只嵌入和插入新增的chunk
+                if h in wanted or (incremental and h in existing):
+                    if h in existing:
+                        progress.chunks_unchanged += 1
+                    wanted.add(h)
+                    continue
+                wanted.add(h)
+                progress.chunks_total += 1
+                batch.append((text, page_id, h))
+                if len(batch) >= Config.EMBED_BATCH_SIZE:
+                    await embed_queue.put(batch)
+                    batch = []
+        metrics.observe("rag_stage_seconds", chunk_seconds, stage="chunk", model="", outcome="ok")
+        if batch:
+            await embed_queue.put(batch)
+        for _ in range(embed_workers):
+            await embed_queue.put(None)
+
+    async def embed():
+        while True:
+            batch = await embed_queue.get()
+            if batch is None:
+                await insert_queue.put(None)
+                return
+            progress.check_cancelled()
+            vectors = await get_embedding_batch_async([text for text, _, _ in batch])
+            progress.chunks_embedded += len(batch)
+            rows = []
+            for (text, page_id, h), vector in zip(batch, vectors):
+                row = {
+                    "vector": vector,
+                    "text_content": text,
+                    "pdf_name": pdf_name,
+                    "page_number": page_id,
+                }
+                if incremental:
+                    row["chunk_hash"] = h
+                rows.append(row)
+            await insert_queue.put(rows)
+
+    async def store():
+        pending = []
+        finished_workers = 0
+        while finished_workers < embed_workers:
+            rows = await insert_queue.get()
+            if rows is None:
+                finished_workers += 1
+            else:
+                pending.extend(rows)
+            while len(pending) >= Config.INSERT_BATCH_SIZE or (pending and finished_workers == embed_workers):
+                group, pending = pending[:Config.INSERT_BATCH_SIZE], pending[Config.INSERT_BATCH_SIZE:]
+                progress.check_cancelled()
+                texts = None if inline_text else [row.pop("text_content") for row in group]
+                with metrics.timed("rag_stage", stage="insert", model=""):
+                    result = await asyncio.to_thread(client.insert, collection_name=shard.collection_name, data=group)
+                    if texts is not None:
+                        await asyncio.to_thread(text_store.put_many, list(result["ids"]), texts, shard)
+                progress.chunks_inserted += len(group)
+                logger.info(f"Inserted {progress.chunks_inserted}/{progress.chunks_total} records for '{pdf_name}'")
+
+    start_time = time.time()
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(produce())
+            for _ in range(embed_workers):
+                group.create_task(embed())
+            group.create_task(store())
+    except BaseExceptionGroup as eg:
+        error = eg.exceptions[0]
+        if isinstance(error, IngestCancelled):
+            raise error
+        # Rows already inserted keep their chunk hash, so a retry only processes the remainder
+        logger.error(f"Failed to embed and insert data: {error}")
+        return False
+    # Unchanged chunks keep their stored embeddings instead of being embedded again
+    metrics.cache_lookup("chunk", True, progress.chunks_unchanged)
+    metrics.cache_lookup("chunk", False, progress.chunks_total)
+
     try:
-        insert_data = [
-            {
-                "vector": embeddings[i],
-                "text_content": titled_text[i],
-                "pdf_name": pdf_name,
-                "page_number": page_id[i],
-            }
-            for i in range(len(data))
-        ]
-        # Execute insertion operation
-        logger.info(f"Inserting {len(data)} records into collection '{Config.DATABASE.collection_name}'...")
-        client.insert(collection_name=Config.DATABASE.collection_name, data=insert_data)
-        
-        logger.info(f"Data insertion completed, inserted {len(data)} records")
-        return True
-        
+        # New chunks are in place before stale ones disappear, so search never sees a gap
+        stale_ids = _stale_ids(existing, wanted, incremental) + orphan_ids
+        if stale_ids:
+            progress.set_stage("inserting")
+            await asyncio.to_thread(client.delete, collection_name=shard.collection_name, ids=stale_ids)
+            await asyncio.to_thread(text_store.delete_many, stale_ids, shard)
+            progress.chunks_deleted = len(stale_ids)
     except Exception as e:
-        logger.error(f"Failed to insert data: {e}")
-        return False
\ No newline at end of file
+        logger.error(f"Failed to delete stale chunks: {e}")
+        return False
+
+    logger.info(
+        f"Data insertion completed for '{pdf_name}' in {time.time() - start_time:.2f}s: "
+        f"{progress.chunks_inserted} inserted, {progress.chunks_unchanged} unchanged, {progress.chunks_deleted} deleted"
+    )
+    return True
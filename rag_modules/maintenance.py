@@ -0,0 +1,350 @@
+"""
+Collection maintenance after deletes and re-ingests.
+Flushes and compacts the collection, rebuilds the IVF index with a cluster
+count fitted to the current row count, and compacts the chunk text store.
+Runs on demand (CLI or admin endpoint) or from a scheduler during quiet hours
+once enough rows have changed since the last index build; each shard is
+checked and maintained on its own.
+
+Usage:
+    python -m rag_modules.maintenance [--force] [--check] [--shard N]
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import math
+import os
+import random
+import struct
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from pymilvus import MilvusClient
+
+from config import Config
+from rag_modules import text_store
+from rag_modules.get_database import Shard, get_database_client, iter_rows, shards, vector_index_params
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+_COMPACTION_TIMEOUT = 600
+_IDLE_POLL_SECONDS = 0.2
+
+
+def _lock_path(suffix: str) -> str:
+    path = Config.MAINTENANCE_STATE_PATH + suffix
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+# struct flock (64-bit off_t): l_type, l_whence, l_start, l_len, l_pid
+_FLOCK = struct.Struct("hhqqi4x")
+
+
+def _lock_request(fd: int, command: int, lock_type: int) -> int:
+    """Issue an open file description lock command over the whole file; returns the resulting l_type"""
+    return _FLOCK.unpack(fcntl.fcntl(fd, command, _FLOCK.pack(lock_type, os.SEEK_SET, 0, 0, 0)))[0]
+
+
+@contextmanager
+def _exclusive(suffix: str, wait: bool = False) -> Iterator[bool]:
+    """
+    Take an exclusive lock file, waiting for it or not; yields whether it was taken
+
+    Open file description locks are visible to every process on the host (and
+    to other open files in this one) and vanish with the process holding them,
+    so a crashed run never leaves searches waiting or maintenance blocked.
+    Unlike flock, they can be probed without taking a lock (see _is_held), so
+    probes from searches never make the owner's attempt fail.
+    """
+    with open(_lock_path(suffix), 'a') as f:
+        try:
+            _lock_request(f.fileno(), fcntl.F_OFD_SETLKW if wait else fcntl.F_OFD_SETLK, fcntl.F_WRLCK)
+        except (BlockingIOError, PermissionError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            _lock_request(f.fileno(), fcntl.F_OFD_SETLK, fcntl.F_UNLCK)
+
+
+def _is_held(suffix: str) -> bool:
+    """Whether some process (or another open file in this one) holds the lock file; takes no lock itself"""
+    with open(_lock_path(suffix), 'a') as f:
+        return _lock_request(f.fileno(), fcntl.F_OFD_GETLK, fcntl.F_WRLCK) != fcntl.F_UNLCK
+
+
+def is_idle() -> bool:
+    """Whether no index rebuild is in progress, in any process"""
+    return not _is_held(".rebuilding")
+
+
+def wait_idle(timeout: Optional[float] = None) -> bool:
+    """Block until no index rebuild is in progress"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not is_idle():
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(_IDLE_POLL_SECONDS)
+    return True
+
+
+def is_running() -> bool:
+    """Whether maintenance is running, in any process"""
+    return _is_held(".lock")
+
+
+def _load_state(shard: Shard) -> dict:
+    try:
+        with open(shard.local_path(Config.MAINTENANCE_STATE_PATH), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_state(shard: Shard, state: dict):
+    path = shard.local_path(Config.MAINTENANCE_STATE_PATH)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _count(client: MilvusClient, shard: Shard, filter: str = "") -> int:
+    result = client.query(collection_name=shard.collection_name, filter=filter, output_fields=["count(*)"])
+    return int(result[0]["count(*)"]) if result else 0
+
+
+def _max_id(client: MilvusClient, shard: Shard) -> int:
+    return max((row["id"] for row in iter_rows(client, "id >= 0", ["id"], shard=shard)), default=-1)
+
+
+def ideal_nlist(rows: int) -> int:
+    """IVF cluster count for a row count (about 4 * sqrt(rows), within Milvus limits)"""
+    return max(16, min(65536, int(4 * math.sqrt(max(rows, 1)))))
+
+
+def database_size_bytes(shard: Shard) -> int:
+    path = shard.uri
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files
+    ) if os.path.isdir(path) else 0
+
+
+def probe_latency(client: MilvusClient, shard: Shard, queries: int = Config.MAINTENANCE_PROBE_QUERIES) -> dict:
+    """Time searches with random query vectors; returns p50/p95 in milliseconds"""
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(queries):
+        vector = [rng.uniform(-1, 1) for _ in range(Config.DATABASE.dimensions)]
+        start = time.perf_counter()
+        client.search(
+            collection_name=shard.collection_name,
+            data=[vector],
+            limit=Config.DEFAULT_SEARCH_LIMIT,
+            output_fields=["pdf_name"]
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    if not latencies:
+        return {"queries": 0}
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(latencies[len(latencies) // 2], 2),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+    }
+
+
+def collection_report(client: MilvusClient, shard: Shard) -> dict:
+    """Row count, on-disk size, index parameters, text store usage and search latency"""
+    try:
+        index = client.describe_index(collection_name=shard.collection_name, index_name="vector")
+    except Exception as e:
+        index = {"error": str(e)}
+    return {
+        "rows": _count(client, shard),
+        "database_bytes": database_size_bytes(shard),
+        "index": {key: index.get(key) for key in ("index_type", "nlist", "indexed_rows", "error") if key in index},
+        "text_store": text_store.stats(shard),
+        "latency": probe_latency(client, shard),
+    }
+
+
+def check(client: Optional[MilvusClient] = None, shard: Optional[Shard] = None) -> Tuple[bool, str, dict]:
+    """
+    Whether maintenance is due
+
+    Churn is measured with auto ids, which only grow: rows with an id above the
+    last build's maximum were inserted since, missing rows at or below it were deleted.
+
+    Returns:
+        (needed, reason, details)
+    """
+    shard = shard or shards()[0]
+    client = client or get_database_client(shard)
+    state = _load_state(shard)
+    rows = _count(client, shard)
+    store = text_store.stats(shard)
+    dead_text = 1 - store["live_bytes"] / store["file_bytes"] if store["file_bytes"] else 0.0
+    details = {"shard": shard.index, "rows": rows, "dead_text_ratio": round(dead_text, 3), "last_run": state.get("last_run")}
+
+    if "max_id" not in state:
+        needed = rows > 0
+        return needed, "no index build recorded" if needed else "collection is empty", details
+
+    kept = _count(client, shard, f"id <= {state['max_id']}")
+    inserted = _count(client, shard, f"id > {state['max_id']}")
+    deleted = state["rows"] - kept
+    churn = (inserted + deleted) / max(state["rows"], 1)
+    details.update({"inserted": inserted, "deleted": deleted, "churn": round(churn, 3)})
+
+    if churn >= Config.MAINTENANCE_MIN_CHURN:
+        return True, f"{inserted} rows inserted and {deleted} deleted since the last index build", details
+    if dead_text >= Config.MAINTENANCE_MIN_DEAD_TEXT:
+        return True, f"{dead_text:.0%} of the text store is unreferenced", details
+    return False, "collection changed too little since the last index build", details
+
+
+def _compact_collection(client: MilvusClient, shard: Shard):
+    name = shard.collection_name
+    client.flush(collection_name=name)
+    if "://" not in shard.uri:
+        # Milvus Lite (a local file) does not implement compaction; the index rebuild still drops deleted rows
+        return
+    try:
+        job_id = client.compact(collection_name=name)
+    except Exception as e:
+        logger.warning(f"Compaction failed: {e}")
+        return
+    deadline = time.time() + _COMPACTION_TIMEOUT
+    while client.get_compaction_state(job_id) != "Completed" and time.time() < deadline:
+        time.sleep(1)
+
+
+def _rebuild_index(client: MilvusClient, shard: Shard, rows: int):
+    name = shard.collection_name
+    nlist = ideal_nlist(rows)
+    logger.info(f"Rebuilding vector index of '{name}' with nlist={nlist} for {rows} rows")
+    # Held while the index is rebuilt, searches in every web worker wait for it
+    with _exclusive(".rebuilding", wait=True):
+        client.release_collection(collection_name=name)
+        client.drop_index(collection_name=name, index_name="vector")
+        client.create_index(collection_name=name, index_params=vector_index_params(nlist))
+        client.load_collection(collection_name=name)
+
+
+def run_maintenance(force: bool = False, shard: Optional[Shard] = None) -> dict:
+    """
+    Compact, rebuild the index and compact the text store of one shard if due (or forced)
+
+    Returns:
+        dict: before/after reports, or the reason nothing was done
+    """
+    shard = shard or shards()[0]
+    # One maintenance run at a time across all web workers and CLI invocations
+    with _exclusive(".lock") as acquired:
+        if not acquired:
+            return {"status": "already_running", "shard": shard.index}
+        client = get_database_client(shard)
+        needed, reason, details = check(client, shard)
+        if not needed and not force:
+            return {"status": "skipped", "shard": shard.index, "reason": reason, "details": details}
+
+        logger.info(f"Starting maintenance of shard {shard.index}: {reason if needed else 'forced'}")
+        started = time.time()
+        before = collection_report(client, shard)
+        _compact_collection(client, shard)
+        rows = _count(client, shard)
+        _rebuild_index(client, shard, rows)
+        text = text_store.compact(shard)
+        after = collection_report(client, shard)
+
+        result = {
+            "status": "completed",
+            "shard": shard.index,
+            "reason": reason if needed else "forced",
+            "seconds": round(time.time() - started, 2),
+            "before": before,
+            "after": after,
+            "text_store": text,
+        }
+        _save_state(shard, {"rows": rows, "max_id": _max_id(client, shard), "last_run": time.time(), "last_result": result})
+        logger.info(
+            f"Maintenance completed in {result['seconds']}s: "
+            f"{before['database_bytes']} -> {after['database_bytes']} bytes, "
+            f"p95 {before['latency'].get('p95_ms')} -> {after['latency'].get('p95_ms')} ms"
+        )
+        return result
+
+
+def run_all(force: bool = False) -> List[dict]:
+    """run_maintenance for every shard in turn"""
+    return [run_maintenance(force, shard) for shard in shards()]
+
+
+def check_all() -> List[dict]:
+    """check() for every shard, with the shard's last result"""
+    reports = []
+    for shard in shards():
+        needed, reason, details = check(shard=shard)
+        reports.append({
+            "shard": shard.index,
+            "needed": needed,
+            "reason": reason,
+            "details": details,
+            "last_result": _load_state(shard).get("last_result"),
+        })
+    return reports
+
+
+def in_quiet_hours(now: Optional[datetime] = None) -> bool:
+    """Whether the local time falls into MAINTENANCE_QUIET_HOURS (which may wrap past midnight)"""
+    start, end = Config.MAINTENANCE_QUIET_HOURS
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+async def scheduler(is_busy: Callable[[], bool] = lambda: False):
+    """Periodically run due maintenance during quiet hours while nothing is being ingested"""
+    while True:
+        await asyncio.sleep(Config.MAINTENANCE_CHECK_INTERVAL)
+        if not in_quiet_hours() or is_busy() or is_running():
+            continue
+        try:
+            for result in await asyncio.to_thread(run_all):
+                if result["status"] == "skipped":
+                    logger.debug(f"Scheduled maintenance of shard {result['shard']} skipped: {result['reason']}")
+        except Exception as e:
+            logger.error(f"Scheduled maintenance failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the collection and rebuild its vector index")
+    parser.add_argument("--force", action="store_true", help="Run even if too little has changed")
+    parser.add_argument("--check", action="store_true", help="Only report whether maintenance is due")
+    parser.add_argument("--shard", type=int, help="Only this shard (default: all)")
+    args = parser.parse_args()
+
+    selected = shards() if args.shard is None else [shards()[args.shard]]
+    if args.check:
+        reports = []
+        for shard in selected:
+            needed, reason, details = check(shard=shard)
+            reports.append({"needed": needed, "reason": reason, "details": details})
+        print(json.dumps(reports, indent=4))
+        return
+    print(json.dumps([run_maintenance(args.force, shard) for shard in selected], indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,41 @@ from typing import List
 from api_client import ChatClient
 from config import ModelType
 from rag_modules import refer
+from utils import admission, metrics
 from utils.colored_logger import get_colored_logger
 logger = get_colored_logger(__name__)
 
+def _split_messages(query: str) -> List[dict]:
+    return [
+        {
+            "role": "system", 
+            "content": "Split the query into 3-4 sub-questions. Output only the questions, with python list format."
+        },
+        {"role": "user", "content": query}
+    ]
+
+
+def _answer_messages(
+    questions: List[str],
+    reference: List[str],
+    language: str,
+    streaming: bool
+) -> List[dict]:
+    user_prompt = f"Questions: {questions}\n References: {reference}\n"
+    answer_language = "Chinese" if language.lower() == "chinese" else "English"
+
+    # Set system prompt based on language
+    if streaming:
+        system_prompt = f"You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use {answer_language} to answer. You need to use markdown format to answer, if you need to use pictures in the reference, copy the image link to the answer as a markdown link format, because the image file will be put besides your response, do not modify any thing about the link, JUST COPY THE LINK AND MAKE IT TO BE MARKDOWN."
+    else:
+        system_prompt = f"""You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use {answer_language} to answer. You need to use markdown format to answer, if you need to use pictures in the reference, in your markdown, write the image link as {{pdf_name}}/{{original_image_link}}, STRICTLY FOLLOW THIS FORMAT"""
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
 def split_query(
     query: str
 ) -> List[str]:
@@ -21,14 +53,7 @@ def split_query(
     logger.info(f"Splitting query: {query}")
     try:
         client = ChatClient(model_type=ModelType.SPLIT)
-        
-        messages = [
-            {
-                "role": "system", 
-                "content": "Split the query into 3-4 sub-questions. Output only the questions, with python list format."
-            },
-            {"role": "user", "content": query}
-        ]
+        messages = _split_messages(query)
     
         content = client.create_completion(messages)
  
@@ -56,19 +81,7 @@ def generate_answer(
     """
     try:
         client = ChatClient(model_type=ModelType.CHAT)
-        
-        user_prompt = f"Questions: {questions}\n References: {reference}\n"
-        
-        # Set system prompt based on language
-        if language.lower() == "chinese":
-            system_prompt = """You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use Chinese to answer. You need to use markdown format to answer, if you need to use pictures in the reference, in your markdown, write the image link as {pdf_name}/{original_image_link}, STRICTLY FOLLOW THIS FORMAT"""
-        else:
-            system_prompt = """You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use English to answer. You need to use markdown format to answer, if you need to use pictures in the reference, in your markdown, write the image link as {pdf_name}/{original_image_link}, STRICTLY FOLLOW THIS FORMAT"""
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages = _answer_messages(questions, reference, language, streaming=False)
 
         logger.info("Starting answer generation...")
         content = client.create_completion(messages)
@@ -96,19 +109,7 @@ def generate_answer_stream(
     """
     try:
         client = ChatClient(model_type=ModelType.CHAT)
-        
-        user_prompt = f"Questions: {questions}\n References: {reference}\n"
-        
-        # Set system prompt based on language
-        if language.lower() == "chinese":
-            system_prompt = "You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use Chinese to answer. You need to use markdown format to answer, if you need to use pictures in the reference, copy the image link to the answer as a markdown link format, because the image file will be put besides your response, do not modify any thing about the link, JUST COPY THE LINK AND MAKE IT TO BE MARKDOWN."
-        else:
-            system_prompt = "You are a helpful assistant that answers questions in detail, based on the provided context. Provide page numbers of the context in your answer. You need to answer as detailed as possible and be consistant with the given context. Use English to answer. You need to use markdown format to answer, if you need to use pictures in the reference, copy the image link to the answer as a markdown link format, because the image file will be put besides your response, do not modify any thing about the link, JUST COPY THE LINK AND MAKE IT TO BE MARKDOWN."
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages = _answer_messages(questions, reference, language, streaming=True)
 
         logger.info("Starting streaming answer generation...")
         chunk_count = 0
@@ -123,13 +124,75 @@ def generate_answer_stream(
         yield "Failed to generate answer due to an error."
 
 
+async def split_query_async(
+    query: str
+) -> List[str]:
+    """
+    Async version of split_query, does not block the event loop
+    
+    Args:
+        query: The query to split
+        
+    Returns:
+        List of sub-questions
+    """
+    logger.info(f"Splitting query: {query}")
+    client = ChatClient(model_type=ModelType.SPLIT)
+    with metrics.timed("rag_stage", stage="split", model=client.model_config.name) as timer:
+        try:
+            async with admission.stage("split"):
+                return await client.create_completion_async(_split_messages(query))
+
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to split query: {e}")
+            timer.outcome = "error"
+            return query
+
+
+async def generate_answer_async(
+    questions: List[str],
+    reference: List[str],
+    language: str = "chinese"
+) -> str:
+    """
+    Async version of generate_answer, does not block the event loop
+    
+    Args:
+        questions: List of questions to answer
+        reference: List of reference documents
+        language: Language for the response ("chinese" or "english")
+        
+    Returns:
+        Generated answer
+    """
+    client = ChatClient(model_type=ModelType.CHAT)
+    with metrics.timed("rag_stage", stage="generate", model=client.model_config.name) as timer:
+        try:
+            with metrics.timed("rag_stage", stage="prompt_build", model=client.model_config.name):
+                messages = _answer_messages(questions, reference, language, streaming=False)
+
+            logger.info("Starting answer generation...")
+            async with admission.stage("generate"):
+                content = await client.create_completion_async(messages)
+            return content if content else "No answer generated."
+
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to generate answer: {e}")
+            timer.outcome = "error"
+            return "Failed to generate answer due to an error."
+
+
 async def generate_answer_stream_async(
     questions: List[str],
     reference: List[str],
     language: str = "chinese"
 ):
     """
-    Async version of generate_answer_stream for better async compatibility
+    Async version of generate_answer_stream, chunks are yielded as they arrive
     
     Args:
         questions: List of questions to answer
@@ -139,27 +202,31 @@ async def generate_answer_stream_async(
     Yields:
         Chunks of generated answer text
     """
-    import asyncio
-    
-    # Run the sync streaming function in an executor to avoid blocking
-    loop = asyncio.get_event_loop()
-    
-    def sync_generator():
-        for chunk in generate_answer_stream(questions, reference, language):
-            yield chunk
-    
-    # Use a thread executor to run the sync generator
-    import concurrent.futures
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(lambda: list(sync_generator()))
-        
-        # Poll for completion without blocking
-        while not future.done():
-            await asyncio.sleep(0.01)
-        
-        result = future.result()
-        for chunk in result:
-            yield chunk
+    client = ChatClient(model_type=ModelType.CHAT)
+    model = client.model_config.name
+    with metrics.timed("rag_stage", stage="generate", model=model) as timer:
+        try:
+            with metrics.timed("rag_stage", stage="prompt_build", model=model):
+                messages = _answer_messages(questions, reference, language, streaming=True)
+
+            logger.info("Starting streaming answer generation...")
+            chunk_count = 0
+            # The slot is held until the whole answer has been streamed
+            async with admission.stage("generate"):
+                async for chunk in client.create_completion_stream_async(messages):
+                    if chunk:
+                        chunk_count += 1
+                        if chunk_count == 1:
+                            metrics.observe("rag_stage_seconds", timer.elapsed, stage="first_token", model=model, outcome="ok")
+                        logger.debug(f"Generated chunk {chunk_count}: {chunk[:30]}...")
+                        yield chunk
+
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to generate streaming answer: {e}")
+            timer.outcome = "error"
+            yield "Failed to generate answer due to an error."
 
 if __name__ == "__main__":
     # Example usage
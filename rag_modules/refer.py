@@ -1,7 +1,10 @@
+import asyncio
 from typing import List, Dict, Any
 
 from config import Config
-from rag_modules import reranker, search
+from rag_modules import reranker, search, text_store
+from rag_modules.get_database import shard_for
+from utils import admission
 from utils.colored_logger import get_colored_logger, logging
 
 logger = get_colored_logger(__name__,level=logging.INFO)
@@ -9,7 +12,8 @@ logger = get_colored_logger(__name__,level=logging.INFO)
 
 async def get_reference(
         split_query: List[str],
-        included_pdfs: List[str]
+        included_pdfs: List[str],
+        rerank: bool = True
 ) -> List[Dict[str, Any]]:
     
     try:
@@ -17,34 +21,101 @@ async def get_reference(
                 query=split_query,
                 included_pdfs=included_pdfs
         )
+    except admission.Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Search operation failed: {e}")
         return []
+    return await rerank_hits(split_query, search_results, rerank)
+
+
+async def rerank_hits(
+        split_query: List[str],
+        search_results: List[List[Any]],
+        rerank: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Deduplicate the search hits of a question's sub-queries, load their texts and rerank them concurrently
 
+    Without rerank, each sub-query keeps its first DEFAULT_RERANK_LIMIT hits in similarity order.
+    """
     all_docs = []
     # de_duplicator = set()  # 用于去重
     pre_de_duplicator = set()
+    query_hits = []  # (query index, hits)
     for i,result in enumerate(search_results):
         logger.info(f"Searching for Query {i+1}: {split_query[i]}")
-        reranked_index = []
-        contents = []
+        hits = []
         for hit in result:
-            if hit.id in pre_de_duplicator:
+            # 不同分片的行ID可能重复，按(PDF, ID)去重
+            key = (hit.entity.get('pdf_name'), hit.id)
+            if key in pre_de_duplicator:
                 logger.info(f"Pre Skipping duplicate document ID: {hit.id}")
                 continue
-            pre_de_duplicator.add(hit.id)
-            contents.append(hit.entity.get('text_content'))  # 获取文本内容，避免KeyError
+            pre_de_duplicator.add(key)
+            hits.append(hit)
+        query_hits.append((i, hits))
+
+    if not rerank:
+        query_hits = [(i, hits[:int(Config.DEFAULT_RERANK_LIMIT)]) for i, hits in query_hits]
+
+    # 文本不在向量库中时，只为进入rerank的候选批量读取文本（按分片分组）
+    missing = {}
+    for _, hits in query_hits:
+        for hit in hits:
+            if hit.entity.get('text_content') is None:
+                missing.setdefault(shard_for(hit.entity.get('pdf_name')), []).append(hit.id)
+    stored_texts = {}
+    try:
+        fetched = await asyncio.gather(*[
+            asyncio.to_thread(text_store.get_many, ids, shard) for shard, ids in missing.items()
+        ])
+        for shard, texts in zip(missing, fetched):
+            stored_texts.update({(shard, row_id): text for row_id, text in texts.items()})
+    except Exception as e:
+        logger.error(f"Failed to read chunk texts: {e}")
+
+    candidates = []  # (query index, hits, contents)
+    for i, hits in query_hits:
+        kept_hits = []
+        contents = []
+        for hit in hits:
+            text = hit.entity.get('text_content')  # 获取文本内容，避免KeyError
+            if text is None:
+                text = stored_texts.get((shard_for(hit.entity.get('pdf_name')), hit.id))
+                if text is None:
+                    logger.warning(f"No text stored for document ID: {hit.id}")
+                    continue
+                hit.entity['entity']['text_content'] = text
+            kept_hits.append(hit)
+            contents.append(text)
         # contents = [hit.entity.get('text_content') for hit in result]
         if not contents:
             logger.warning(f"No contents found for query {i+1}. Skipping reranking.")
             continue
+        candidates.append((i, kept_hits, contents))
+
+    if not rerank:
+        return [hit.entity['entity'] for _, hits, _ in candidates for hit in hits]
+
+    # 并发rerank，避免单个慢请求串行阻塞其余子问题
+    reranked = await asyncio.gather(*[
+        reranker.get_rerank_async(query=str(split_query[i]), documents=contents, top_n=int(Config.DEFAULT_RERANK_LIMIT))
+        for i, _, contents in candidates
+    ], return_exceptions=True)
+
+    for reranked_index in reranked:
+        # Shedding load rejects the whole query rather than answering it with fewer references
+        if isinstance(reranked_index, admission.Overloaded):
+            raise reranked_index
 
-        reranked_index = reranker.get_rerank(query=str(split_query[i]), documents=contents, top_n=int(Config.DEFAULT_RERANK_LIMIT))
-        
+    for (i, hits, _), reranked_index in zip(candidates, reranked):
         logger.info(f"Reranking for query {i+1}\n")
         try:
+            if isinstance(reranked_index, BaseException):
+                raise reranked_index
             for order in reranked_index['results']:
-                hit = result[order['index']]
+                hit = hits[order['index']]
                 all_docs.append(hit.entity['entity'])
         except Exception as e:
             logger.error(f"Reranking failed for query {i+1}: {e}")
@@ -56,5 +127,4 @@ def get_reference_sync(
         included_pdfs: List[str]
 ) -> List[Dict[str, Any]]:
     """Synchronous version for backward compatibility"""
-    import asyncio
     return asyncio.run(get_reference(split_query, included_pdfs))
\ No newline at end of file
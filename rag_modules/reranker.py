@@ -1,6 +1,11 @@
 from typing import List, Dict, Any
 from config import Config
 from api_client import RerankClient
+from utils import admission, metrics
+from utils.singleflight import SingleFlight
+
+# 相同query和文档集合的并发rerank请求共享一次API调用
+_rerank_flight = SingleFlight("rerank")
 
 def get_rerank(
     query: str,
@@ -8,4 +13,21 @@ def get_rerank(
     top_n: int = Config.DEFAULT_SEARCH_LIMIT / 2,
 ) -> List[Dict[str, Any]]:
     client = RerankClient()
-    return client.rerank(query, documents, top_n)
\ No newline at end of file
+    return client.rerank(query, documents, top_n)
+
+
+async def get_rerank_async(
+    query: str,
+    documents: List[str],
+    top_n: int = Config.DEFAULT_SEARCH_LIMIT / 2,
+) -> List[Dict[str, Any]]:
+    """Async version, coalescing identical in-flight requests"""
+    client = RerankClient()
+    key = (query, tuple(documents), top_n)
+
+    async def rerank():
+        with metrics.timed("rag_stage", stage="rerank", model=client.model_config.name):
+            async with admission.stage("rerank"):
+                return await client.rerank_async(query, documents, top_n)
+
+    return await _rerank_flight.do(key, rerank)
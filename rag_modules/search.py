@@ -1,51 +1,96 @@
+import asyncio
+import heapq
+from itertools import chain
 from typing import List, Dict, Any
 
 from config import Config
+from rag_modules import maintenance
 from rag_modules.embedding import get_embedding_async
-from rag_modules.get_database import get_database_client
+from rag_modules.get_database import Shard, get_database_client, group_by_shard, stores_text_inline
+from utils import admission, metrics
 from utils.colored_logger import get_colored_logger
 
 logger = get_colored_logger(__name__)
 
 
+def _search_shard(shard: Shard, query_vectors: List[List[float]], pdf_names: List[str]) -> List[List[Any]]:
+    """Search one shard for the documents it holds"""
+    client = get_database_client(shard)
+    search_params = {
+        "collection_name": shard.collection_name,
+        "data": query_vectors,
+        "limit": Config.DEFAULT_SEARCH_LIMIT,
+        "filter": f"pdf_name in {pdf_names}",
+        "output_fields": ["pdf_name", "page_number"],
+        "search_params": {"params": {"nprobe": Config.DATABASE.search_nprobe}}
+    }
+    # Text kept in the side store is fetched later, only for rerank candidates
+    if stores_text_inline(client, shard):
+        search_params["output_fields"].append("text_content")
+    return client.search(**search_params)
+
+
+def merge_results(shard_results: List[List[List[Any]]], limit: int) -> List[List[Any]]:
+    """Per query, the top `limit` hits over all shards by similarity (COSINE: higher is closer)"""
+    if len(shard_results) == 1:
+        return shard_results[0]
+    return [
+        heapq.nlargest(limit, chain.from_iterable(hits), key=lambda hit: hit["distance"])
+        for hits in zip(*shard_results)
+    ]
+
+
 async def search_async(
     query: List[str],
     included_pdfs : List[str]
 ) -> List[Dict[str, Any]]:
-    """Async version for use with FastAPI"""
+    """
+    Async version for use with FastAPI
+
+    The query fans out in parallel to the shards holding the included PDFs
+    and the hits of each sub-query are merged back into one top-k list.
+    """
 
     try:
         # 获取查询向量
         query_vectors = await get_embedding_async(query)
-        # 创建Milvus客户端
-        client = get_database_client()
-        
-        
-        logger.info(f"Searching in collection {Config.DATABASE.collection_name} with {len(query)} queries")
-
-        # 执行搜索 - 使用 Milvus 原生过滤
-        search_params = {
-            "collection_name": Config.DATABASE.collection_name,
-            "data": query_vectors,
-            "limit": Config.DEFAULT_SEARCH_LIMIT,
-            "filter": f"pdf_name in {included_pdfs}",
-            "output_fields": ["pdf_name", "page_number", "text_content"]
-        }
-        
-        results = client.search(**search_params)
-        
-        logger.info(f"Search completed, found {len(results)} result groups")
-        return results
+        return await search_vectors_async(query_vectors, included_pdfs)
         
+    except admission.Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Search failed: {e}")
         raise Exception(f"Search operation failed: {e}")
 
 
+async def search_vectors_async(
+    query_vectors: List[List[float]],
+    included_pdfs: List[str]
+) -> List[List[Any]]:
+    """Search already embedded queries, one multi-vector search per shard; results are in query order"""
+    # 索引重建期间集合未加载，等待维护完成
+    if not maintenance.is_idle():
+        await asyncio.to_thread(maintenance.wait_idle)
+
+    groups = group_by_shard(included_pdfs)
+    logger.info(f"Searching {len(groups)} shard(s) with {len(query_vectors)} queries")
+
+    # 执行搜索 - 使用 Milvus 原生过滤，各分片并行（数据库调用放到线程中，避免阻塞事件循环）
+    with metrics.timed("rag_stage", stage="search", model=""):
+        async with admission.stage("search"):
+            shard_results = await asyncio.gather(*[
+                asyncio.to_thread(_search_shard, shard, query_vectors, pdf_names)
+                for shard, pdf_names in groups.items()
+            ])
+    results = merge_results(shard_results, Config.DEFAULT_SEARCH_LIMIT) if shard_results else [[] for _ in query_vectors]
+    
+    logger.info(f"Search completed, found {len(results)} result groups")
+    return results
+
+
 def search(
     query: List[str],
     included_pdfs : List[str]
 ) -> List[Dict[str, Any]]:
     """Sync wrapper for backward compatibility"""
-    import asyncio
     return asyncio.run(search_async(query, included_pdfs))
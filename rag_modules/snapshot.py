@@ -0,0 +1,247 @@
+"""
+Snapshot export and import of the vector database.
+A snapshot is a directory of column files with the rows of each document
+stored contiguously:
+
+    manifest.json       format version, vector dimensions, per-document row range and registry entry
+    vectors.f32         raw little-endian float32, rows x dimensions
+    page_number.i16     raw int16 per row
+    chunk_hash.s64      64 ASCII bytes per row
+    text.bin            zlib-compressed chunk text, concatenated
+    text_offsets.u64    rows + 1 offsets into text.bin
+
+Import reads the columns through memory maps and bulk-inserts them into the
+shard each document belongs to, so a host is rebuilt without Marker or any
+embedding calls; selected documents can be restored on their own.
+
+Usage:
+    python -m rag_modules.snapshot export DIR [--pdf NAME ...]
+    python -m rag_modules.snapshot import DIR [--pdf NAME ...]
+"""
+
+import argparse
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import Config
+from rag_modules import doc_registry, text_store
+from rag_modules.get_database import (
+    Shard, get_database_client, group_by_shard, has_field, iter_rows, shards,
+    stores_text_inline
+)
+from rag_modules.insert import chunk_hash
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+FORMAT_VERSION = 1
+_HASH_BYTES = 64
+
+
+def _list_documents(shard: Shard) -> List[str]:
+    client = get_database_client(shard)
+    return sorted({row["pdf_name"] for row in iter_rows(client, "id >= 0", ["pdf_name"], shard=shard)})
+
+
+def _export_document(shard: Shard, pdf_name: str) -> List[dict]:
+    """Rows of one document with their text, ordered by page"""
+    client = get_database_client(shard)
+    inline = stores_text_inline(client, shard)
+    fields = ["id", "vector", "page_number"]
+    if has_field(client, "chunk_hash", shard):
+        fields.append("chunk_hash")
+    if inline:
+        fields.append("text_content")
+    rows = list(iter_rows(client, f'pdf_name == "{pdf_name}"', fields, shard=shard))
+    if not inline:
+        texts = text_store.get_many([row["id"] for row in rows], shard)
+        for row in rows:
+            row["text_content"] = texts.get(row["id"])
+    missing = [row["id"] for row in rows if row["text_content"] is None]
+    if missing:
+        logger.warning(f"Skipping {len(missing)} rows of '{pdf_name}' without stored text")
+    return sorted((row for row in rows if row["text_content"] is not None), key=lambda row: (row["page_number"], row["id"]))
+
+
+def export_snapshot(output_dir: str, pdf_names: Optional[List[str]] = None) -> dict:
+    """
+    Write every document (or only the given ones) to a snapshot directory
+
+    Returns:
+        dict: the snapshot manifest
+    """
+    if pdf_names is None:
+        groups = {shard: _list_documents(shard) for shard in shards()}
+    else:
+        groups = group_by_shard(pdf_names)
+
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.time()
+    documents = {}
+    offset = 0
+    text_offset = 0
+    with open(os.path.join(output_dir, "vectors.f32"), 'wb') as vectors_file, \
+            open(os.path.join(output_dir, "page_number.i16"), 'wb') as pages_file, \
+            open(os.path.join(output_dir, "chunk_hash.s64"), 'wb') as hashes_file, \
+            open(os.path.join(output_dir, "text.bin"), 'wb') as text_file, \
+            open(os.path.join(output_dir, "text_offsets.u64"), 'wb') as offsets_file:
+        offsets_file.write(np.zeros(1, dtype='<u8').tobytes())
+        for shard, names in groups.items():
+            for pdf_name in names:
+                rows = _export_document(shard, pdf_name)
+                if not rows:
+                    logger.warning(f"'{pdf_name}' has no rows, not exported")
+                    continue
+                blobs = [
+                    zlib.compress(row["text_content"].encode('utf-8'), Config.DATABASE.text_store_compression)
+                    for row in rows
+                ]
+                vectors_file.write(np.asarray([row["vector"] for row in rows], dtype='<f4').tobytes())
+                pages_file.write(np.asarray([row["page_number"] for row in rows], dtype='<i2').tobytes())
+                hashes_file.write(b"".join(
+                    row.get("chunk_hash", "").encode('ascii').ljust(_HASH_BYTES, b"\0") for row in rows
+                ))
+                text_file.write(b"".join(blobs))
+                ends = text_offset + np.cumsum([len(blob) for blob in blobs], dtype='<u8')
+                offsets_file.write(ends.astype('<u8').tobytes())
+                text_offset = int(ends[-1])
+
+                documents[pdf_name] = {"offset": offset, "rows": len(rows), "registry": doc_registry.get(pdf_name)}
+                offset += len(rows)
+                logger.info(f"Exported {len(rows)} rows of '{pdf_name}'")
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "created_at": time.time(),
+        "dimensions": Config.DATABASE.dimensions,
+        "rows": offset,
+        "documents": documents,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    logger.info(f"Exported {len(documents)} documents ({offset} rows) to {output_dir} in {time.time() - started:.1f}s")
+    return manifest
+
+
+class _Columns:
+    """Memory-mapped column files of a snapshot"""
+
+    def __init__(self, snapshot_dir: str, rows: int, dimensions: int):
+        def column(name: str, dtype, shape):
+            path = os.path.join(snapshot_dir, name)
+            return np.memmap(path, dtype=dtype, mode='r', shape=shape) if rows else np.zeros(shape, dtype=dtype)
+
+        self.vectors = column("vectors.f32", '<f4', (rows, dimensions))
+        self.pages = column("page_number.i16", '<i2', (rows,))
+        self.hashes = column("chunk_hash.s64", f'S{_HASH_BYTES}', (rows,))
+        self.offsets = column("text_offsets.u64", '<u8', (rows + 1,))
+        self.text = column("text.bin", np.uint8, (int(self.offsets[-1]),)) if rows else b""
+
+    def text_at(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return zlib.decompress(self.text[start:end].tobytes()).decode('utf-8')
+
+
+def _delete_document(client, shard: Shard, pdf_name: str):
+    """Remove a document's current rows before it is restored"""
+    ids = [row["id"] for row in iter_rows(client, f'pdf_name == "{pdf_name}"', ["id"], shard=shard)]
+    if ids:
+        client.delete(collection_name=shard.collection_name, ids=ids)
+        text_store.delete_many(ids, shard)
+        logger.info(f"Replaced {len(ids)} existing rows of '{pdf_name}'")
+
+
+def _import_shard(shard: Shard, pdf_names: List[str], columns: _Columns, documents: Dict[str, dict]) -> int:
+    client = get_database_client(shard)
+    inline = stores_text_inline(client, shard)
+    with_hash = has_field(client, "chunk_hash", shard)
+    imported = 0
+    for pdf_name in pdf_names:
+        _delete_document(client, shard, pdf_name)
+        start = documents[pdf_name]["offset"]
+        end = start + documents[pdf_name]["rows"]
+        for batch_start in range(start, end, Config.INSERT_BATCH_SIZE):
+            batch = range(batch_start, min(batch_start + Config.INSERT_BATCH_SIZE, end))
+            texts = [columns.text_at(row) for row in batch]
+            vectors = columns.vectors[batch.start:batch.stop].tolist()
+            group = []
+            for row, text, vector in zip(batch, texts, vectors):
+                page_id = int(columns.pages[row])
+                entry = {"vector": vector, "pdf_name": pdf_name, "page_number": page_id}
+                if with_hash:
+                    # Collections exported before chunk hashes existed get them computed here
+                    entry["chunk_hash"] = columns.hashes[row].rstrip(b"\0").decode('ascii') or chunk_hash(text, page_id)
+                if inline:
+                    entry["text_content"] = text
+                group.append(entry)
+            result = client.insert(collection_name=shard.collection_name, data=group)
+            if not inline:
+                text_store.put_many(list(result["ids"]), texts, shard)
+            imported += len(group)
+
+        registry = documents[pdf_name].get("registry")
+        if registry:
+            doc_registry.record(pdf_name, registry["sha256"], registry.get("filename"), registry.get("size"))
+        logger.info(f"Imported {documents[pdf_name]['rows']} rows of '{pdf_name}' into shard {shard.index}")
+    return imported
+
+
+def import_snapshot(snapshot_dir: str, pdf_names: Optional[List[str]] = None) -> dict:
+    """
+    Bulk-load a snapshot, or only the given documents from it
+
+    Documents already in the database are replaced. Shards are loaded in
+    parallel, one thread each.
+
+    Returns:
+        dict: documents and rows imported and the time taken
+    """
+    with open(os.path.join(snapshot_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version: {manifest.get('version')}")
+    if manifest["dimensions"] != Config.DATABASE.dimensions:
+        raise ValueError(
+            f"Snapshot vectors have {manifest['dimensions']} dimensions, the database expects {Config.DATABASE.dimensions}"
+        )
+
+    documents = manifest["documents"]
+    if pdf_names is None:
+        pdf_names = list(documents)
+    unknown = [pdf_name for pdf_name in pdf_names if pdf_name not in documents]
+    if unknown:
+        raise ValueError(f"Not in the snapshot: {unknown}")
+
+    started = time.time()
+    columns = _Columns(snapshot_dir, manifest["rows"], manifest["dimensions"])
+    groups = group_by_shard(pdf_names)
+    with ThreadPoolExecutor(max_workers=max(1, len(groups))) as pool:
+        rows = sum(pool.map(lambda item: _import_shard(item[0], item[1], columns, documents), groups.items()))
+
+    result = {"documents": len(pdf_names), "rows": rows, "seconds": round(time.time() - started, 2)}
+    logger.info(f"Imported {result['documents']} documents ({rows} rows) from {snapshot_dir} in {result['seconds']}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a snapshot of the vector database")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("directory", help="Snapshot directory")
+    parser.add_argument("--pdf", action="append", dest="pdf_names", help="Only this document (repeatable)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        manifest = export_snapshot(args.directory, args.pdf_names)
+        print(json.dumps({"documents": len(manifest["documents"]), "rows": manifest["rows"]}, indent=4))
+    else:
+        print(json.dumps(import_snapshot(args.directory, args.pdf_names), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+External store for chunk text, addressed by the Milvus row id.
+Texts are zlib-compressed and appended to one data file per shard that
+readers memory-map; a SQLite index maps row id -> (offset, length) and records
+the generation of the data file the offsets point into. Compaction writes a
+new generation and switches offsets and generation in one transaction. The collection
+then only holds vectors and filter keys, and text is fetched in bulk for the
+candidates that actually go to rerank and into the prompt.
+"""
+
+import fcntl
+import mmap
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+
+from config import Config
+from rag_modules.get_database import Shard, shards
+
+# SQLite limits the number of bound parameters per statement
+_BATCH = 900
+
+_map_lock = threading.Lock()
+_maps: Dict[str, Tuple[str, int, mmap.mmap]] = {}  # base path -> (data file path, inode, current mapping)
+
+
+def _base_path(shard: Optional[Shard]) -> str:
+    return (shard or shards()[0]).local_path(Config.DATABASE.text_store_path)
+
+
+def _generation_path(base_path: str, generation: int) -> str:
+    """Data file of a generation; generation 0 keeps the plain name"""
+    return base_path if generation == 0 else f"{base_path}.{generation}"
+
+
+def _generation(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _data_path(shard: Optional[Shard], conn: sqlite3.Connection) -> str:
+    """Current data file, the one the stored offsets point into"""
+    return _generation_path(_base_path(shard), _generation(conn))
+
+
+@contextmanager
+def _connect(shard: Optional[Shard] = None) -> Iterator[sqlite3.Connection]:
+    """Open the shard's index, commit on success and always close"""
+    path = (shard or shards()[0]).local_path(Config.DATABASE.text_index_path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def _file_lock(shared: bool, shard: Optional[Shard] = None):
+    """
+    Lock against compaction: readers and appenders hold it shared, compaction
+    holds it exclusively while it rewrites the data file and the offsets
+    """
+    path = _base_path(shard) + ".lock"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _batches(ids: Sequence[int]) -> Iterator[Sequence[int]]:
+    for start in range(0, len(ids), _BATCH):
+        yield ids[start:start + _BATCH]
+
+
+def _mapping(base_path: str, path: str, min_size: int) -> mmap.mmap:
+    """
+    Memory map of a data file covering at least min_size bytes, remapped when
+    the file grew, was replaced or a new generation became current
+    """
+    with _map_lock:
+        inode = os.stat(path).st_ino
+        current = _maps.get(base_path)
+        if current is None or current[:2] != (path, inode) or len(current[2]) < min_size:
+            with open(path, 'rb') as f:
+                # Old mappings are left to the garbage collector, another thread may still be reading one
+                current = (path, inode, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            _maps[base_path] = current
+        return current[2]
+
+
+def put_many(ids: Sequence[int], texts: Sequence[str], shard: Optional[Shard] = None):
+    """Store the texts of newly inserted rows"""
+    if not ids:
+        return
+    blobs = [zlib.compress(text.encode('utf-8'), Config.DATABASE.text_store_compression) for text in texts]
+    with _file_lock(shared=True, shard=shard), _connect(shard) as conn:
+        # The generation cannot change while the shared lock is held
+        path = _data_path(shard, conn)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'ab') as f:
+            # Appends from several processes must not interleave
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                entries = []
+                for row_id, blob in zip(ids, blobs):
+                    entries.append((int(row_id), offset, len(blob)))
+                    offset += len(blob)
+                f.write(b"".join(blobs))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        conn.executemany("INSERT OR REPLACE INTO chunks (id, offset, length) VALUES (?, ?, ?)", entries)
+
+
+def get_many(ids: Iterable[int], shard: Optional[Shard] = None) -> Dict[int, str]:
+    """Texts of the given row ids; ids without stored text are left out"""
+    ids = list(dict.fromkeys(int(row_id) for row_id in ids))
+    if not ids:
+        return {}
+    with _file_lock(shared=True, shard=shard):
+        locations = []
+        with _connect(shard) as conn:
+            path = _data_path(shard, conn)
+            for batch in _batches(ids):
+                placeholders = ",".join("?" * len(batch))
+                locations += conn.execute(
+                    f"SELECT id, offset, length FROM chunks WHERE id IN ({placeholders})", batch
+                ).fetchall()
+        if not locations:
+            return {}
+
+        data = _mapping(_base_path(shard), path, max(offset + length for _, offset, length in locations))
+        return {
+            row_id: zlib.decompress(data[offset:offset + length]).decode('utf-8')
+            for row_id, offset, length in locations
+        }
+
+
+def stored_ids(ids: Iterable[int], shard: Optional[Shard] = None) -> Set[int]:
+    """The given row ids that have stored text (index lookup only)"""
+    ids = list(dict.fromkeys(int(row_id) for row_id in ids))
+    found: Set[int] = set()
+    with _connect(shard) as conn:
+        for batch in _batches(ids):
+            placeholders = ",".join("?" * len(batch))
+            found.update(row_id for (row_id,) in conn.execute(f"SELECT id FROM chunks WHERE id IN ({placeholders})", batch))
+    return found
+
+
+def delete_many(ids: Iterable[int], shard: Optional[Shard] = None):
+    """Forget the texts of deleted rows; the space is reclaimed by compaction"""
+    ids = [int(row_id) for row_id in ids]
+    with _connect(shard) as conn:
+        for batch in _batches(ids):
+            conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+
+
+def clear(shard: Optional[Shard] = None):
+    with _file_lock(shared=False, shard=shard):
+        with _connect(shard) as conn:
+            path = _data_path(shard, conn)
+            conn.execute("DELETE FROM chunks")
+        with _map_lock:
+            _maps.pop(_base_path(shard), None)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def stats(shard: Optional[Shard] = None) -> dict:
+    """Record count, data file size and bytes still referenced"""
+    with _connect(shard) as conn:
+        count, live = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks").fetchone()
+        path = _data_path(shard, conn)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return {"records": count, "file_bytes": size, "live_bytes": live}
+
+
+def compact(shard: Optional[Shard] = None) -> dict:
+    """
+    Rewrite the data file with only the texts still referenced
+
+    The live texts are copied into the next generation's file; the new
+    offsets and the generation switch commit in one transaction, and only
+    then is the old file removed. A crash at any point leaves the index
+    consistent with one complete data file (plus at most a stray file).
+
+    Returns:
+        dict: stats() before and after
+    """
+    before = stats(shard)
+    base_path = _base_path(shard)
+    with _file_lock(shared=False, shard=shard):
+        with _connect(shard) as conn:
+            generation = _generation(conn)
+            path = _generation_path(base_path, generation)
+            if not os.path.exists(path) or not os.path.getsize(path):
+                return {"before": before, "after": before}
+            new_path = _generation_path(base_path, generation + 1)
+
+            data = _mapping(base_path, path, 0)
+            entries = []
+            with open(new_path, 'wb') as out:
+                offset = 0
+                for row_id, old_offset, length in conn.execute("SELECT id, offset, length FROM chunks ORDER BY offset"):
+                    out.write(data[old_offset:old_offset + length])
+                    entries.append((offset, row_id))
+                    offset += length
+                out.flush()
+                os.fsync(out.fileno())
+            conn.executemany("UPDATE chunks SET offset = ? WHERE id = ?", entries)
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('generation', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (generation + 1,)
+            )
+        # Committed: the old generation (and leftovers of earlier interrupted runs) can go
+        with _map_lock:
+            _maps.pop(base_path, None)
+        directory = os.path.dirname(base_path) or "."
+        prefix = os.path.basename(base_path)
+        for filename in os.listdir(directory):
+            stale = os.path.join(directory, filename)
+            if stale != new_path and (filename == prefix or (filename.startswith(prefix + ".") and filename[len(prefix) + 1:].isdigit())):
+                os.remove(stale)
+    return {"before": before, "after": stats(shard)}
@@ -0,0 +1,287 @@
+"""
+Admission control and per-stage concurrency limits.
+Every pipeline stage (split, embed, search, rerank, generate, convert) has a
+fixed number of slots and a bounded waiting line. Waiting work is served in
+priority order, so interactive queries overtake ingestion and batch runs,
+and interactive work that would wait longer than the stage's budget is
+rejected with Overloaded instead of piling up until every request times out.
+The web app turns Overloaded into 429 with a Retry-After header.
+
+Priority is carried in a context variable: the web app marks queries as
+interactive when it admits them, everything else (ingestion jobs, batch
+queries, CLI tools) runs as background work that waits without a budget.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import Config
+from utils import metrics
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("admission_priority", default=BACKGROUND)
+
+# Stages an interactive query passes through, checked before it is admitted
+QUERY_STAGES = ("split", "embed", "search", "rerank", "generate")
+
+
+class Overloaded(Exception):
+    """Work was turned away because a stage is saturated; retry after retry_after seconds"""
+
+    metrics_outcome = "overloaded"
+
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(f"Server is overloaded ({stage}), retry after {retry_after}s")
+        self.stage = stage
+        self.retry_after = retry_after
+
+
+def set_priority(priority: int):
+    """Set the priority of work started from the current context"""
+    _priority.set(priority)
+
+
+class _Waiter:
+    __slots__ = ("priority", "sequence", "loop", "future", "granted")
+
+    def __init__(self, priority: int, sequence: int, loop: asyncio.AbstractEventLoop):
+        self.priority = priority
+        self.sequence = sequence
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StageLimiter:
+    """
+    Priority semaphore for one stage
+
+    Thread-safe and usable from any event loop, since sync wrappers in this
+    project run their own short-lived loops in worker threads.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_waiting: int, max_wait: Optional[float]):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters: List[_Waiter] = []
+        self._sequence = itertools.count()
+        self._service_seconds = 1.0  # Moving average of how long a slot is held
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _ahead(self, priority: int) -> int:
+        """Waiters that would be served before newly arriving work of this priority"""
+        return sum(1 for waiter in self._waiters if waiter.priority <= priority)
+
+    def expected_wait(self, priority: int = INTERACTIVE) -> float:
+        """Seconds newly arriving work of this priority would wait for a slot"""
+        with self._lock:
+            if self._active < self.concurrency and not self._waiters:
+                return 0.0
+            return (self._ahead(priority) + 1) / self.concurrency * self._service_seconds
+
+    def retry_after(self) -> int:
+        return max(Config.ADMISSION_MIN_RETRY_AFTER, math.ceil(self.expected_wait()))
+
+    def over_budget(self) -> bool:
+        """Whether interactive work arriving now would exceed the waiting line or the time budget"""
+        with self._lock:
+            if self._ahead(INTERACTIVE) >= self.max_waiting:
+                return True
+        return self.max_wait is not None and self.expected_wait() > self.max_wait
+
+    def _reject(self) -> Overloaded:
+        metrics.inc("admission_rejected_total", stage=self.name)
+        logger.warning(f"Stage '{self.name}' overloaded: {self._active} running, {len(self._waiters)} waiting")
+        return Overloaded(self.name, self.retry_after())
+
+    async def acquire(self, priority: int):
+        with self._lock:
+            if self._active < self.concurrency and not self._waiters:
+                self._active += 1
+                return
+            # Background waiters never hold up interactive work, so only those ahead count
+            line_full = priority == INTERACTIVE and self._ahead(priority) >= self.max_waiting
+            if not line_full:
+                waiter = _Waiter(priority, next(self._sequence), asyncio.get_running_loop())
+                heapq.heappush(self._waiters, waiter)
+        if line_full:
+            raise self._reject()
+
+        started = time.monotonic()
+        try:
+            if priority == INTERACTIVE and self.max_wait is not None:
+                await asyncio.wait_for(waiter.future, self.max_wait)
+            else:
+                await waiter.future
+        except BaseException as e:
+            with self._lock:
+                if waiter.granted:
+                    # The slot was handed over just as the wait ended, pass it on
+                    self._release_locked()
+                else:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject() from None
+            raise
+        metrics.inc("admission_wait_seconds_total", time.monotonic() - started, stage=self.name)
+
+    def release(self, held_seconds: float):
+        with self._lock:
+            self._service_seconds = 0.9 * self._service_seconds + 0.1 * held_seconds
+            self._release_locked()
+
+    def _release_locked(self):
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            waiter.granted = True
+            try:
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+                return  # The slot passes straight to the waiter
+            except RuntimeError:
+                continue  # Its event loop is closed
+        self._active -= 1
+
+    def status(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "concurrency": self.concurrency,
+            "max_waiting": self.max_waiting,
+            "max_wait_seconds": self.max_wait,
+            "expected_wait_seconds": round(self.expected_wait(), 2),
+        }
+
+
+_limiters: Dict[str, StageLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name: str) -> StageLimiter:
+    with _limiters_lock:
+        if name not in _limiters:
+            concurrency, max_waiting, max_wait = Config.ADMISSION_STAGES[name]
+            _limiters[name] = StageLimiter(name, concurrency, max_waiting, max_wait)
+        return _limiters[name]
+
+
+@asynccontextmanager
+async def stage(name: str) -> AsyncIterator[None]:
+    """Hold one of the stage's slots for the duration of the block"""
+    if not Config.ADMISSION_ENABLED:
+        yield
+        return
+    stage_limiter = limiter(name)
+    await stage_limiter.acquire(_priority.get())
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        stage_limiter.release(time.monotonic() - started)
+
+
+class _Admissions:
+    """Count of interactive queries admitted and not yet finished"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.current >= Config.ADMISSION_MAX_QUERIES:
+                return False
+            self.current += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.current -= 1
+
+
+_queries = _Admissions()
+
+
+class Ticket:
+    """An admitted interactive query; release it once the response is complete (idempotent)"""
+
+    def __init__(self, counted: bool = True):
+        self._released = not counted
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            _queries.leave()
+
+
+def admit_query() -> Ticket:
+    """
+    Admit an interactive query or raise Overloaded
+
+    Rejects at once when too many queries are in flight or when a stage the
+    query needs already has a longer wait than its budget, so an overloaded
+    server answers 429 quickly instead of queueing work that would time out.
+    Also marks the current context as interactive.
+    """
+    set_priority(INTERACTIVE)
+    if not Config.ADMISSION_ENABLED:
+        return Ticket(counted=False)
+    for name in QUERY_STAGES:
+        stage_limiter = limiter(name)
+        if stage_limiter.over_budget():
+            raise stage_limiter._reject()
+    if not _queries.try_enter():
+        metrics.inc("admission_rejected_total", stage="admission")
+        raise Overloaded("admission", Config.ADMISSION_MIN_RETRY_AFTER)
+    return Ticket()
+
+
+def _export_gauges():
+    metrics.set_gauge("admission_queries_in_flight", _queries.current)
+    for name in Config.ADMISSION_STAGES:
+        stage_limiter = limiter(name)
+        metrics.set_gauge("admission_stage_active", stage_limiter.active, stage=name)
+        metrics.set_gauge("admission_stage_waiting", stage_limiter.waiting, stage=name)
+
+
+metrics.register_collector(_export_gauges)
+
+
+def status() -> dict:
+    """Queries in flight and the slots and waiting lines of every stage"""
+    return {
+        "queries_in_flight": _queries.current,
+        "max_queries": Config.ADMISSION_MAX_QUERIES,
+        "stages": {name: limiter(name).status() for name in Config.ADMISSION_STAGES},
+    }
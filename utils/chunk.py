@@ -1,62 +1,199 @@
+import itertools
 import json
-import os
-from typing import List, Dict, Any
+import mmap
+import re
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Union
 
 from config import Config
 from utils.colored_logger import get_colored_logger
 
 logger = get_colored_logger(__name__)
 
-def chunk_with_metadata(markdown_content: str, metadata: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+# 分词片段: 前导空白 + (ASCII单词 | 其他单个非空白字符); 单词长度有上限, 保证字符数上限总能满足
+# 各片段首尾相接; 分组依次为: 整个片段, 前导空白中的换行, ASCII单词
+_PIECE = re.compile(r'((\s*\n)?\s*(?:([A-Za-z0-9_]{1,64})|\S))')
 
-    chunks = []
-    
-    # 过滤掉重复的标题和页眉页脚
+Buffer = Union[str, bytes, mmap.mmap]
+
+
+def _pieces(text: str) -> Tuple[List[int], List[int], List[bool]]:
+    """
+    切分为片段, 返回每个片段的结束位置、token数和前面是否有换行
+
+    ASCII单词约4字符一个token, 其余非空白字符 (含CJK) 每个一个token。
+    逐片段的工作都在C层完成 (findall/accumulate/map), 这里是分块的热点路径。
+    """
+    matches = _PIECE.findall(text)
+    if not matches:
+        return [], [], []
+    pieces, newlines, words = zip(*matches)
+    ends = list(itertools.accumulate(map(len, pieces)))
+    costs = [(length + 3) >> 2 or 1 for length in map(len, words)]
+    breaks = list(map(bool, newlines))
+    return ends, costs, breaks
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数"""
+    return sum(_pieces(text)[1])
+
+
+def split_text(
+    text: str,
+    token_limit: Optional[int] = None,
+    overlap_tokens: Optional[int] = None,
+    char_limit: Optional[int] = None
+) -> Iterator[str]:
+    """
+    按token数切分一段文本, 相邻块之间保留overlap_tokens的重叠
+
+    每块不超过token_limit个token且不超过char_limit个字符; 若块的后半部分有换行, 则在换行处断开。
+    未指定的上限在调用时从Config.DATABASE读取 (chunk_token_limit / chunk_overlap_tokens / chunk_size_limit)。
+    """
+    token_limit = Config.DATABASE.chunk_token_limit if token_limit is None else token_limit
+    overlap_tokens = Config.DATABASE.chunk_overlap_tokens if overlap_tokens is None else overlap_tokens
+    char_limit = Config.DATABASE.chunk_size_limit if char_limit is None else char_limit
+    ends, costs, breaks = _pieces(text)
+    n = len(ends)
+    start_piece, start_offset = 0, 0
+    while start_piece < n:
+        tokens, i, last_break = 0, start_piece, None
+        while i < n:
+            if i > start_piece and (tokens + costs[i] > token_limit or ends[i] - start_offset > char_limit):
+                break
+            if breaks[i] and i > start_piece:
+                last_break = i
+            tokens += costs[i]
+            i += 1
+        if i < n and last_break and last_break > start_piece + (i - start_piece) // 2:
+            i = last_break
+
+        chunk = text[start_offset:ends[i - 1]].strip()
+        if chunk:
+            yield chunk
+        if i >= n:
+            return
+
+        # 回退若干片段作为下一块的开头, 且至少前进一个片段
+        j, overlap = i, 0
+        while j - 1 > start_piece and overlap + costs[j - 1] <= overlap_tokens:
+            j -= 1
+            overlap += costs[j]
+        start_piece, start_offset = j, ends[j - 1]
+
+
+def _filter_toc(metadata: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # 过滤掉完全重复的目录项 (同一标题且同一页)
     filtered_meta = []
-    seen_titles = set()
+    seen = set()
     for item in metadata:
-        title = item['title']
-        # 跳过重复标题和页眉页脚
-        if (title not in seen_titles):
+        key = (item['title'], item['page_id'])
+        if key not in seen:
             filtered_meta.append({
                 'title': item['title'],
                 'page_id': item['page_id']
             })
-            seen_titles.add(title)
-        
-    # print(f"Filtered TOC: {filtered_meta}")
-    start_index = 0
-    end_index = 0
-    chunks = []
-    for i, toc_item in enumerate(filtered_meta):
-        start_index = markdown_content.find(toc_item['title'])
-        end_index = markdown_content.find(filtered_meta[i+1]['title']) if (i + 1) < len(filtered_meta) else len(markdown_content)
-        
-        if len(markdown_content[start_index:end_index].strip()) < 50:
+            seen.add(key)
+    return filtered_meta
+
+
+def _iter_sections(
+    buffer: Buffer,
+    toc: List[Dict[str, Any]],
+    encode: Callable[[str], Any]
+) -> Iterator[Tuple[Dict[str, Any], int, int]]:
+    """
+    单次顺序扫描定位每个章节的 [start, end) 区间
+
+    每个标题都从上一个标题之后开始查找, 因此总开销与文档长度成线性关系, 重复标题也会落在正确的位置。
+    找不到的标题 (或顺序错乱的标题) 被跳过, 其内容并入上一章节。
+    """
+    pos = 0
+    current = None
+    for toc_item in toc:
+        title = encode(toc_item['title'])
+        if not title:
+            continue
+        found = buffer.find(title, pos)
+        if found < 0:
+            logger.debug(f"Title '{toc_item['title']}' not found after offset {pos}, merged into previous section")
+            continue
+        if current is not None:
+            yield current[0], current[1], found
+        current = (toc_item, found)
+        pos = found + len(title)
+    if current is not None:
+        yield current[0], current[1], len(buffer)
+
+
+def _chunk_sections(
+    buffer: Buffer,
+    metadata: List[Dict[str, Any]],
+    encode: Callable[[str], Any],
+    decode: Callable[[Any], str]
+) -> Iterator[Dict[str, Any]]:
+    for toc_item, start_index, end_index in _iter_sections(buffer, _filter_toc(metadata), encode):
+        section = decode(buffer[start_index:end_index])
+        if len(section.strip()) < 50:
             logger.warning(f"Skipping chunk for '{toc_item['title']}' due to insufficient content length")
             continue
-        
-        current_pos = start_index
-        while current_pos < end_index:
-            chunk_end = min(current_pos + Config.DATABASE.chunk_size_limit, end_index)
-            chunk_content = markdown_content[current_pos:chunk_end].strip()
-            
-            # 只有当chunk内容长度大于0时才添加
-            if chunk_content:
-                chunks.append({
-                    'content': chunk_content,
-                    'metadata': {
-                        'title': toc_item['title'],
-                        'page_id': toc_item['page_id']+1
-                    }
-                })
-            current_pos = chunk_end
-    
-    return chunks
+
+        for chunk_content in split_text(section):
+            yield {
+                'content': chunk_content,
+                'metadata': {
+                    'title': toc_item['title'],
+                    'page_id': toc_item['page_id']+1
+                }
+            }
+
+
+def chunk_with_metadata(markdown_content: str, metadata: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    按目录将markdown文本切分为带元数据的块
+
+    Args:
+        markdown_content: markdown文本
+        metadata: 目录列表, 每项包含'title'和'page_id'
+
+    Returns:
+        List[Dict]: 分块结果
+    """
+    return list(_chunk_sections(markdown_content, metadata, lambda s: s, lambda s: s))
+
+
+def iter_chunks(markdown_path: str, metadata_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    以内存映射方式读取markdown文件并逐块生成分块结果
+
+    整个文件不会被读入内存, 每次只解码当前章节。
+
+    Args:
+        markdown_path: markdown文件路径
+        metadata_path: metadata JSON文件路径
+    """
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    with open(markdown_path, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            return
+        with buffer:
+            yield from _chunk_sections(
+                buffer,
+                metadata['table_of_contents'],
+                lambda s: s.encode('utf-8'),
+                lambda b: b.decode('utf-8', errors='replace')
+            )
+
 
 def load_and_chunk(markdown_path: str, metadata_path: str) -> List[Dict[str, Any]]:
     """
-    加载文件并进行分块的便捷函数
+    加载文件并进行分块的便捷函数, 供需要完整列表的调用方使用
+
+    导入流程直接使用iter_chunks逐块处理。
     
     Args:
         markdown_path: markdown文件路径
@@ -65,13 +202,7 @@ def load_and_chunk(markdown_path: str, metadata_path: str) -> List[Dict[str, Any
     Returns:
         List[Dict]: 分块结果
     """
-    with open(markdown_path, 'r', encoding='utf-8') as f:
-        markdown_content = f.read()
-        # print(markdown_content[:100])
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
-        # print(metadata['table_of_contents'])
-    return chunk_with_metadata(markdown_content, metadata['table_of_contents'])
+    return list(iter_chunks(markdown_path, metadata_path))
 
 
 if __name__ == "__main__":
@@ -80,4 +211,3 @@ if __name__ == "__main__":
     metadata_path = "../docs/74HC165D/74HC165D_meta.json"
     
     load_and_chunk(markdown_path, metadata_path)
-    
\ No newline at end of file
@@ -1,14 +1,56 @@
+import asyncio
+import json
 import os
+import re
+import shutil
 import subprocess
+import threading
+import weakref
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 from config import Config
 from utils.colored_logger import get_colored_logger
+from utils.progress import IngestCancelled, IngestProgress
 
 logger = get_colored_logger(__name__)
 
+# marker_single 的 tqdm 进度条，例如 "Recognizing Text: 40%|████ | 4/10 [00:02<00:03]"
+_PROGRESS_PATTERN = re.compile(r"(\d+)/(\d+) \[")
+
+
+def count_pages(pdf_path: str) -> int:
+    """Return the number of pages in a PDF, or 0 if it cannot be determined"""
+    try:
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not count pages of {pdf_path}: {e}")
+        return 0
+
+    try:
+        from pdfminer.pdfpage import PDFPage
+
+        with open(pdf_path, 'rb') as f:
+            return sum(1 for _ in PDFPage.get_pages(f))
+    except Exception as e:
+        logger.warning(f"Could not count pages of {pdf_path}: {e}")
+        return 0
+
+
 def pdf2md(
         pdf_path: str,
-        output_dir: str
+        output_dir: str,
+        progress: Optional[IngestProgress] = None,
+        page_range: Optional[str] = None,
+        stop: Optional[threading.Event] = None,
+        paginate: bool = False
 ):
     # Set the model cache directory
     logger.info(f"Loading models from {Config.MODEL_DIR}")
@@ -18,31 +60,434 @@ def pdf2md(
     logger.info(f"Starting PDF to Markdown conversion: {pdf_path}")
     logger.info(f"Output directory: {output_dir}")
     
-    # Use Popen to get real-time output
-    process = subprocess.Popen([
+    command = [
         'marker_single', 
         pdf_path, 
         '--output_dir', 
         output_dir
-    ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True)
+    ]
+    if page_range:
+        command += ['--page_range', page_range]
+    if paginate:
+        command.append('--paginate_output')
+
+    # Use Popen to get real-time output
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True)
     
     # Read output line by line in real-time
     while True:
+        if (progress is not None and progress.cancelled) or (stop is not None and stop.is_set()):
+            process.terminate()
+            process.wait()
+            raise IngestCancelled(f"Conversion of {pdf_path} cancelled")
         output = process.stdout.readline()
         if output == '' and process.poll() is not None:
             break
         if output:
             # Log each line of output as it comes
             logger.info(f"[marker_single] {output.strip()}")
+            if progress is not None and page_range is None:
+                _update_page_progress(progress, output)
     
     # Wait for the process to complete and get return code
     return_code = process.poll()
     
     if return_code == 0:
         logger.info("PDF to Markdown conversion completed successfully")
+        if progress is not None and progress.pages_total and page_range is None:
+            progress.pages_converted = progress.pages_total
     else:
         logger.error(f"PDF to Markdown conversion failed with return code: {return_code}")
         raise RuntimeError(f"marker_single failed with return code: {return_code}")
 
+
+async def pdf2md_async(
+        pdf_path: str,
+        output_dir: str,
+        progress: Optional[IngestProgress] = None
+):
+    """
+    Convert a PDF without blocking the event loop.
+    In "auto" mode pages with a good text layer are extracted with pdfminer
+    and only the remaining pages go through Marker. Large PDFs are split into
+    page ranges that are converted in parallel and merged back into the usual
+    {name}/{name}.md and {name}_meta.json layout.
+    """
+    if Config.CONVERT_MODE == "auto" and await _pdf2md_text_layer(pdf_path, output_dir, progress):
+        logger.info("PDF to Markdown conversion completed successfully")
+        return
+
+    pages_total = progress.pages_total if progress is not None else 0
+    if pages_total >= Config.PARALLEL_CONVERT_MIN_PAGES:
+        await _pdf2md_ranges(pdf_path, output_dir, pages_total, progress)
+    else:
+        await _convert_once(pdf_path, output_dir, progress)
+        if progress is not None and progress.pages_total:
+            progress.pages_converted = progress.pages_total
+    logger.info("PDF to Markdown conversion completed successfully")
+
+
+async def _convert_once(
+        pdf_path: str,
+        output_dir: str,
+        progress: Optional[IngestProgress] = None,
+        page_range: Optional[str] = None,
+        paginate: bool = False
+):
+    """Convert a PDF (or some of its pages) in the warm Marker pool, or with marker_single"""
+    if Config.MARKER_POOL_SIZE > 0:
+        from utils.marker_pool import get_marker_pool
+
+        pool = get_marker_pool()
+        if not pool.broken:
+            logger.info(f"Converting {pdf_path} (pages {page_range or 'all'}) in Marker pool")
+            job_id, future = pool.submit(pdf_path, output_dir, page_range, paginate)
+            try:
+                await asyncio.wrap_future(future)
+                return
+            except asyncio.CancelledError:
+                pool.cancel(job_id)
+                raise
+            except RuntimeError:
+                if not pool.broken:
+                    raise
+        logger.warning(f"Marker pool unavailable ({pool.broken}), falling back to marker_single")
+
+    async with _subprocess_slots():
+        stop = threading.Event()
+        conversion = asyncio.ensure_future(asyncio.to_thread(pdf2md, pdf_path, output_dir, progress, page_range, stop, paginate))
+        try:
+            await asyncio.shield(conversion)
+        except asyncio.CancelledError:
+            # Stop marker_single and wait for it to exit, so the caller can remove its output directory
+            stop.set()
+            await asyncio.gather(conversion, return_exceptions=True)
+            raise
+
+
+_subprocess_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _subprocess_slots() -> asyncio.Semaphore:
+    """Per-loop limit on concurrent marker_single processes"""
+    loop = asyncio.get_running_loop()
+    if loop not in _subprocess_semaphores:
+        _subprocess_semaphores[loop] = asyncio.Semaphore(Config.MARKER_PARALLEL_PROCESSES)
+    return _subprocess_semaphores[loop]
+
+
+def page_ranges(pages_total: int, pages_per_range: int) -> List[Tuple[int, int]]:
+    """Split [0, pages_total) into inclusive (start, end) page ranges"""
+    return [
+        (start, min(start + pages_per_range, pages_total) - 1)
+        for start in range(0, pages_total, pages_per_range)
+    ]
+
+
+async def _pdf2md_ranges(
+        pdf_path: str,
+        output_dir: str,
+        pages_total: int,
+        progress: Optional[IngestProgress] = None
+):
+    ranges = page_ranges(pages_total, Config.MARKER_PAGES_PER_RANGE)
+    logger.info(f"Converting {pdf_path} as {len(ranges)} page ranges of up to {Config.MARKER_PAGES_PER_RANGE} pages")
+
+    async def convert_part(part_dir: str, start: int, end: int):
+        await _convert_once(pdf_path, part_dir, progress, page_range=f"{start}-{end}")
+        if progress is not None:
+            progress.pages_converted += end - start + 1
+
+    await _convert_parts(pdf_path, output_dir, ranges, convert_part)
+
+
+async def _pdf2md_text_layer(
+        pdf_path: str,
+        output_dir: str,
+        progress: Optional[IngestProgress] = None
+) -> bool:
+    """
+    Convert text-layer pages with pdfminer and the rest with Marker
+
+    Returns:
+        bool: False if no page has a usable text layer (the caller converts the whole PDF with Marker)
+    """
+    from utils import pdf_text
+
+    try:
+        pages, outline = await asyncio.to_thread(pdf_text.extract_pdf, pdf_path)
+    except Exception as e:
+        logger.warning(f"pdfminer could not read {pdf_path}, converting every page with Marker: {e}")
+        return False
+    text_pages = sum(1 for page in pages if page.use_text_layer)
+    if not text_pages:
+        return False
+
+    headings = pdf_text.document_headings(pages, outline)
+    # Runs of consecutive pages per method; the Marker pages of all runs are converted together
+    segments = text_layer_segments([page.use_text_layer for page in pages], max(1, len(pages)))
+    marker_pages = [page.page_id for page in pages if not page.use_text_layer]
+    batches = [
+        marker_pages[i:i + Config.MARKER_PAGES_PER_RANGE]
+        for i in range(0, len(marker_pages), Config.MARKER_PAGES_PER_RANGE)
+    ]
+    logger.info(
+        f"Converting {pdf_path}: {text_pages} pages from the text layer, "
+        f"{len(marker_pages)} pages with Marker in {len(batches)} call(s)"
+    )
+    if progress is not None:
+        progress.pages_total = progress.pages_total or len(pages)
+        progress.pages_converted += text_pages
+        progress.detail = f"{text_pages} of {len(pages)} pages from the text layer"
+
+    text_ranges = {(start, end) for text, start, end in segments if text}
+    marker_ranges = [(start, end) for text, start, end in segments if not text]
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    marker_dir = os.path.join(output_dir, pdf_name, "_marker")
+
+    async def convert_batch(index: int, page_ids: List[int]) -> str:
+        batch_dir = os.path.join(marker_dir, str(index))
+        os.makedirs(batch_dir, exist_ok=True)
+        await _convert_once(pdf_path, batch_dir, progress, page_range=page_list(page_ids), paginate=True)
+        if progress is not None:
+            progress.pages_converted += len(page_ids)
+        return os.path.join(batch_dir, pdf_name)
+
+    try:
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(convert_batch(i, page_ids)) for i, page_ids in enumerate(batches)]
+        except BaseExceptionGroup as eg:
+            raise eg.exceptions[0]
+        marker_markdown, marker_meta = await asyncio.to_thread(
+            split_paginated_output, [task.result() for task in tasks], batches, pdf_name
+        )
+
+        async def convert_part(part_dir: str, start: int, end: int):
+            folder = os.path.join(part_dir, pdf_name)
+            if (start, end) in text_ranges:
+                await asyncio.to_thread(pdf_text.write_text_part, pages[start:end + 1], headings, pdf_name, folder)
+                return
+            # The images of every Marker page travel with the first Marker part
+            image_folders = [task.result() for task in tasks] if (start, end) == marker_ranges[0] else []
+            await asyncio.to_thread(
+                write_marker_part, marker_markdown, marker_meta, start, end, image_folders, pdf_name, folder
+            )
+
+        await _convert_parts(pdf_path, output_dir, [(start, end) for _, start, end in segments], convert_part)
+    finally:
+        shutil.rmtree(marker_dir, ignore_errors=True)
+    return True
+
+
+def page_list(page_ids: List[int]) -> str:
+    """Marker page range of sorted page ids, e.g. [0, 1, 2, 5, 9, 10] -> 0-2,5,9-10"""
+    parts = []
+    start = previous = page_ids[0]
+    for page_id in page_ids[1:] + [None]:
+        if page_id is not None and page_id == previous + 1:
+            previous = page_id
+            continue
+        parts.append(str(start) if start == previous else f"{start}-{previous}")
+        if page_id is not None:
+            start = previous = page_id
+    return ",".join(parts)
+
+
+# Marker's --paginate_output puts "{page_id}" and 48 dashes before every page
+_PAGE_SEPARATOR = re.compile(r"^\{(\d+)\}-{48}\s*$", re.MULTILINE)
+
+
+def split_paginated_output(
+        folders: List[str],
+        batches: List[List[int]],
+        pdf_name: str
+) -> Tuple[Dict[int, str], dict]:
+    """
+    Split paginated Marker outputs of scattered pages back into per-page Markdown
+
+    Page ids are normally the original ones; if a batch's ids turn out to be
+    positions in its page list they are mapped back. Output without page
+    separators is kept whole on the batch's first page.
+
+    Returns:
+        (page id -> Markdown, merged metadata with original page ids)
+    """
+    markdown_by_page: Dict[int, str] = {}
+    merged_meta: dict = {}
+    for folder, requested in zip(folders, batches):
+        with open(os.path.join(folder, f"{pdf_name}.md"), 'r', encoding='utf-8') as f:
+            markdown = f.read()
+        with open(os.path.join(folder, f"{pdf_name}_meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        pieces = _PAGE_SEPARATOR.split(markdown)
+        found = [int(page_id) for page_id in pieces[1::2]]
+        if set(found) <= set(requested):
+            mapping = {page_id: page_id for page_id in requested}
+        else:
+            mapping = dict(enumerate(requested))
+        if not found:
+            logger.warning(f"Marker output of pages {page_list(requested)} has no page separators, keeping it on page {requested[0]}")
+            markdown_by_page[requested[0]] = markdown.strip()
+        else:
+            preamble = pieces[0].strip()
+            for index, (page_id, text) in enumerate(zip(found, pieces[2::2])):
+                text = text.strip()
+                if index == 0 and preamble:
+                    text = f"{preamble}\n\n{text}"
+                page_id = mapping.get(page_id, page_id)
+                markdown_by_page[page_id] = f"{markdown_by_page[page_id]}\n\n{text}" if page_id in markdown_by_page else text
+
+        for key in ('table_of_contents', 'page_stats'):
+            for item in meta.get(key, []):
+                if 'page_id' in item:
+                    item['page_id'] = mapping.get(item['page_id'], item['page_id'])
+            merged_meta.setdefault(key, []).extend(meta.get(key, []))
+    return markdown_by_page, merged_meta
+
+
+def write_marker_part(
+        markdown_by_page: Dict[int, str],
+        meta: dict,
+        start: int,
+        end: int,
+        image_folders: List[str],
+        pdf_name: str,
+        part_folder: str
+):
+    """Write the Marker pages start..end in the Marker output layout, moving in the images of image_folders"""
+    os.makedirs(part_folder, exist_ok=True)
+    texts = [markdown_by_page[page_id] for page_id in range(start, end + 1) if markdown_by_page.get(page_id)]
+    part_meta = {
+        key: [item for item in meta.get(key, []) if start <= item.get('page_id', -1) <= end]
+        for key in ('table_of_contents', 'page_stats')
+    }
+    with open(os.path.join(part_folder, f"{pdf_name}.md"), 'w', encoding='utf-8') as f:
+        f.write("\n\n".join(texts) + "\n")
+    with open(os.path.join(part_folder, f"{pdf_name}_meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(part_meta, f, ensure_ascii=False, indent=4)
+    for folder in image_folders:
+        for filename in os.listdir(folder):
+            if filename not in (f"{pdf_name}.md", f"{pdf_name}_meta.json"):
+                shutil.move(os.path.join(folder, filename), os.path.join(part_folder, filename))
+
+
+def text_layer_segments(use_text_layer: List[bool], pages_per_range: int) -> List[Tuple[bool, int, int]]:
+    """
+    Group consecutive pages by conversion method into inclusive (text_layer, start, end) segments.
+    Marker segments are further split into ranges of at most pages_per_range pages.
+    """
+    segments = []
+    start = 0
+    for page_id in range(1, len(use_text_layer) + 1):
+        if page_id < len(use_text_layer) and use_text_layer[page_id] == use_text_layer[start]:
+            continue
+        if use_text_layer[start]:
+            segments.append((True, start, page_id - 1))
+        else:
+            segments += [
+                (False, start + range_start, start + range_end)
+                for range_start, range_end in page_ranges(page_id - start, pages_per_range)
+            ]
+        start = page_id
+    return segments
+
+
+async def _convert_parts(
+        pdf_path: str,
+        output_dir: str,
+        ranges: List[Tuple[int, int]],
+        convert_part: Callable[[str, int, int], Awaitable[None]]
+):
+    """Convert page ranges concurrently into {name}/_parts/{index} and merge them in page order"""
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    parts_dir = os.path.join(output_dir, pdf_name, "_parts")
+
+    async def run(index: int, start: int, end: int) -> str:
+        part_dir = os.path.join(parts_dir, str(index))
+        os.makedirs(part_dir, exist_ok=True)
+        await convert_part(part_dir, start, end)
+        return os.path.join(part_dir, pdf_name)
+
+    try:
+        # A failed range cancels the others (and waits for them) before their directories are removed
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(run(i, start, end)) for i, (start, end) in enumerate(ranges)]
+        except BaseExceptionGroup as eg:
+            raise eg.exceptions[0]
+        await asyncio.to_thread(
+            merge_range_outputs, [task.result() for task in tasks], ranges, pdf_name, os.path.join(output_dir, pdf_name)
+        )
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def merge_range_outputs(
+        part_folders: List[str],
+        ranges: List[Tuple[int, int]],
+        pdf_name: str,
+        target_folder: str
+):
+    """
+    Merge per-range Marker outputs into one Markdown file, one metadata file and a flat image folder.
+
+    Marker keeps original page ids when given a page range; if a part's ids
+    turn out to be range-relative they are shifted by the range start so
+    chunk page ids stay correct.
+    """
+    os.makedirs(target_folder, exist_ok=True)
+    markdown_parts = []
+    merged_meta = None
+
+    for index, (part_folder, (start, end)) in enumerate(zip(part_folders, ranges)):
+        with open(os.path.join(part_folder, f"{pdf_name}.md"), 'r', encoding='utf-8') as f:
+            markdown = f.read()
+        with open(os.path.join(part_folder, f"{pdf_name}_meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        page_ids = [item.get('page_id', 0) for item in meta.get('table_of_contents', [])]
+        page_ids += [item.get('page_id', 0) for item in meta.get('page_stats', [])]
+        offset = start if page_ids and max(page_ids) < start else 0
+        for key in ('table_of_contents', 'page_stats'):
+            for item in meta.get(key, []):
+                if 'page_id' in item:
+                    item['page_id'] += offset
+
+        # Move images, renaming on collision and rewriting their links
+        for filename in sorted(os.listdir(part_folder)):
+            if filename in (f"{pdf_name}.md", f"{pdf_name}_meta.json"):
+                continue
+            target_name = filename
+            if os.path.exists(os.path.join(target_folder, target_name)):
+                target_name = f"part{index}{filename}"
+                markdown = markdown.replace(f"]({filename})", f"]({target_name})")
+            shutil.move(os.path.join(part_folder, filename), os.path.join(target_folder, target_name))
+
+        markdown_parts.append(markdown.strip())
+        if merged_meta is None:
+            merged_meta = meta
+        else:
+            for key in ('table_of_contents', 'page_stats'):
+                merged_meta.setdefault(key, []).extend(meta.get(key, []))
+
+    with open(os.path.join(target_folder, f"{pdf_name}.md"), 'w', encoding='utf-8') as f:
+        f.write("\n\n".join(markdown_parts) + "\n")
+    with open(os.path.join(target_folder, f"{pdf_name}_meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(merged_meta or {"table_of_contents": []}, f, ensure_ascii=False, indent=4)
+    logger.info(f"Merged {len(part_folders)} page ranges into {target_folder}")
+
+
+def _update_page_progress(progress: IngestProgress, line: str):
+    """Track page progress from marker's per-page progress bars"""
+    match = _PROGRESS_PATTERN.search(line)
+    if not match:
+        return
+    done, total = int(match.group(1)), int(match.group(2))
+    if progress.pages_total and total != progress.pages_total:
+        return  # Not a per-page progress bar
+    progress.pages_converted = max(progress.pages_converted, done)
+
 if __name__ == "__main__":
     pdf2md("../docs/74HC165D.pdf", "../docs/")
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""
+Index of the figures Marker extracts from each PDF.
+Ingestion registers every image with its page, a strong ETag (content hash)
+and a pre-generated downscaled thumbnail, so the web app can serve figures
+with long cache lifetimes and list them without walking the output folders.
+Thumbnails need Pillow (installed with marker-pdf); without it images are
+indexed and served at full size only.
+
+Usage (index documents converted before the index existed):
+    python -m utils.image_assets uploads docs
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from config import Config
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+THUMBNAIL_FOLDER = ".thumbs"
+# Marker names figures "_page_{page}_{block type}_{n}.{ext}", merged ranges may add a "part{i}" prefix
+_PAGE_PATTERN = re.compile(r"_page_(\d+)_")
+_COLUMNS = "pdf_name, filename, page_id, path, size, etag, width, height, thumbnail_path, thumbnail_etag"
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the index, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.images_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.images_path, timeout=30)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            " pdf_name TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " page_id INTEGER,"
+            " path TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " etag TEXT NOT NULL,"
+            " width INTEGER,"
+            " height INTEGER,"
+            " thumbnail_path TEXT,"
+            " thumbnail_etag TEXT,"
+            " registered_at REAL,"
+            " PRIMARY KEY (pdf_name, filename))"
+        )
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _file_sha256(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _make_thumbnail(path: str, thumbnail_path: str) -> Optional[tuple]:
+    """Write a downscaled JPEG copy; returns the original (width, height), or None without Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(path) as image:
+        size = image.size
+        image.thumbnail((Config.IMAGE_THUMBNAIL_SIZE, Config.IMAGE_THUMBNAIL_SIZE))
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        image.convert("RGB").save(thumbnail_path, "JPEG", quality=80, optimize=True)
+    return size
+
+
+def register_pdf(pdf_name: str, folder: str) -> int:
+    """
+    Index the images in a PDF's Marker output folder, replacing earlier entries for it
+
+    Returns:
+        int: number of images registered
+    """
+    if not os.path.isdir(folder):
+        remove_pdf(pdf_name)
+        return 0
+
+    entries = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        path = os.path.abspath(os.path.join(folder, filename))
+        etag = _file_sha256(path)[:32]
+        match = _PAGE_PATTERN.search(filename)
+        thumbnail_path = os.path.join(os.path.dirname(path), THUMBNAIL_FOLDER, os.path.splitext(filename)[0] + ".jpg")
+        try:
+            size = _make_thumbnail(path, thumbnail_path)
+        except Exception as e:
+            logger.warning(f"Could not create a thumbnail of {path}: {e}")
+            size = None
+        has_thumbnail = size is not None
+        entries.append((
+            pdf_name, filename, int(match.group(1)) if match else None, path, os.path.getsize(path), etag,
+            size[0] if has_thumbnail else None, size[1] if has_thumbnail else None,
+            thumbnail_path if has_thumbnail else None, f"{etag}-t" if has_thumbnail else None, time.time()
+        ))
+
+    with _connect() as conn:
+        conn.execute("DELETE FROM images WHERE pdf_name = ?", (pdf_name,))
+        conn.executemany(f"INSERT INTO images ({_COLUMNS}, registered_at) VALUES ({', '.join('?' * 11)})", entries)
+    logger.info(f"Registered {len(entries)} images of '{pdf_name}'")
+    return len(entries)
+
+
+def get(pdf_name: str, filename: str) -> Optional[dict]:
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT {_COLUMNS} FROM images WHERE pdf_name = ? AND filename = ?", (pdf_name, filename)
+        ).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def list_images(pdf_name: Optional[str] = None, page_id: Optional[int] = None) -> List[dict]:
+    """Indexed images, optionally of one PDF and page, in page order"""
+    conditions, params = [], []
+    if pdf_name is not None:
+        conditions.append("pdf_name = ?")
+        params.append(pdf_name)
+    if page_id is not None:
+        conditions.append("page_id = ?")
+        params.append(page_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with _connect() as conn:
+        rows = conn.execute(f"SELECT {_COLUMNS} FROM images {where} ORDER BY pdf_name, page_id, filename", params).fetchall()
+    return [_row_to_dict(row) for row in rows]
+
+
+def remove_pdf(pdf_name: str):
+    with _connect() as conn:
+        conn.execute("DELETE FROM images WHERE pdf_name = ?", (pdf_name,))
+
+
+def clear():
+    with _connect() as conn:
+        conn.execute("DELETE FROM images")
+
+
+def asset_url(entry: dict, thumbnail: bool = False) -> str:
+    """Versioned URL of an image; the version changes with the content, so it can be cached indefinitely"""
+    etag = entry["thumbnail_etag"] if thumbnail else entry["etag"]
+    return f"/assets/{entry['pdf_name']}/{entry['filename']}?v={etag}" + ("&size=thumb" if thumbnail else "")
+
+
+def _row_to_dict(row) -> dict:
+    return dict(zip([column.strip() for column in _COLUMNS.split(",")], row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the images of already converted documents")
+    parser.add_argument("directories", nargs="+", help="Directories holding {pdf_name}/{pdf_name}.md output folders")
+    args = parser.parse_args()
+    for directory in args.directories:
+        for pdf_name in sorted(os.listdir(directory)):
+            folder = os.path.join(directory, pdf_name)
+            if os.path.isfile(os.path.join(folder, f"{pdf_name}.md")):
+                register_pdf(pdf_name, folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Background ingestion job queue.
+Uploads are enqueued as jobs and processed by a bounded pool of worker tasks,
+so the upload request returns immediately and queries keep being served.
+
+Jobs live in a SQLite table shared by every web worker process: any worker
+accepts uploads and answers status and cancel requests, while only the worker
+holding the ingest lock file runs jobs, so the number of PDFs converted at
+once does not grow with the number of web workers. If that worker exits, its
+running jobs go back to the queue and another worker takes over.
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from config import Config
+from utils.colored_logger import get_colored_logger
+from utils.progress import IngestCancelled, IngestProgress
+
+logger = get_colored_logger(__name__)
+
+_COLUMNS = "id, pdf_path, filename, status, error, created_at, started_at, finished_at, progress"
+_FINISHED = "('completed', 'failed', 'cancelled')"
+# Seconds between attempts of a non-leading worker to take over the ingest lock
+_LEADER_RETRY_SECONDS = 5
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the job table, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.jobs_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.jobs_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " pdf_path TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " progress TEXT,"
+            " cancel_requested INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);"
+        )
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+@dataclass
+class IngestJob:
+    """One PDF waiting for or undergoing ingestion"""
+    id: str
+    pdf_path: str
+    filename: str
+    status: str = "queued"  # queued, running, completed, failed, cancelled
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    progress: IngestProgress = field(default_factory=IngestProgress)
+    # Last progress written to the job table, for jobs run by another process
+    stored_progress: Optional[dict] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    @classmethod
+    def from_row(cls, row) -> "IngestJob":
+        job = cls(*row[:8])
+        job.stored_progress = json.loads(row[8]) if row[8] else None
+        return job
+
+    def to_dict(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": round(end - self.started_at, 2) if self.started_at else None,
+            "progress": self.stored_progress if self.stored_progress is not None else self.progress.to_dict(),
+        }
+
+
+class IngestJobQueue:
+    """Bounded queue of ingestion jobs, shared across processes and served by a fixed number of worker tasks"""
+
+    def __init__(
+        self,
+        workers: int = Config.INGEST_WORKERS,
+        max_queued: int = Config.INGEST_QUEUE_SIZE,
+        max_history: int = Config.INGEST_JOB_HISTORY
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_history = max_history
+        # Jobs claimed by this process and the tasks running them
+        self._jobs: Dict[str, IngestJob] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self._leader_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self):
+        """Start competing for the ingest lock on the running event loop; the winner runs the worker tasks"""
+        if self._leader_task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._leader_task = asyncio.create_task(self._lead())
+
+    async def stop(self):
+        """Stop the workers; jobs running here are returned to the queue for the next leading process"""
+        if self._leader_task is None:
+            return
+        self._leader_task.cancel()
+        await asyncio.gather(self._leader_task, return_exceptions=True)
+        self._leader_task = None
+
+    async def submit(self, pdf_path: str, filename: str) -> IngestJob:
+        """
+        Enqueue a PDF for ingestion
+
+        Raises:
+            asyncio.QueueFull: If too many jobs are already waiting
+        """
+        job = IngestJob(id=uuid.uuid4().hex, pdf_path=pdf_path, filename=filename)
+        if not await asyncio.to_thread(self._insert, job):
+            raise asyncio.QueueFull()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logger.info(f"Queued ingestion job {job.id} for {filename}")
+        return job
+
+    @property
+    def busy(self) -> bool:
+        """Whether any job is running or waiting, in any process"""
+        if self._running:
+            return True
+        with _connect() as conn:
+            return conn.execute("SELECT 1 FROM jobs WHERE status IN ('queued', 'running') LIMIT 1").fetchone() is not None
+
+    async def get(self, job_id: str) -> Optional[IngestJob]:
+        if job_id in self._jobs:
+            return self._jobs[job_id]
+        return await asyncio.to_thread(self._load, job_id)
+
+    async def list(self) -> List[IngestJob]:
+        jobs = await asyncio.to_thread(self._load_all)
+        return [self._jobs.get(job.id, job) for job in jobs]
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; returns False if it is unknown or already finished"""
+        if job_id in self._jobs:
+            self._cancel_local(job_id)
+            return True
+        cancelled = await asyncio.to_thread(self._request_cancel, job_id)
+        if cancelled:
+            logger.info(f"Cancellation requested for ingestion job {job_id}")
+        return cancelled
+
+    def _insert(self, job: IngestJob) -> bool:
+        with _connect() as conn:
+            # One statement, so concurrent submits from several processes cannot overfill the queue
+            cursor = conn.execute(
+                "INSERT INTO jobs (id, pdf_path, filename, status, created_at)"
+                " SELECT ?, ?, ?, 'queued', ? WHERE (SELECT COUNT(*) FROM jobs WHERE status = 'queued') < ?",
+                (job.id, job.pdf_path, job.filename, job.created_at, self.max_queued)
+            )
+            return cursor.rowcount > 0
+
+    def _load(self, job_id: str) -> Optional[IngestJob]:
+        with _connect() as conn:
+            row = conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return IngestJob.from_row(row) if row else None
+
+    def _load_all(self) -> List[IngestJob]:
+        with _connect() as conn:
+            rows = conn.execute(f"SELECT {_COLUMNS} FROM jobs ORDER BY created_at DESC").fetchall()
+        return [IngestJob.from_row(row) for row in rows]
+
+    def _request_cancel(self, job_id: str) -> bool:
+        with _connect() as conn:
+            row = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued' RETURNING pdf_path",
+                (time.time(), job_id)
+            ).fetchone()
+            if row is None:
+                # Running in the leading process, which polls for the flag
+                cursor = conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+                return cursor.rowcount > 0
+        self._discard_upload(row[0])
+        return True
+
+    def _discard_upload(self, pdf_path: str):
+        """Remove the upload of a cancelled queued job, unless another job or the ingested document still needs it"""
+        from utils.pdf_manage import has_pdf
+
+        with _connect() as conn:
+            pending = conn.execute(
+                "SELECT 1 FROM jobs WHERE pdf_path = ? AND status IN ('queued', 'running') LIMIT 1", (pdf_path,)
+            ).fetchone()
+        # An ingested document of the same name makes the file its current revision
+        if pending is not None or has_pdf(os.path.splitext(os.path.basename(pdf_path))[0]):
+            return
+        try:
+            os.remove(pdf_path)
+            logger.info(f"Removed upload of cancelled job: {pdf_path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove upload {pdf_path}: {e}")
+
+    def _cancel_local(self, job_id: str):
+        job = self._jobs[job_id]
+        job.progress.cancel()
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        logger.info(f"Cancellation requested for ingestion job {job_id}")
+
+    def _claim(self) -> Optional[IngestJob]:
+        """Mark the oldest queued job as running and take it"""
+        with _connect() as conn:
+            row = conn.execute(
+                f"UPDATE jobs SET status = 'running', started_at = ?"
+                f" WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)"
+                f" RETURNING {_COLUMNS}",
+                (time.time(),)
+            ).fetchone()
+        if row is None:
+            return None
+        job = IngestJob.from_row(row)
+        job.stored_progress = None
+        self._jobs[job.id] = job
+        return job
+
+    def _sync(self, progress: Dict[str, str]) -> List[str]:
+        """Publish the progress of local jobs; returns the ids other processes asked to cancel"""
+        if not progress:
+            return []
+        with _connect() as conn:
+            conn.executemany("UPDATE jobs SET progress = ? WHERE id = ?", [(data, job_id) for job_id, data in progress.items()])
+            return [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({', '.join('?' * len(progress))})",
+                list(progress)
+            )]
+
+    def _requeue(self, job_ids: Optional[List[str]] = None):
+        """Put running jobs (all of them, or the given ones) back in the queue"""
+        with _connect() as conn:
+            if job_ids is not None:
+                conn.executemany(
+                    "UPDATE jobs SET status = 'queued', started_at = NULL WHERE id = ? AND status = 'running'",
+                    [(job_id,) for job_id in job_ids]
+                )
+            else:
+                conn.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+
+    def _store_finished(self, job: IngestJob):
+        with _connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, progress = ? WHERE id = ?",
+                (job.status, job.error, job.finished_at, json.dumps(job.progress.to_dict(), ensure_ascii=False), job.id)
+            )
+            # Drop the oldest finished jobs beyond max_history
+            conn.execute(
+                f"DELETE FROM jobs WHERE status IN {_FINISHED} AND id NOT IN"
+                f" (SELECT id FROM jobs WHERE status IN {_FINISHED} ORDER BY finished_at DESC LIMIT ?)",
+                (self.max_history,)
+            )
+
+    async def _lead(self):
+        lock_path = Config.DATABASE.jobs_path + ".lock"
+        os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+        with open(lock_path, 'a') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(_LEADER_RETRY_SECONDS)
+
+            # Whoever held the lock before is gone, jobs it left running start over
+            await asyncio.to_thread(self._requeue)
+            worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+            logger.info(f"Started {self.workers} ingestion workers in process {os.getpid()}")
+            try:
+                while True:
+                    await asyncio.sleep(Config.INGEST_POLL_INTERVAL)
+                    progress = {
+                        job_id: json.dumps(job.progress.to_dict(), ensure_ascii=False)
+                        for job_id, job in self._jobs.items()
+                    }
+                    for job_id in await asyncio.to_thread(self._sync, progress):
+                        if job_id in self._jobs and not self._jobs[job_id].progress.cancelled:
+                            self._cancel_local(job_id)
+            finally:
+                for task in worker_tasks:
+                    task.cancel()
+                await asyncio.gather(*worker_tasks, return_exceptions=True)
+                unfinished = [job_id for job_id, job in self._jobs.items() if not job.finished]
+                if unfinished:
+                    await asyncio.shield(asyncio.to_thread(self._requeue, unfinished))
+                    logger.info(f"Returned {len(unfinished)} running ingestion jobs to the queue")
+                self._jobs.clear()
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    async def _worker(self, index: int):
+        from utils.pdf_manage import insert_pdf
+
+        while True:
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), Config.INGEST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(insert_pdf(job.pdf_path, progress=job.progress))
+            self._running[job.id] = task
+            try:
+                success = await task
+                if success:
+                    await self._mark_finished(job, "completed")
+                else:
+                    await self._mark_finished(job, "failed", "Failed to process PDF")
+            except (asyncio.CancelledError, IngestCancelled):
+                if not job.progress.cancelled:
+                    raise  # The worker itself is being stopped, the job is requeued
+                await self._mark_finished(job, "cancelled")
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                logger.error(f"Ingestion job {job.id} failed: {e}")
+                await self._mark_finished(job, "failed", str(e))
+            finally:
+                self._running.pop(job.id, None)
+
+    async def _mark_finished(self, job: IngestJob, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        await asyncio.shield(asyncio.to_thread(self._store_finished, job))
+        self._jobs.pop(job.id, None)
+        logger.info(f"Ingestion job {job.id} {status}")
@@ -0,0 +1,309 @@
+"""
+Warm pool of Marker converter processes.
+Each worker loads the layout, OCR and recognition models once and then serves
+conversion jobs, instead of paying the model start-up cost for every PDF as a
+fresh marker_single subprocess does. Workers are recycled once their resident
+memory grows past a limit.
+"""
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from config import Config
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+
+def _rss_mb() -> float:
+    """Resident memory of the current process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def convert_with_models(
+        models: dict,
+        pdf_path: str,
+        output_dir: str,
+        page_range: Optional[str] = None,
+        paginate: bool = False
+):
+    """
+    Convert one PDF with already loaded Marker models.
+    Output layout matches marker_single: {output_dir}/{name}/{name}.md, {name}_meta.json and images.
+    With paginate, every page starts with Marker's "{page_id}-----" separator line.
+    """
+    from marker.config.parser import ConfigParser
+    from marker.converters.pdf import PdfConverter
+    from marker.output import save_output
+
+    options = {"output_format": "markdown", "output_dir": output_dir}
+    if page_range:
+        options["page_range"] = page_range
+    if paginate:
+        options["paginate_output"] = True
+    config_parser = ConfigParser(options)
+
+    converter = PdfConverter(
+        config=config_parser.generate_config_dict(),
+        artifact_dict=models,
+        processor_list=config_parser.get_processors(),
+        renderer=config_parser.get_renderer(),
+        llm_service=config_parser.get_llm_service()
+    )
+    rendered = converter(pdf_path)
+
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    out_folder = os.path.join(output_dir, base_name)
+    os.makedirs(out_folder, exist_ok=True)
+    save_output(rendered, out_folder, base_name)
+
+
+def _worker_main(worker_id: int, tasks, results, model_dir: str, max_rss_mb: float, max_jobs: int, threads: int):
+    """Worker process entry point: load models once, then convert until told to stop or recycled"""
+    os.environ['MODEL_CACHE_DIR'] = model_dir
+    # Share the CPU cores between workers instead of every worker using all of them
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    os.environ.setdefault('MKL_NUM_THREADS', str(threads))
+    try:
+        from marker.models import create_model_dict
+        models = create_model_dict()
+    except Exception as e:
+        results.put(("fatal", worker_id, None, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", worker_id, None, None))
+
+    jobs_done = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, pdf_path, output_dir, page_range, paginate = task
+        try:
+            convert_with_models(models, pdf_path, output_dir, page_range, paginate)
+            outcome = ("done", worker_id, job_id, None)
+        except Exception as e:
+            outcome = ("error", worker_id, job_id, f"{type(e).__name__}: {e}")
+
+        jobs_done += 1
+        rss = _rss_mb()
+        recycle = rss > max_rss_mb or (max_jobs and jobs_done >= max_jobs)
+        if recycle:
+            # Announce the exit before the result so no new job is dispatched to this worker
+            results.put(("recycle", worker_id, None, f"rss={rss:.0f}MB, jobs={jobs_done}"))
+        results.put(outcome)
+        if recycle:
+            return
+
+
+class _Worker:
+    def __init__(self, worker_id: int, process: multiprocessing.Process, tasks):
+        self.id = worker_id
+        self.process = process
+        self.tasks = tasks
+        self.ready = False
+        self.job_id: Optional[int] = None
+
+
+class MarkerPool:
+    """
+    Fixed-size pool of warm Marker worker processes.
+
+    Jobs are dispatched by a background thread to idle workers; a worker that
+    exceeds max_rss_mb (or max_jobs) after a job exits and is replaced.
+    Cancelling a running job terminates its worker, which is then replaced.
+    """
+
+    def __init__(
+        self,
+        size: int = Config.MARKER_POOL_SIZE,
+        max_rss_mb: float = Config.MARKER_POOL_MAX_RSS_MB,
+        max_jobs: int = Config.MARKER_POOL_MAX_JOBS
+    ):
+        self.size = size
+        self.max_rss_mb = max_rss_mb
+        self.max_jobs = max_jobs
+        self.threads_per_worker = max(1, (os.cpu_count() or 1) // max(1, size))
+        self.broken: Optional[str] = None
+        self._ctx = multiprocessing.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._workers: Dict[int, _Worker] = {}
+        self._pending: Deque[Tuple[int, str, str, Optional[str], bool]] = deque()
+        self._futures: Dict[int, concurrent.futures.Future] = {}
+        self._job_ids = itertools.count()
+        self._worker_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            for _ in range(self.size):
+                self._spawn()
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="marker-pool", daemon=True)
+            self._dispatcher.start()
+        logger.info(f"Started Marker pool with {self.size} workers")
+
+    def submit(
+            self,
+            pdf_path: str,
+            output_dir: str,
+            page_range: Optional[str] = None,
+            paginate: bool = False
+    ) -> Tuple[int, concurrent.futures.Future]:
+        """
+        Queue a conversion
+
+        Returns:
+            (job id, future resolved when the conversion finishes)
+        """
+        self.start()
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.broken:
+                future.set_exception(RuntimeError(f"Marker pool unavailable: {self.broken}"))
+                return -1, future
+            job_id = next(self._job_ids)
+            self._futures[job_id] = future
+            self._pending.append((job_id, pdf_path, output_dir, page_range, paginate))
+            self._dispatch()
+        return job_id, future
+
+    def cancel(self, job_id: int):
+        """Cancel a queued or running conversion"""
+        with self._lock:
+            future = self._futures.pop(job_id, None)
+            if future is None:
+                return
+            self._pending = deque(task for task in self._pending if task[0] != job_id)
+            for worker in list(self._workers.values()):
+                if worker.job_id == job_id:
+                    logger.info(f"Terminating Marker worker {worker.id} to cancel job {job_id}")
+                    worker.process.terminate()
+                    self._workers.pop(worker.id)
+                    self._spawn()
+            future.cancel()
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            for worker in self._workers.values():
+                worker.tasks.put(None)
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+            self._pending.clear()
+        for worker in list(self._workers.values()):
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self._workers.clear()
+
+    def _spawn(self):
+        worker_id = next(self._worker_ids)
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, tasks, self._results, Config.MODEL_DIR, self.max_rss_mb, self.max_jobs, self.threads_per_worker),
+            name=f"marker-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._workers[worker_id] = _Worker(worker_id, process, tasks)
+
+    def _dispatch(self):
+        """Hand pending jobs to idle workers; caller holds the lock"""
+        for worker in self._workers.values():
+            if not self._pending:
+                return
+            if worker.ready and worker.job_id is None:
+                task = self._pending.popleft()
+                worker.job_id = task[0]
+                worker.tasks.put(task)
+
+    def _finish(self, job_id: Optional[int], error: Optional[str] = None):
+        future = self._futures.pop(job_id, None) if job_id is not None else None
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(RuntimeError(f"Marker conversion failed: {error}"))
+        else:
+            future.set_result(None)
+
+    def _dispatch_loop(self):
+        while not self._stopped:
+            try:
+                kind, worker_id, job_id, detail = self._results.get(timeout=1.0)
+            except queue.Empty:
+                kind = None
+
+            with self._lock:
+                if self._stopped:
+                    return
+                worker = self._workers.get(worker_id) if kind else None
+                if kind == "ready" and worker:
+                    worker.ready = True
+                elif kind in ("done", "error"):
+                    self._finish(job_id, detail if kind == "error" else None)
+                    if worker and worker.job_id == job_id:
+                        worker.job_id = None
+                elif kind == "recycle":
+                    logger.info(f"Recycling Marker worker {worker_id} ({detail})")
+                    if worker:
+                        self._workers.pop(worker_id)
+                        worker.process.join(timeout=10)
+                        self._spawn()
+                elif kind == "fatal":
+                    logger.error(f"Marker worker {worker_id} failed to load models: {detail}")
+                    self.broken = detail
+                    self._workers.pop(worker_id, None)
+                    for pending_id, *_ in self._pending:
+                        self._finish(pending_id, detail)
+                    self._pending.clear()
+
+                # Replace workers that died without saying goodbye (e.g. OOM kill)
+                for dead in [w for w in self._workers.values() if w.process.exitcode is not None]:
+                    logger.warning(f"Marker worker {dead.id} exited with code {dead.process.exitcode}")
+                    self._workers.pop(dead.id)
+                    self._finish(dead.job_id, f"worker exited with code {dead.process.exitcode}")
+                    if not self.broken:
+                        self._spawn()
+
+                self._dispatch()
+
+
+_pool: Optional[MarkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_marker_pool() -> MarkerPool:
+    """Get the process-wide Marker pool, starting it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = MarkerPool()
+            _pool.start()
+        return _pool
+
+
+def shutdown_marker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,196 @@
+"""
+In-process metrics: counters for operational events (cancelled streams and
+the like), latency histograms and gauges. Metrics are keyed by name and a set
+of labels and are safe to update from worker threads; snapshot() returns the
+counters for the JSON metrics endpoint and render() all metrics in the
+Prometheus text exposition format.
+
+Values are per process: with several web workers every worker reports its own.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from config import Config
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_lock = threading.Lock()
+_counters: Dict[_Key, float] = {}
+_gauges: Dict[_Key, float] = {}
+_histograms: Dict[_Key, "_Histogram"] = {}
+_collectors: List[Callable[[], None]] = []
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _key(name: str, labels: dict) -> _Key:
+    return name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    """Add value to the counter name{labels}"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels: str):
+    """Set the gauge name{labels}"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def add_gauge(name: str, value: float, **labels: str):
+    """Add value (which may be negative) to the gauge name{labels}"""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels: str):
+    """Record value in the histogram name{labels} (latency buckets from METRICS_LATENCY_BUCKETS)"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram(tuple(Config.METRICS_LATENCY_BUCKETS))
+        histogram.observe(value)
+
+
+def outcome_of(error: BaseException) -> str:
+    """Outcome label of a failed operation; exceptions may name their own with a metrics_outcome attribute"""
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    return getattr(error, "metrics_outcome", "error")
+
+
+class Timer:
+    """A running timed() block; code that handles its own errors sets outcome itself"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.outcome = "ok"
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+@contextmanager
+def timed(name: str, **labels: str) -> Iterator[Timer]:
+    """
+    Time the block into the histogram {name}_seconds{labels, outcome} and
+    count it in the gauge {name}_in_flight{labels} while it runs
+    """
+    add_gauge(f"{name}_in_flight", 1, **labels)
+    timer = Timer()
+    try:
+        yield timer
+    except BaseException as e:
+        timer.outcome = outcome_of(e)
+        raise
+    finally:
+        observe(f"{name}_seconds", timer.elapsed, outcome=timer.outcome, **labels)
+        add_gauge(f"{name}_in_flight", -1, **labels)
+
+
+def cache_lookup(cache: str, hit: bool, count: int = 1):
+    """Count lookups of a cache (or coalescing layer) as hits or misses"""
+    inc("cache_requests_total", count, cache=cache, result="hit" if hit else "miss")
+
+
+def register_collector(collector: Callable[[], None]):
+    """Call collector before every render(), e.g. to set gauges read from other components"""
+    _collectors.append(collector)
+
+
+def snapshot() -> List[dict]:
+    """Current counter values as [{"name", "labels", "value"}]"""
+    with _lock:
+        items = sorted(_counters.items())
+    return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in items]
+
+
+def cache_hit_rates() -> Dict[str, dict]:
+    """Hits, misses and hit rate of every cache counted with cache_lookup"""
+    rates: Dict[str, dict] = {}
+    for entry in snapshot():
+        if entry["name"] == "cache_requests_total":
+            counts = rates.setdefault(entry["labels"]["cache"], {"hit": 0, "miss": 0})
+            counts[entry["labels"]["result"]] += entry["value"]
+    for counts in rates.values():
+        total = counts["hit"] + counts["miss"]
+        counts["hit_rate"] = round(counts["hit"] / total, 4) if total else None
+    return rates
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+    for collector in list(_collectors):
+        collector()
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted(
+            (key, (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count))
+            for key, histogram in _histograms.items()
+        )
+
+    lines = []
+    typed = set()
+
+    def declare(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), value in gauges:
+        declare(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), (buckets, counts, total, count) in histograms:
+        declare(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -1,14 +1,26 @@
 import os
 import ast
-from pymilvus import MilvusClient
+import asyncio
+from typing import Optional
 
 from config import Config
-from rag_modules import get_database, insert, query
-from utils import chunk, convert
+
+from rag_modules import doc_registry, get_database, insert, query, text_store
+from utils import admission, chunk, convert, image_assets, metrics, session_store, usage
 from utils.colored_logger import get_colored_logger
+from utils.progress import IngestProgress
+from utils.singleflight import SingleFlight
 
 logger = get_colored_logger(__name__)
 
+# 相同问题和PDF集合的并发查询共享同一条检索/生成流水线
+_query_flight = SingleFlight("query")
+_query_stream_flight = SingleFlight("query_stream")
+
+
+def _query_key(question: str, active_pdf_names: list):
+    return (question, tuple(sorted(set(active_pdf_names))))
+
 def get_pdf_names():
     """
     Fetches all PDF names from the Milvus database.
@@ -17,23 +29,91 @@ def get_pdf_names():
         set: A set of PDF names.
     """
     logger.info("Fetching PDF names from the database...")
-    client = MilvusClient(uri=Config.DATABASE.path)
-    results = client.query(  
-        collection_name=Config.DATABASE.collection_name,  
-        filter="id >= 0",  # matches all records since auto_id starts from 0  
-        output_fields=["pdf_name"],  
-    )  
+    results = []
+    for shard in get_database.shards():
+        client = get_database.connect(shard)
+        if not client.has_collection(collection_name=shard.collection_name):
+            continue
+        results += client.query(  
+            collection_name=shard.collection_name,  
+            filter="id >= 0",  # matches all records since auto_id starts from 0  
+            output_fields=["pdf_name"],  
+        )  
     
     logger.info(f"Fetched {len(results)} results from the database.")
     pdf_names_set = set(result["pdf_name"] for result in results)
     return pdf_names_set
 
-async def insert_pdf(pdf_path: str):
+def has_pdf(pdf_name: str) -> bool:
+    """
+    Checks whether any chunk of a PDF is stored, reading at most one row of its shard.
+
+    Args:
+        pdf_name: Name of the PDF (without extension)
+
+    Returns:
+        bool: True if the PDF is in the database
+    """
+    shard = get_database.shard_for(pdf_name)
+    client = get_database.connect(shard)
+    if not client.has_collection(collection_name=shard.collection_name):
+        return False
+    rows = client.query(
+        collection_name=shard.collection_name,
+        filter=f'pdf_name == "{pdf_name}"',
+        output_fields=["id"],
+        limit=1,
+    )
+    return len(rows) > 0
+
+async def insert_pdf(pdf_path: str, progress: Optional[IngestProgress] = None, output_dir: Optional[str] = None):
+    """
+    Converts a PDF, chunks it and inserts the chunks into the database.
+    Blocking work runs in worker threads so the event loop stays responsive.
+    
+    Args:
+        pdf_path: Path of the PDF to ingest
+        progress: Optional progress tracker, also used for cancellation
+        output_dir: Where converted Markdown is written, defaults to the PDF's directory
+    
+    Returns:
+        bool: True if successful
+    """
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    with metrics.timed("rag_stage", stage="ingest", model="") as timer:
+        async with usage.track([pdf_name]):
+            success = await _insert_pdf(pdf_path, progress, output_dir)
+        if not success:
+            timer.outcome = "error"
+        return success
+
+
+async def _insert_pdf(pdf_path: str, progress: Optional[IngestProgress], output_dir: Optional[str]) -> bool:
+    if progress is None:
+        progress = IngestProgress()
 
-    output_dir = os.path.dirname(pdf_path) + "/"
+    output_dir = output_dir or os.path.dirname(pdf_path) + "/"
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+
+    # 相同内容的PDF已经导入过则直接跳过
+    sha256 = await asyncio.to_thread(doc_registry.file_sha256, pdf_path)
+    existing = await asyncio.to_thread(doc_registry.find_by_hash, sha256)
+    duplicate = existing is not None and (
+        existing["pdf_name"] == pdf_name or await asyncio.to_thread(has_pdf, existing["pdf_name"])
+    )
+    metrics.cache_lookup("document", duplicate)
+    if duplicate:
+        progress.detail = f"Identical to already ingested '{existing['pdf_name']}'"
+        progress.set_stage("done")
+        logger.info(f"Skipping {pdf_path}: {progress.detail}")
+        return True
+
     logger.info(f"Converting PDF: {pdf_path}, with output directory: {output_dir}")
-    convert.pdf2md(pdf_path=pdf_path, output_dir=output_dir)
+    progress.pages_total = await asyncio.to_thread(convert.count_pages, pdf_path)
+    progress.set_stage("converting")
+    with metrics.timed("rag_stage", stage="convert", model=Config.CONVERT_MODE):
+        async with admission.stage("convert"):
+            await convert.pdf2md_async(pdf_path=pdf_path, output_dir=output_dir, progress=progress)
 
     logger.info(f"Converted files saved to {output_dir}")
 
@@ -44,16 +124,32 @@ async def insert_pdf(pdf_path: str):
         logger.error(f"Conversion failed. Missing files: {markdown_file} or {metadata_file}")
         return False
 
-    chunk_res = chunk.load_and_chunk(markdown_file, metadata_file)
+    progress.check_cancelled()
+    progress.set_stage("chunking")
+    # Chunks are streamed from the memory-mapped Markdown into the insert pipeline
+    chunk_res = chunk.iter_chunks(markdown_file, metadata_file)
 
-    client = get_database.get_database_client()
+    shard = get_database.shard_for(pdf_name)
+    client = await asyncio.to_thread(get_database.get_database_client, shard)
 
     logger.info(f"Collection list: {client.list_collections()}")
-    logger.info(f"Collection stats: {client.get_collection_stats(collection_name=Config.DATABASE.collection_name)}")
+    logger.info(f"Collection stats: {client.get_collection_stats(collection_name=shard.collection_name)}")
     # print(chunk_res)
 
-    success = await insert.insert_data(chunk_res, pdf_name)
+    success = await insert.insert_data(chunk_res, pdf_name, progress=progress)
     if success:
+        # Without stored chunks the same bytes must not count as a duplicate next time
+        if progress.chunks_inserted + progress.chunks_unchanged > 0:
+            await asyncio.to_thread(
+                doc_registry.record, pdf_name, sha256, os.path.basename(pdf_path), os.path.getsize(pdf_path)
+            )
+        else:
+            logger.warning(f"No chunks stored for {pdf_name}, not recording it as ingested")
+        try:
+            await asyncio.to_thread(image_assets.register_pdf, pdf_name, os.path.join(output_dir, pdf_name))
+        except Exception as e:
+            logger.warning(f"Could not index images of {pdf_name}: {e}")
+        progress.set_stage("done")
         logger.info(f"Successfully inserted PDF: {pdf_name}")
         return True
     else:
@@ -61,20 +157,22 @@ async def insert_pdf(pdf_path: str):
         return False
 
 
-def set_active_pdfs(pdf_names: list):
+def set_active_pdfs(pdf_names: list, session_id: Optional[str] = None):
     """
     Sets which PDFs should be currently used for querying.
-    This is stored in memory for this session or can be persisted.
+    With a session id the selection is stored in the shared session store,
+    so every web worker serving that session sees it.
     
     Args:
         pdf_names: List of PDF names to set as active
+        session_id: Browser session the selection belongs to
     
     Returns:
         bool: True if successful
     """
     try:
-        # For now, we'll use a simple approach where the caller manages this
-        # In a real implementation, this could be stored in a session or config file
+        if session_id is not None:
+            session_store.set_active_pdfs(session_id, pdf_names)
         logger.info(f"Set active PDFs: {pdf_names}")
         return True
     except Exception as e:
@@ -85,6 +183,7 @@ def set_active_pdfs(pdf_names: list):
 async def query_pdfs_async(question: str, active_pdf_names: list):
     """
     Async version of query_pdfs for use with FastAPI.
+    Concurrent identical queries share one pipeline run.
     
     Args:
         question: User's question
@@ -93,34 +192,45 @@ async def query_pdfs_async(question: str, active_pdf_names: list):
     Returns:
         str: Generated answer
     """
-    try:
-        from rag_modules.search import search_async
-        from rag_modules import reranker, refer
-        from rag_modules.query import split_query, generate_answer
-        
-        logger.info(f"Querying: '{question}' using PDFs: {active_pdf_names}")
+    return await _query_flight.do(
+        _query_key(question, active_pdf_names),
+        lambda: _query_pdfs_async(question, active_pdf_names)
+    )
 
-        split_queries = ast.literal_eval(query.split_query(question))
-        split_queries.insert(0, question)  # Ensure the original question is included
 
-        logger.info(f"Split Query Success: {split_queries}")
+async def _query_pdfs_async(question: str, active_pdf_names: list):
+    with metrics.timed("rag_stage", stage="query", model="") as timer:
+        try:
+            from rag_modules import refer
 
-        # Get references and rerank (async)
-        references = await refer.get_reference(split_query=split_queries, included_pdfs=active_pdf_names)
-        
-        # Generate final answer
-        answer = generate_answer(split_queries, references)
-        
-        return answer
-        
-    except Exception as e:
-        logger.error(f"Error querying PDFs: {e}")
-        return f"Error occurred while processing your query: {e}"
+            logger.info(f"Querying: '{question}' using PDFs: {active_pdf_names}")
+
+            split_queries = ast.literal_eval(await query.split_query_async(question))
+            split_queries.insert(0, question)  # Ensure the original question is included
+
+            logger.info(f"Split Query Success: {split_queries}")
+
+            # Get references and rerank (async)
+            references = await refer.get_reference(split_query=split_queries, included_pdfs=active_pdf_names)
+
+            # Generate final answer
+            answer = await query.generate_answer_async(split_queries, references)
+
+            return answer
+
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Error querying PDFs: {e}")
+            timer.outcome = "error"
+            return f"Error occurred while processing your query: {e}"
 
 
 async def query_pdfs_stream_async(question: str, active_pdf_names: list):
     """
     Streaming async version of query_pdfs for use with FastAPI.
+    Concurrent identical queries share one pipeline run and every
+    subscriber receives the full answer stream.
     
     Args:
         question: User's question
@@ -129,39 +239,47 @@ async def query_pdfs_stream_async(question: str, active_pdf_names: list):
     Yields:
         str: Chunks of generated answer
     """
-    try:
-        from rag_modules.search import search_async
-        from rag_modules import reranker, refer
-        from rag_modules.query import split_query, generate_answer_stream
-        
-        logger.info(f"Streaming query: '{question}' using PDFs: {active_pdf_names}")
+    async for chunk in _query_stream_flight.stream(
+        _query_key(question, active_pdf_names),
+        lambda: _query_pdfs_stream_async(question, active_pdf_names)
+    ):
+        yield chunk
 
-        # Split query (this can be blocking, but it's usually fast)
-        split_queries = ast.literal_eval(query.split_query(question))
-        split_queries.insert(0, question)  # Ensure the original question is included
 
-        logger.info(f"Split Query Success: {split_queries}")
-        
-        # Get references and rerank (async) - this is the potentially slow part
-        references = await refer.get_reference(split_query=split_queries, included_pdfs=active_pdf_names)
-        logger.info(f"Retrieved {len(references)} references")
-        
-        # Generate streaming answer - this should be truly streaming
-        chunk_count = 0
-        for chunk in generate_answer_stream(split_queries, references):
-            if chunk:
-                chunk_count += 1
-                logger.debug(f"Yielding chunk {chunk_count}: {chunk[:50]}...")
-                yield chunk
-                # Add small delay to ensure true streaming behavior
-                import asyncio
-                await asyncio.sleep(0.01)  # Small delay to prevent overwhelming
-        
-        logger.info(f"Streaming completed with {chunk_count} chunks")
-        
-    except Exception as e:
-        logger.error(f"Error in streaming query: {e}")
-        yield f"Error occurred while processing your query: {e}"
+async def _query_pdfs_stream_async(question: str, active_pdf_names: list):
+    with metrics.timed("rag_stage", stage="query_stream", model="") as timer:
+        try:
+            from rag_modules import refer
+
+            logger.info(f"Streaming query: '{question}' using PDFs: {active_pdf_names}")
+
+            split_queries = ast.literal_eval(await query.split_query_async(question))
+            split_queries.insert(0, question)  # Ensure the original question is included
+
+            logger.info(f"Split Query Success: {split_queries}")
+
+            # Get references and rerank (async) - this is the potentially slow part
+            references = await refer.get_reference(split_query=split_queries, included_pdfs=active_pdf_names)
+            logger.info(f"Retrieved {len(references)} references")
+
+            # Generate streaming answer
+            chunk_count = 0
+            async for chunk in query.generate_answer_stream_async(split_queries, references):
+                if chunk:
+                    chunk_count += 1
+                    if chunk_count == 1:
+                        metrics.observe("rag_stage_seconds", timer.elapsed, stage="query_first_token", model="", outcome="ok")
+                    logger.debug(f"Yielding chunk {chunk_count}: {chunk[:50]}...")
+                    yield chunk
+
+            logger.info(f"Streaming completed with {chunk_count} chunks")
+
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"Error in streaming query: {e}")
+            timer.outcome = "error"
+            yield f"Error occurred while processing your query: {e}"
 
 
 def delete_pdf(pdf_name: str):
@@ -177,12 +295,13 @@ def delete_pdf(pdf_name: str):
     try:
         logger.info(f"Attempting to delete PDF: {pdf_name}")
         
-        # Create Milvus client
-        client = MilvusClient(uri=Config.DATABASE.path)
+        # Create Milvus client for the shard holding the PDF
+        shard = get_database.shard_for(pdf_name)
+        client = get_database.connect(shard)
         
         # Check if collection exists
-        if not client.has_collection(collection_name=Config.DATABASE.collection_name):
-            logger.warning(f"Collection {Config.DATABASE.collection_name} does not exist")
+        if not client.has_collection(collection_name=shard.collection_name):
+            logger.warning(f"Collection {shard.collection_name} does not exist")
             return False
         
         # Check if PDF exists in database
@@ -191,11 +310,19 @@ def delete_pdf(pdf_name: str):
             logger.warning(f"PDF '{pdf_name}' not found in database")
             return False
         
+        # Chunk texts in the side store are keyed by row id, collect the ids before deleting
+        row_ids = []
+        if not get_database.stores_text_inline(client, shard):
+            row_ids = [
+                row["id"] for row in get_database.iter_rows(client, f'pdf_name == "{pdf_name}"', ["id"], shard=shard)
+            ]
+
         # Delete all records associated with this PDF
         res = client.delete(
-            collection_name=Config.DATABASE.collection_name,
+            collection_name=shard.collection_name,
             filter=f'pdf_name == "{pdf_name}"'
         )
+        text_store.delete_many(row_ids, shard)
         
         # Handle different response formats from Milvus
         delete_count = "unknown"
@@ -205,6 +332,9 @@ def delete_pdf(pdf_name: str):
             delete_count = len(res)
         
         logger.info(f"Successfully deleted PDF '{pdf_name}' from database. Deleted {delete_count} records.")
+        doc_registry.remove(pdf_name)
+        image_assets.remove_pdf(pdf_name)
+        session_store.remove_pdf(pdf_name)
         
         # Optionally, also delete the physical files
         try:
@@ -0,0 +1,275 @@
+"""
+Text-layer fast path for PDF conversion.
+Extracts text and the outline with pdfminer and decides per page whether the
+text layer is good enough to skip Marker. Pages without a usable text layer,
+or with ruled tables or large figures, are left for Marker.
+Output uses the same {name}/{name}.md and {name}_meta.json layout Marker writes,
+so chunk.iter_chunks consumes either.
+"""
+
+import json
+import os
+import re
+import statistics
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_RULE_THICKNESS = 2.0   # points
+_RULE_MIN_LENGTH = 20.0
+_BULLETS = ("•", "▪", "●", "◦")
+
+
+@dataclass
+class TextLine:
+    text: str
+    size: float
+
+
+@dataclass
+class PageText:
+    """Text and layout statistics of one page as seen by pdfminer"""
+    page_id: int
+    blocks: List[List[TextLine]] = field(default_factory=list)
+    chars: int = 0
+    garbled: int = 0
+    rulings: int = 0
+    drawings: int = 0
+    figure_area_ratio: float = 0.0
+    marker_reason: Optional[str] = None
+
+    @property
+    def use_text_layer(self) -> bool:
+        return self.marker_reason is None
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def _assess(page: PageText) -> Optional[str]:
+    """Why a page must go through Marker, or None if its text layer is good enough"""
+    if page.chars < Config.TEXT_LAYER_MIN_CHARS:
+        return "no text layer"
+    if page.garbled / page.chars > Config.TEXT_LAYER_MAX_GARBLED_RATIO:
+        return "garbled text"
+    if page.rulings > Config.TEXT_LAYER_MAX_RULINGS:
+        return "table"
+    if page.figure_area_ratio > Config.TEXT_LAYER_MAX_FIGURE_AREA or page.drawings > Config.TEXT_LAYER_MAX_DRAWINGS:
+        return "figure"
+    return None
+
+
+def _read_page(page_id: int, layout) -> PageText:
+    from pdfminer.layout import LTChar, LTCurve, LTFigure, LTTextBox, LTTextLine
+
+    page = PageText(page_id=page_id)
+    page_area = max(layout.width * layout.height, 1.0)
+    figure_area = 0.0
+
+    for element in layout:
+        if isinstance(element, LTTextBox):
+            lines = []
+            for line in element:
+                if not isinstance(line, LTTextLine):
+                    continue
+                text = line.get_text().strip()
+                if not text:
+                    continue
+                sizes = [char.size for char in line if isinstance(char, LTChar)]
+                lines.append(TextLine(text, statistics.median(sizes) if sizes else 0.0))
+                page.chars += len(text)
+                page.garbled += text.count("(cid:") + text.count("\ufffd")
+            if lines:
+                page.blocks.append(lines)
+        elif isinstance(element, LTFigure):
+            figure_area += element.width * element.height
+        elif isinstance(element, LTCurve):
+            # LTLine and LTRect are LTCurve subclasses: thin long ones are table rules,
+            # large ones frame a vector diagram and small ones are its strokes
+            width, height = element.width, element.height
+            if min(width, height) < _RULE_THICKNESS and max(width, height) > _RULE_MIN_LENGTH:
+                page.rulings += 1
+            elif width > _RULE_MIN_LENGTH and height > _RULE_MIN_LENGTH:
+                figure_area += width * height
+            else:
+                page.drawings += 1
+
+    page.figure_area_ratio = min(figure_area / page_area, 1.0)
+    page.marker_reason = _assess(page)
+    return page
+
+
+def _outline(document, page_ids: Dict[int, int]) -> List[Tuple[int, str, int]]:
+    """(level, title, page_id) for each outline entry that resolves to a page"""
+    from pdfminer.pdfdocument import PDFNoOutlines
+    from pdfminer.pdftypes import PDFObjRef, resolve1
+    from pdfminer.psparser import PSLiteral
+
+    def resolve_dest(dest):
+        dest = resolve1(dest)
+        if isinstance(dest, (bytes, str, PSLiteral)):
+            name = dest.name if isinstance(dest, PSLiteral) else dest
+            dest = resolve1(document.get_dest(name))
+        if isinstance(dest, dict):
+            dest = resolve1(dest.get("D"))
+        if isinstance(dest, list) and dest and isinstance(dest[0], PDFObjRef):
+            return page_ids.get(dest[0].objid)
+        return None
+
+    entries = []
+    try:
+        for level, title, dest, action, _ in document.get_outlines():
+            try:
+                if dest is None and action is not None:
+                    action = resolve1(action)
+                    dest = action.get("D") if isinstance(action, dict) else None
+                page_id = resolve_dest(dest) if dest is not None else None
+            except Exception:
+                page_id = None
+            if page_id is not None and title and title.strip():
+                entries.append((level, title.strip(), page_id))
+    except PDFNoOutlines:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not read PDF outline: {e}")
+    return entries
+
+
+def extract_pdf(pdf_path: str) -> Tuple[List[PageText], List[Tuple[int, str, int]]]:
+    """
+    Read every page's text layer and the document outline
+
+    Returns:
+        (pages, outline) where outline holds (level, title, page_id)
+    """
+    from pdfminer.converter import PDFPageAggregator
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+
+    with open(pdf_path, 'rb') as f:
+        document = PDFDocument(PDFParser(f))
+        resources = PDFResourceManager(caching=True)
+        device = PDFPageAggregator(resources, laparams=LAParams())
+        interpreter = PDFPageInterpreter(resources, device)
+
+        pages, page_ids = [], {}
+        for page_id, pdf_page in enumerate(PDFPage.create_pages(document)):
+            page_ids[pdf_page.pageid] = page_id
+            try:
+                interpreter.process_page(pdf_page)
+                pages.append(_read_page(page_id, device.get_result()))
+            except Exception as e:
+                logger.warning(f"pdfminer could not read page {page_id} of {pdf_path}: {e}")
+                pages.append(PageText(page_id=page_id, marker_reason="unreadable"))
+
+        outline = _outline(document, page_ids)
+    return pages, outline
+
+
+def document_headings(pages: List[PageText], outline: List[Tuple[int, str, int]]) -> List[Tuple[int, str, int]]:
+    """Headings for the text-layer pages: the PDF outline if it has one, else font-size guesses"""
+    return outline if outline else _font_headings(pages)
+
+
+def _font_headings(pages: List[PageText]) -> List[Tuple[int, str, int]]:
+    """Heading guesses from font size, used when the PDF has no outline"""
+    sizes = [line.size for page in pages if page.use_text_layer for block in page.blocks for line in block if line.size]
+    if not sizes:
+        return []
+    body = statistics.median(sizes)
+    heading_sizes = sorted({
+        round(line.size, 1) for page in pages if page.use_text_layer
+        for block in page.blocks for line in block
+        if line.size >= body * Config.TEXT_LAYER_HEADING_SCALE
+    }, reverse=True)
+    levels = {size: min(index + 1, 3) for index, size in enumerate(heading_sizes)}
+
+    headings = []
+    for page in pages:
+        if not page.use_text_layer:
+            continue
+        for block in page.blocks:
+            for line in block:
+                level = levels.get(round(line.size, 1))
+                if level and len(line.text) <= 120 and any(c.isalpha() for c in line.text):
+                    headings.append((level, line.text, page.page_id))
+    return headings
+
+
+def render_pages(
+        pages: List[PageText],
+        headings: List[Tuple[int, str, int]]
+) -> Tuple[str, List[dict]]:
+    """
+    Render text-layer pages as Markdown
+
+    Lines matching a heading on their page become Markdown headings; headings
+    that are not found in the page text are emitted at the top of the page so
+    the chunker can still locate them.
+
+    Returns:
+        (markdown, table_of_contents)
+    """
+    by_page: Dict[int, List[Tuple[int, str]]] = {}
+    for level, title, page_id in headings:
+        by_page.setdefault(page_id, []).append((level, title))
+
+    parts, toc = [], []
+    for page in pages:
+        page_headings = {_normalize(title): (level, title) for level, title in by_page.get(page.page_id, [])}
+        found = []
+        body = []
+        for block in page.blocks:
+            paragraph = []
+            for line in block:
+                key = _normalize(line.text)
+                if key in page_headings and key not in found:
+                    if paragraph:
+                        body.append(" ".join(paragraph))
+                        paragraph = []
+                    level, title = page_headings[key]
+                    body.append(f"{'#' * level} {title}")
+                    found.append(key)
+                elif line.text.startswith(_BULLETS):
+                    if paragraph:
+                        body.append(" ".join(paragraph))
+                    paragraph = ["- " + line.text[1:].strip()]
+                elif paragraph and paragraph[-1].endswith("-"):
+                    paragraph[-1] = paragraph[-1][:-1] + line.text
+                else:
+                    paragraph.append(line.text)
+            if paragraph:
+                body.append(" ".join(paragraph))
+
+        # Headings not found in the page text go to the top of the page, before the found ones
+        missing = [key for key in page_headings if key not in found]
+        for key in missing + found:
+            level, title = page_headings[key]
+            toc.append({"title": title, "heading_level": level, "page_id": page.page_id})
+        header = [f"{'#' * page_headings[key][0]} {page_headings[key][1]}" for key in missing]
+        parts.append("\n\n".join(header + body))
+
+    return "\n\n".join(part for part in parts if part) + "\n", toc
+
+
+def write_text_part(pages: List[PageText], headings: List[Tuple[int, str, int]], pdf_name: str, part_folder: str):
+    """Write text-layer pages in the Marker output layout"""
+    markdown, toc = render_pages(pages, headings)
+    meta = {
+        "table_of_contents": toc,
+        "page_stats": [{"page_id": page.page_id, "text_extraction_method": "pdfminer"} for page in pages],
+    }
+    os.makedirs(part_folder, exist_ok=True)
+    with open(os.path.join(part_folder, f"{pdf_name}.md"), 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    with open(os.path.join(part_folder, f"{pdf_name}_meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
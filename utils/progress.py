@@ -0,0 +1,81 @@
+"""
+Progress tracking for PDF ingestion.
+An IngestProgress is threaded through insert_pdf and its stages so callers
+(the job queue, the bulk CLI) can observe stage, counters and throughput.
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+
+class IngestCancelled(Exception):
+    """Raised inside ingestion stages once cancellation has been requested"""
+
+
+@dataclass
+class IngestProgress:
+    """Mutable progress counters for one document being ingested"""
+    stage: str = "queued"
+    pages_total: int = 0
+    pages_converted: int = 0
+    chunks_total: int = 0
+    chunks_embedded: int = 0
+    chunks_inserted: int = 0
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0
+    detail: str = ""
+    stage_started: Dict[str, float] = field(default_factory=dict)
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+
+    def set_stage(self, stage: str):
+        """Close the current stage timer and start a new one"""
+        now = time.time()
+        if self.stage in self.stage_started:
+            self.stage_seconds[self.stage] = now - self.stage_started[self.stage]
+        self.stage = stage
+        self.stage_started[stage] = now
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise IngestCancelled if cancellation has been requested"""
+        if self.cancelled:
+            raise IngestCancelled("Ingestion cancelled")
+
+    def elapsed(self, stage: str) -> Optional[float]:
+        """Seconds spent in a stage so far, or None if it never started"""
+        if stage in self.stage_seconds:
+            return self.stage_seconds[stage]
+        if stage in self.stage_started:
+            return time.time() - self.stage_started[stage]
+        return None
+
+    def to_dict(self) -> dict:
+        def rate(count: int, stage: str) -> Optional[float]:
+            seconds = self.elapsed(stage)
+            return round(count / seconds, 2) if seconds else None
+
+        return {
+            "stage": self.stage,
+            "pages_total": self.pages_total,
+            "pages_converted": self.pages_converted,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_inserted": self.chunks_inserted,
+            "chunks_unchanged": self.chunks_unchanged,
+            "chunks_deleted": self.chunks_deleted,
+            "detail": self.detail,
+            "pages_per_second": rate(self.pages_converted, "converting"),
+            "chunks_embedded_per_second": rate(self.chunks_embedded, "embedding"),
+            "stage_seconds": {
+                stage: round(self.elapsed(stage), 2) for stage in self.stage_started
+            },
+        }
@@ -0,0 +1,84 @@
+"""
+Per-session web state in SQLite (WAL mode), shared by every web worker process.
+A browser session is identified by a random id kept in a cookie; the PDFs it
+selected for querying are stored here instead of in a process global, so
+whichever worker serves the next request sees the same selection.
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from config import Config
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the store, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.sessions_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.sessions_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " active_pdfs TEXT NOT NULL,"
+            " updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);"
+        )
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(18)
+
+
+def is_valid_session_id(session_id: str) -> bool:
+    """Whether a cookie value looks like an id from new_session_id (and not arbitrary client input)"""
+    return 16 <= len(session_id) <= 64 and all(c.isalnum() or c in "-_" for c in session_id)
+
+
+def get_active_pdfs(session_id: str) -> List[str]:
+    with _connect() as conn:
+        row = conn.execute("SELECT active_pdfs FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+    return json.loads(row[0]) if row else []
+
+
+def set_active_pdfs(session_id: str, pdf_names: List[str]):
+    """Store a session's selection and drop sessions idle for longer than SESSION_MAX_AGE"""
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO sessions (session_id, active_pdfs, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE SET active_pdfs = excluded.active_pdfs, updated_at = excluded.updated_at",
+            (session_id, json.dumps(pdf_names, ensure_ascii=False), now)
+        )
+        conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - Config.SESSION_MAX_AGE,))
+
+
+def remove_pdf(pdf_name: str) -> int:
+    """Deselect a deleted PDF in every session; returns how many sessions had it selected"""
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT session_id, active_pdfs FROM sessions WHERE instr(active_pdfs, ?) > 0",
+            (json.dumps(pdf_name, ensure_ascii=False),)
+        ).fetchall()
+        updates = []
+        for session_id, active_pdfs in rows:
+            names = json.loads(active_pdfs)
+            if pdf_name in names:
+                updates.append((json.dumps([name for name in names if name != pdf_name], ensure_ascii=False), session_id))
+        conn.executemany("UPDATE sessions SET active_pdfs = ? WHERE session_id = ?", updates)
+    return len(updates)
+
+
+def clear():
+    with _connect() as conn:
+        conn.execute("DELETE FROM sessions")
@@ -0,0 +1,162 @@
+"""
+Single-flight request coalescing.
+Concurrent callers that ask for the same key share one upstream computation
+instead of each running it; streamed results are fanned out to every subscriber.
+"""
+
+import asyncio
+import weakref
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from utils import metrics
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+
+class _Call:
+    """An in-flight shared coroutine and the number of callers waiting on it"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _Broadcast:
+    """An in-flight shared async generator with a replay buffer for late subscribers"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+
+    def publish(self, item: Any):
+        self.items.append(item)
+        self.changed.set()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self.changed.set()
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent identical async work.
+
+    The shared work runs in its own task, so a single caller going away does not
+    cancel it for everyone else; it is only cancelled once every caller has left.
+    State is kept per event loop because the sync wrappers in this project run
+    their own short-lived loops in worker threads.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, _Call]]" = weakref.WeakKeyDictionary()
+        self._streams: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, _Broadcast]]" = weakref.WeakKeyDictionary()
+
+    def _loop_state(self, store: weakref.WeakKeyDictionary) -> Dict[Hashable, Any]:
+        loop = asyncio.get_running_loop()
+        state = store.get(loop)
+        if state is None:
+            state = {}
+            store[loop] = state
+        return state
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run fn() once for all concurrent callers with the same key
+
+        Args:
+            key: Hashable identity of the request
+            fn: Zero-argument coroutine factory performing the real work
+
+        Returns:
+            The shared result of fn()
+        """
+        calls = self._loop_state(self._calls)
+        call = calls.get(key)
+        metrics.cache_lookup(f"singleflight_{self.name}", hit=call is not None)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            calls[key] = call
+
+            def forget(_task, k=key, c=call):
+                if calls.get(k) is c:
+                    calls.pop(k, None)
+
+            call.task.add_done_callback(forget)
+        else:
+            logger.debug(f"[{self.name}] Joining in-flight call")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Share one async generator among all concurrent subscribers with the same key
+
+        Every subscriber receives the full sequence of items, including those
+        produced before it joined.
+
+        Args:
+            key: Hashable identity of the request
+            factory: Zero-argument callable returning the async iterator to share
+
+        Yields:
+            Items produced by the shared iterator
+        """
+        streams = self._loop_state(self._streams)
+        broadcast = streams.get(key)
+        metrics.cache_lookup(f"singleflight_{self.name}", hit=broadcast is not None)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            streams[key] = broadcast
+
+            async def pump():
+                try:
+                    async for item in factory():
+                        broadcast.publish(item)
+                    broadcast.finish()
+                except asyncio.CancelledError:
+                    broadcast.finish(asyncio.CancelledError())
+                    raise
+                except Exception as e:
+                    broadcast.finish(e)
+                finally:
+                    if streams.get(key) is broadcast:
+                        streams.pop(key, None)
+
+            broadcast.task = asyncio.ensure_future(pump())
+        else:
+            logger.debug(f"[{self.name}] Joining in-flight stream")
+
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(broadcast.items):
+                    yield broadcast.items[position]
+                    position += 1
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                broadcast.changed.clear()
+                if position < len(broadcast.items) or broadcast.done:
+                    continue
+                await broadcast.changed.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done and broadcast.task is not None:
+                broadcast.task.cancel()
@@ -0,0 +1,260 @@
+"""
+Token and cost accounting for provider calls.
+api_client records the tokens each provider response reports, or a local
+estimate when it reports none (e.g. streamed answers), under the stage of the
+call: split, generate, embed or rerank. Every record is added to
+
+- the ledger of the request in progress (see track()), returned with its response,
+- the llm_tokens_total / llm_cost_total counters on the metrics endpoints,
+- daily totals per stage, model and PDF set in SQLite (WAL mode), for the usage API.
+
+Cost is tokens times the per-million prices of ModelConfig. Coalesced calls
+(single flight) are billed once, to the request that started them. Hedged
+duplicates that were still in flight when another attempt won are billed by
+the provider too; they are recorded as estimates with usage="hedged".
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from config import Config, ModelType
+from utils import metrics
+from utils.chunk import estimate_tokens
+from utils.colored_logger import get_colored_logger
+
+logger = get_colored_logger(__name__)
+
+STAGES = {
+    ModelType.SPLIT: "split",
+    ModelType.CHAT: "generate",
+    ModelType.EMBEDDING: "embed",
+    ModelType.RERANK: "rerank",
+}
+GROUP_COLUMNS = ("day", "stage", "model", "pdf_set")
+
+
+def estimate_message_tokens(messages: List[dict]) -> int:
+    """Prompt tokens of a chat request (the chunker's estimate), with a few tokens of framing per message"""
+    return sum(estimate_tokens(str(message.get("content") or "")) + 4 for message in messages)
+
+
+def pdf_set_key(pdf_names: List[str]) -> str:
+    """Stable name of a set of PDFs, independent of order and duplicates"""
+    return json.dumps(sorted(set(pdf_names)), ensure_ascii=False)
+
+
+def cost_of(model_type: ModelType, prompt_tokens: int, completion_tokens: int) -> float:
+    model_config = Config.get_model_config(model_type)
+    return (prompt_tokens * model_config.input_price + completion_tokens * model_config.output_price) / 1_000_000
+
+
+class Ledger:
+    """Usage of one request (or of work done outside any request), per stage and model"""
+
+    def __init__(self, pdf_names: Optional[List[str]] = None):
+        self.pdf_set = pdf_set_key(pdf_names or [])
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], dict] = {}
+
+    def add(self, stage: str, model: str, prompt_tokens: int, completion_tokens: int, cost: float, estimated: bool):
+        with self._lock:
+            entry = self._entries.setdefault((stage, model), {
+                "calls": 0, "estimated_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0,
+            })
+            entry["calls"] += 1
+            entry["estimated_calls"] += int(estimated)
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["cost"] += cost
+
+    def entries(self, clear: bool = False) -> Dict[Tuple[str, str], dict]:
+        """The usage per (stage, model); with clear, the ledger starts over"""
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+            if clear:
+                self._entries = {}
+        return entries
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = [{"stage": stage, "model": model, **entry} for (stage, model), entry in sorted(self._entries.items())]
+        return {"pdf_set": json.loads(self.pdf_set), "currency": Config.COST_CURRENCY, **_totals(stages), "stages": stages}
+
+
+def _totals(rows: List[dict]) -> dict:
+    prompt_tokens = sum(row["prompt_tokens"] for row in rows)
+    completion_tokens = sum(row["completion_tokens"] for row in rows)
+    return {
+        "calls": sum(row["calls"] for row in rows),
+        "estimated_calls": sum(row["estimated_calls"] for row in rows),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cost": round(sum(row["cost"] for row in rows), 6),
+    }
+
+
+_current: contextvars.ContextVar[Optional[Ledger]] = contextvars.ContextVar("usage_ledger", default=None)
+# Usage of calls made outside track(), stored together with the next tracked request
+_unattributed = Ledger()
+
+
+def record(
+    model_type: ModelType,
+    prompt_tokens: int,
+    completion_tokens: int = 0,
+    estimated: bool = False,
+    hedged: bool = False
+):
+    """
+    Account one provider call to the current request (if any), the metrics and the daily totals
+
+    hedged marks a duplicate attempt whose response was discarded (always an estimate).
+    """
+    estimated = estimated or hedged
+    stage = STAGES[model_type]
+    model = Config.get_model_config(model_type).name
+    cost = cost_of(model_type, prompt_tokens, completion_tokens)
+    kind = "hedged" if hedged else "estimated" if estimated else "reported"
+    metrics.inc("llm_calls_total", stage=stage, model=model, usage=kind)
+    metrics.inc("llm_tokens_total", prompt_tokens, stage=stage, model=model, kind="prompt")
+    metrics.inc("llm_tokens_total", completion_tokens, stage=stage, model=model, kind="completion")
+    metrics.inc("llm_cost_total", cost, stage=stage, model=model, currency=Config.COST_CURRENCY)
+    (_current.get() or _unattributed).add(stage, model, prompt_tokens, completion_tokens, cost, estimated)
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the usage database, commit on success and always close"""
+    os.makedirs(os.path.dirname(Config.DATABASE.usage_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(Config.DATABASE.usage_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage_daily ("
+            " day TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " pdf_set TEXT NOT NULL,"
+            " calls INTEGER NOT NULL,"
+            " estimated_calls INTEGER NOT NULL,"
+            " prompt_tokens INTEGER NOT NULL,"
+            " completion_tokens INTEGER NOT NULL,"
+            " cost REAL NOT NULL,"
+            " PRIMARY KEY (day, stage, model, pdf_set))"
+        )
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def store(*ledgers: Ledger):
+    """Add the ledgers' usage, and any unattributed usage, to today's totals"""
+    day = time.strftime("%Y-%m-%d")
+    rows = []
+    for ledger in ledgers + (_unattributed,):
+        for (stage, model), entry in ledger.entries(clear=ledger is _unattributed).items():
+            rows.append((
+                day, stage, model, ledger.pdf_set, entry["calls"], entry["estimated_calls"],
+                entry["prompt_tokens"], entry["completion_tokens"], entry["cost"]
+            ))
+    if not rows:
+        return
+    with _connect() as conn:
+        conn.executemany(
+            "INSERT INTO usage_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (day, stage, model, pdf_set) DO UPDATE SET"
+            " calls = calls + excluded.calls,"
+            " estimated_calls = estimated_calls + excluded.estimated_calls,"
+            " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+            " completion_tokens = completion_tokens + excluded.completion_tokens,"
+            " cost = cost + excluded.cost",
+            rows
+        )
+
+
+@asynccontextmanager
+async def track(pdf_names: List[str]) -> AsyncIterator[Ledger]:
+    """
+    Account the provider calls made inside the block (including tasks it starts)
+    to a new ledger for the given PDF set; stored in the daily totals on exit
+    """
+    ledger = Ledger(pdf_names)
+    token = _current.set(ledger)
+    try:
+        yield ledger
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass  # An async generator closed from another task than the one that started it
+        try:
+            await asyncio.to_thread(store, ledger)
+        except Exception as e:
+            logger.error(f"Could not store token usage: {e}")
+
+
+def summary(
+    group_by: List[str],
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    pdf_name: Optional[str] = None
+) -> dict:
+    """
+    Stored usage totals, grouped by any of day, stage, model and pdf_set
+
+    Args:
+        group_by: Columns to group by (empty for a single total)
+        since, until: Inclusive day range (YYYY-MM-DD)
+        pdf_name: Only PDF sets containing this PDF
+    """
+    unknown = set(group_by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot group usage by {sorted(unknown)}, choose from {list(GROUP_COLUMNS)}")
+    store()
+    conditions, params = [], []
+    if since:
+        conditions.append("day >= ?")
+        params.append(since)
+    if until:
+        conditions.append("day <= ?")
+        params.append(until)
+    if pdf_name:
+        conditions.append("EXISTS (SELECT 1 FROM json_each(pdf_set) WHERE value = ?)")
+        params.append(pdf_name)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = ", ".join(group_by)
+    select = f"{columns}, " if group_by else ""
+    grouping = f"GROUP BY {columns} ORDER BY {columns}" if group_by else ""
+    with _connect() as conn:
+        rows = conn.execute(
+            f"SELECT {select}SUM(calls), SUM(estimated_calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost)"
+            f" FROM usage_daily {where} {grouping}",
+            params
+        ).fetchall()
+
+    groups = []
+    for row in rows:
+        calls, estimated_calls, prompt_tokens, completion_tokens, cost = row[len(group_by):]
+        if calls is None:
+            continue  # No rows matched the filters
+        group = dict(zip(group_by, row))
+        if "pdf_set" in group:
+            group["pdf_set"] = json.loads(group["pdf_set"])
+        groups.append({
+            **group, "calls": calls, "estimated_calls": estimated_calls, "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens, "cost": cost,
+        })
+    totals = _totals(groups)
+    for group in groups:
+        group["total_tokens"] = group["prompt_tokens"] + group["completion_tokens"]
+        group["cost"] = round(group["cost"], 6)
+    return {"currency": Config.COST_CURRENCY, **totals, "groups": groups}